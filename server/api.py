@@ -1,30 +1,467 @@
-from flask import Flask, request, jsonify
+import argparse
+import json
+import os
+import time
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from flask import Flask, abort, jsonify, make_response, request
 from flask_cors import CORS, cross_origin
-from depgraph2 import process_code
+from flask_sock import Sock
+from cache import ResultCache, SingleFlight, code_fingerprint
+from metrics import (
+    analyses_total, analysis_cpu_seconds, endpoint_seconds, record_analysis, render_metrics, request_seconds, server_timing,
+)
+from depgraph2 import BudgetExceeded, analysis_budget, job_budget, stream_code
+from jobs import JOB_TIMEOUT, Job, JobStore
+from lod import LOD_MAX_NODES, UnknownCluster, analyze_lod, expand_cluster
+from scopes import UnknownScope, open_scope
+from pool import LAYOUT_SETTINGS, AnalysisPool, AnalysisTimeout, PoolBusy, render_analysis, render_batch
+from session import AnalysisSession
+from wire import COMPACT_MEDIA_TYPE, gzip_body
 
 app = Flask(__name__)
 # Enable CORS for the /analyze endpoint from your frontend
 CORS(app, resources={r"/analyze": {"origins": "http://localhost:3000"}})
+sock = Sock(app)
+
+# Results keyed by normalized AST; set DEPGRAPH_CACHE_PATH to persist across restarts
+result_cache = ResultCache(
+    max_bytes=int(os.environ.get("DEPGRAPH_CACHE_BYTES", 64 * 1024 * 1024)),
+    path=os.environ.get("DEPGRAPH_CACHE_PATH"),
+)
+
+# Identical requests that miss the cache together share one analysis; DEPGRAPH_COALESCE=0 turns this off
+in_flight: Optional[SingleFlight] = SingleFlight() if os.environ.get("DEPGRAPH_COALESCE", "1") != "0" else None
+
+# Set by production mode; when None, analyses run in the request thread
+analysis_pool: Optional[AnalysisPool] = None
+RETRY_AFTER_SECONDS = int(os.environ.get("DEPGRAPH_RETRY_AFTER", 1))
+STREAM_STEPS_PER_CHUNK = 256
+
+def run_job(code: str, progress: Callable[[str], None]) -> bytes:
+    """Work of an /analyze job: the same JSON body /analyze would return, under the job limits."""
+    start = time.perf_counter()
+    body, _ = analyze_to_json(code, progress=progress, job=True)
+    endpoint_seconds.observe("job", time.perf_counter() - start)
+    return body
+
+# Analyses submitted to POST /jobs; see jobs.py
+jobs = JobStore(run_job)
+JOB_POLL_SECONDS = 25        # Longest a long poll waits for a new event
+JOB_KEEPALIVE_SECONDS = 15   # Quiet time before an event stream sends a comment to keep the connection open
+
+def analyze_to_json(code: str, timings: Optional[Dict[str, float]] = None, compact: bool = False,
+                    gzipped: bool = False, progress: Optional[Callable[[str], None]] = None,
+                    job: bool = False) -> Tuple[bytes, str]:
+    """
+    Return the serialized /analyze response for code and where it came from: "hit" (the
+    cache), "miss" (analyzed for this call) or "coalesced" (shared from an identical request
+    already being analyzed). compact selects the columnar wire format and gzipped compresses
+    the body; each combination is cached and coalesced separately. When analyzed, per-stage
+    timings are recorded into the metrics and, if given, into timings, and progress (if
+    given) is called as each stage finishes. A job waits for a pool worker and runs under
+    the job limits; it shares cached results with requests but is coalesced only with other
+    jobs, so no request waits on a job's longer analysis.
+    """
+    if timings is None:
+        timings = {}
+    start = time.perf_counter()
+    key = code_fingerprint(code, LAYOUT_SETTINGS) + (":compact" if compact else "") + (":gzip" if gzipped else "")
+    timings["fingerprint"] = time.perf_counter() - start
+    body = result_cache.get(key)
+    if body is not None:
+        return body, "hit"
+
+    def compute() -> bytes:
+        budget = job_budget() if job else analysis_budget()
+        if analysis_pool is not None:
+            body, stats, degraded = analysis_pool.run(code, timings, compact, progress, budget,
+                                                      JOB_TIMEOUT if job else None, wait=job)
+        else:
+            cpu_start = time.thread_time()
+            body, stats, degraded = render_analysis(code, timings, budget, compact, progress)
+            analysis_cpu_seconds.inc("inline", time.thread_time() - cpu_start)
+        record_analysis(timings, stats)
+        if gzipped:
+            body = gzip_body(body)
+        if not degraded:    # Shortcuts depend on load and limits, so only complete results are cached
+            result_cache.put(key, body)
+        return body
+
+    if in_flight is None:
+        body, shared = compute(), False
+    else:
+        body, shared = in_flight.do(key + (":job" if job else ""), compute)
+    analyses_total.inc("coalesced" if shared else "computed")
+    return body, "coalesced" if shared else "miss"
+
+def payload_fields(*names: str) -> Tuple:
+    """The named fields of the JSON body, in order; a body missing any of them is answered with 400."""
+    payload = request.get_json()
+    try:
+        return tuple(payload[name] for name in names)
+    except (KeyError, TypeError):
+        missing = " or ".join(f"'{name}'" for name in names)
+        abort(make_response(jsonify({"error": f"Missing {missing} in payload"}), 400))
+
+def error_response(error: Exception):
+    """
+    The JSON response for an error raised while analyzing: 503 with Retry-After when the
+    pool is busy, 504 on timeout, 413 over budget, 404 for an unknown cluster or scope and
+    500 otherwise.
+    """
+    response = jsonify({"error": str(error)})
+    if isinstance(error, PoolBusy):
+        response.headers["Retry-After"] = str(RETRY_AFTER_SECONDS)
+        return response, 503
+    if isinstance(error, AnalysisTimeout):
+        return response, 504
+    if isinstance(error, BudgetExceeded):
+        return response, 413
+    if isinstance(error, (UnknownCluster, UnknownScope)):
+        return response, 404
+    return response, 500
 
 @app.route('/analyze', methods=['POST', 'OPTIONS'])
 @cross_origin(origins="http://localhost:3000")
 def analyze():
-    payload = request.get_json()
+    [code] = payload_fields('Original')
+    compact = request.args.get("format") == "compact" or COMPACT_MEDIA_TYPE in request.headers.get("Accept", "")
+    gzipped = request.accept_encodings["gzip"] > 0    # Not for "gzip;q=0"
+    start = time.perf_counter()
+    timings = {}
     try:
-        code = payload['Original']
-    except KeyError:
-        return jsonify({"error": "Missing 'Original' in payload"}), 400
+        body, outcome = analyze_to_json(code, timings, compact, gzipped)
+    except Exception as e:
+        return error_response(e)
+    timings["total"] = time.perf_counter() - start
+    request_seconds.observe(outcome, timings["total"])
+
+    response = app.response_class(body, mimetype=COMPACT_MEDIA_TYPE if compact else "application/json")
+    response.headers["Server-Timing"] = server_timing(timings)
+    response.headers["Vary"] = "Accept, Accept-Encoding"
+    if gzipped:
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+def ndjson_chunks(first, items: Iterator) -> Iterator[bytes]:
+    """Serialize stream_code items as NDJSON, grouping order steps into chunks to limit write overhead."""
+    yield (json.dumps(first, separators=(",", ":")) + "\n").encode("utf-8")
+    lines = []
+    for item in items:
+        lines.append(json.dumps(item, separators=(",", ":")))
+        if len(lines) >= STREAM_STEPS_PER_CHUNK:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode("utf-8")
 
+@app.route('/analyze/stream', methods=['POST', 'OPTIONS'])
+@cross_origin(origins="http://localhost:3000")
+def analyze_stream():
+    """
+    Streaming variant of /analyze returning NDJSON: a {"nodes", "edges"} line, one
+    [element id, color] line per order step as it is generated, then a {"done", "degraded"} line.
+    """
+    [code] = payload_fields('Original')
+    release = None
+    if analysis_pool is not None:
+        try:
+            analysis_pool.acquire_slot()
+        except PoolBusy as e:
+            return error_response(e)
+        release = analysis_pool.release_slot
+
+    items = stream_code(code, analysis_budget())
+    try:
+        first = next(items)    # Surface parse and budget errors before the response starts
+    except Exception as e:
+        if release is not None:
+            release()
+        return error_response(e)
+
+    response = app.response_class(ndjson_chunks(first, items), mimetype="application/x-ndjson")
+    if release is not None:
+        response.call_on_close(release)    # Runs even if the client disconnects mid-stream
+    return response
+
+def session_reply(session: AnalysisSession, message) -> Dict:
+    """Handle one session message and return the reply (snapshot, diff or error)."""
+    try:
+        code = message['Original']
+    except (KeyError, TypeError):
+        return session.error("Missing 'Original' in message")
+
+    if analysis_pool is not None:
+        try:
+            analysis_pool.acquire_slot()    # Session updates run here but share the pool's admission limit
+        except PoolBusy as e:
+            return {**session.error(str(e)), "retry_after": RETRY_AFTER_SECONDS}
+    start = time.perf_counter()
     try:
-        result = process_code(code)
+        return session.update(code, snapshot=bool(message.get('snapshot')), budget=analysis_budget())
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return session.error(str(e))
+    finally:
+        if analysis_pool is not None:
+            analysis_pool.release_slot()
+        endpoint_seconds.observe("session", time.perf_counter() - start)
 
-    return jsonify({
-        "nodes": result["positioned_nodes"],
-        "edges": result["edges"],
-        "order": result["order"]
-    })
+@sock.route('/session')
+def analysis_session(ws):
+    """
+    WebSocket editing session. Each text message is {"Original": code} (add "snapshot": true
+    to get the full graph again) and is answered with a snapshot or a diff (see session.py).
+    Connect with ?layout=stable to keep unchanged nodes in place between edits.
+    """
+    session = AnalysisSession(stable_layout=request.args.get("layout") == "stable")
+    while True:
+        try:
+            message = json.loads(ws.receive())
+        except ValueError:
+            ws.send(json.dumps(session.error("Messages must be JSON")))
+            continue
+        ws.send(json.dumps(session_reply(session, message), separators=(",", ":")))
+
+def inline_reply(run, label: str):
+    """
+    Run a call that returns a JSON payload (given the budget and timings) in the request
+    thread, within the pool's admission limit, and build its response. Its time is recorded
+    in endpoint_seconds under label.
+    """
+    if analysis_pool is not None:
+        try:
+            analysis_pool.acquire_slot()
+        except PoolBusy as e:
+            return error_response(e)
+    start = time.perf_counter()
+    timings = {}
+    try:
+        result = run(analysis_budget(), timings)
+    except Exception as e:
+        return error_response(e)
+    finally:
+        if analysis_pool is not None:
+            analysis_pool.release_slot()
+    timings["total"] = time.perf_counter() - start
+    endpoint_seconds.observe(label, timings["total"])
+
+    response = jsonify(result)
+    response.headers["Server-Timing"] = server_timing(timings)
+    return response
+
+def lod_reply(run):
+    """Run a level-of-detail call (analyze_lod or expand_cluster, given ?max_nodes=) with inline_reply."""
+    try:
+        max_nodes = int(request.args.get("max_nodes", LOD_MAX_NODES))
+    except ValueError:
+        max_nodes = 0
+    if max_nodes < 2:
+        return jsonify({"error": "'max_nodes' must be an integer of at least 2"}), 400
+    return inline_reply(lambda budget, timings: run(max_nodes, budget, timings), "lod")
+
+@app.route('/analyze/lod', methods=['POST', 'OPTIONS'])
+@cross_origin(origins="http://localhost:3000")
+def analyze_lod_route():
+    """
+    Level-of-detail view for large programs: the /analyze payload cut down to at most
+    ?max_nodes= elements by collapsing chains and dense groups into clusters (see lod.py).
+    """
+    [code] = payload_fields('Original')
+    return lod_reply(lambda max_nodes, budget, timings: analyze_lod(code, max_nodes, budget, timings))
+
+@app.route('/analyze/lod/expand', methods=['POST', 'OPTIONS'])
+@cross_origin(origins="http://localhost:3000")
+def expand_cluster_route():
+    """
+    Expand one cluster of a level-of-detail view: {"Original": code, "cluster": id}, with the
+    same ?max_nodes= as the view. Replies with the cluster's own view and its boundary edges.
+    """
+    code, cluster_id = payload_fields('Original', 'cluster')
+    if not isinstance(cluster_id, str):
+        return jsonify({"error": "'cluster' must be a string"}), 400
+    return lod_reply(lambda max_nodes, budget, timings: expand_cluster(code, cluster_id, max_nodes, budget, timings))
+
+@app.route('/analyze/scopes', methods=['POST', 'OPTIONS'])
+@cross_origin(origins="http://localhost:3000")
+def analyze_scopes_route():
+    """
+    Module-level summary of a program: its module variables, with each top-level function or
+    class drawn as one node, and the scopes that can be opened (see scopes.py).
+    """
+    [code] = payload_fields('Original')
+    return inline_reply(lambda budget, timings: open_scope(code, "", budget, timings), "scopes")
+
+@app.route('/analyze/scopes/open', methods=['POST', 'OPTIONS'])
+@cross_origin(origins="http://localhost:3000")
+def open_scope_route():
+    """
+    Open one scope of a program: {"Original": code, "scope": name}, with a name listed under
+    "scopes" by the summary or by the scope around it. Laid out on the first request only.
+    """
+    code, scope = payload_fields('Original', 'scope')
+    if not isinstance(scope, str):
+        return jsonify({"error": "'scope' must be a string"}), 400
+    return inline_reply(lambda budget, timings: open_scope(code, scope, budget, timings), "scopes")
+
+@app.route('/jobs', methods=['POST', 'OPTIONS'])
+@cross_origin(origins="http://localhost:3000")
+def submit_job():
+    """
+    Queue an analysis and reply at once (202) with its job id. Follow it with
+    GET /jobs/<id>/events (Server-Sent Events) or by long polling GET /jobs/<id>.
+    """
+    [code] = payload_fields('Original')
+    try:
+        job = jobs.submit(code)
+    except PoolBusy as e:
+        return error_response(e)
+    response = jsonify({"job": job.id, "events": f"/jobs/{job.id}/events", "poll": f"/jobs/{job.id}"})
+    response.headers["Location"] = f"/jobs/{job.id}"
+    return response, 202
+
+def first_event() -> int:
+    """Number of the first event to send: ?after= or the Last-Event-ID of a reconnecting stream."""
+    try:
+        return max(0, int(request.headers.get("Last-Event-ID") or request.args.get("after", 0)))
+    except ValueError:
+        return 0
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@cross_origin(origins="http://localhost:3000")
+def poll_job(job_id: str):
+    """
+    Long poll: the job's events from ?after= on (0 by default), waiting up to ?wait= seconds
+    for one. Replies with "events", "next" (the ?after= of the next poll) and "state"; once
+    the job is done, the /analyze payload is included as "result".
+    """
+    job = jobs.get(job_id)
+    if job is None:    # Never submitted, or finished and evicted
+        return jsonify({"error": f"Unknown job '{job_id}'"}), 404
+    after = first_event()
+    try:
+        wait = min(float(request.args.get("wait", JOB_POLL_SECONDS)), JOB_POLL_SECONDS)
+    except ValueError:
+        wait = JOB_POLL_SECONDS
+    events, state = job.wait(after, max(0.0, wait))
+    reply = json.dumps({"job": job.id, "state": state, "events": events, "next": after + len(events)},
+                       separators=(",", ":")).encode("utf-8")
+    if state == "done":    # The body is already serialized, so it is spliced in as it is
+        reply = reply[:-1] + b',"result":' + job.result + b"}"
+    return app.response_class(reply, mimetype="application/json")
+
+def job_events(job: Job, after: int) -> Iterator[bytes]:
+    """Server-Sent Events for a job: one "progress" event per job event, then a "result" event once done."""
+    while True:
+        events, state = job.wait(after, JOB_KEEPALIVE_SECONDS)
+        if not events:
+            yield b": keepalive\n\n"
+            continue
+        for event in events:
+            after += 1
+            yield f"id: {after}\nevent: progress\ndata: {json.dumps(event, separators=(',', ':'))}\n\n".encode("utf-8")
+        if state == "done":
+            yield b"event: result\ndata: " + job.result + b"\n\n"
+        if state in ("done", "failed"):
+            return
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+@cross_origin(origins="http://localhost:3000")
+def stream_job(job_id: str):
+    """Follow a job as Server-Sent Events (see job_events); reconnecting resumes after Last-Event-ID."""
+    job = jobs.get(job_id)
+    if job is None:    # Never submitted, or finished and evicted
+        return jsonify({"error": f"Unknown job '{job_id}'"}), 404
+    response = app.response_class(job_events(job, first_event()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"    # Keep proxies such as nginx from holding events back
+    return response
+
+@app.route('/analyze/batch', methods=['POST'])
+def analyze_batch_route():
+    [submissions] = payload_fields('submissions')
+    if not isinstance(submissions, dict):
+        return jsonify({"error": "'submissions' must map submission ids to code"}), 400
+
+    start = time.perf_counter()
+    timings = {}
+    try:
+        if analysis_pool is not None:    # One worker analyzes the whole batch, within the pool's limits
+            body, _, _ = analysis_pool.run_batch(submissions, timings)
+        else:
+            body, _, _ = render_batch(submissions, timings)
+    except Exception as e:
+        return error_response(e)
+    timings["total"] = time.perf_counter() - start
+    endpoint_seconds.observe("batch", timings["total"])
+
+    response = app.response_class(body, mimetype="application/json")
+    response.headers["Server-Timing"] = server_timing(timings)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return app.response_class(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+@app.route('/jobs/stats', methods=['GET'])
+def job_stats():
+    return jsonify(jobs.stats())
+
+def serve_production(host: str, port: int, threads: int, workers: int, queue_depth: int, timeout: float) -> None:
+    """
+    Serve the app with gunicorn: one process, since the result cache, jobs and sessions live
+    in it, handling at most threads connections at once. The analysis pool is started in
+    that process once gunicorn has forked it, and closed when it exits.
+    """
+    from gunicorn.app.base import BaseApplication    # Only production mode needs gunicorn
+
+    def start_pool(worker) -> None:
+        global analysis_pool
+        analysis_pool = AnalysisPool(workers, queue_depth, timeout)
+
+    def close_pool(server, worker) -> None:
+        if analysis_pool is not None:
+            analysis_pool.close()
+
+    class ProductionServer(BaseApplication):
+        def load_config(self) -> None:
+            settings = {
+                "bind": f"{host}:{port}",
+                "workers": 1,
+                "worker_class": "gthread",    # Threads, so WebSocket sessions and event streams work
+                "threads": threads,
+                "post_worker_init": start_pool,
+                "worker_exit": close_pool,
+            }
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    ProductionServer().run()
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5001)
+    parser = argparse.ArgumentParser(description="Dependency graph analysis server.")
+    parser.add_argument("--production", action="store_true",
+                        help="serve with gunicorn and run analyses in a bounded pool of preforked workers")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("DEPGRAPH_WORKERS", os.cpu_count() or 1)),
+                        help="analysis worker processes (production mode)")
+    parser.add_argument("--queue-depth", type=int, default=int(os.environ.get("DEPGRAPH_QUEUE_DEPTH", 16)),
+                        help="requests allowed to wait for a worker before new ones get 503 (production mode)")
+    parser.add_argument("--timeout", type=float, default=float(os.environ.get("DEPGRAPH_TIMEOUT", 10)),
+                        help="seconds before an analysis is cancelled (production mode)")
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("DEPGRAPH_THREADS", 64)),
+                        help="connections served at once, open WebSocket sessions and event streams included (production mode)")
+    args = parser.parse_args()
+
+    if args.production:
+        serve_production(args.host, args.port, args.threads, args.workers, args.queue_depth, args.timeout)
+    else:
+        app.run(debug=True, host=args.host, port=args.port)
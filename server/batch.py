@@ -0,0 +1,91 @@
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional
+
+from depgraph2 import Budget, analysis_budget
+from structure import StructureCache, process_code_by_structure
+
+# ---------------------
+# Worker Pool
+# ---------------------
+
+WORKER_COUNT = os.cpu_count() or 1
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    Return the shared process pool, creating it on first use.
+    Workers import depgraph2 once (through this module) and are reused across batches.
+    They are started by a forkserver (or spawned) rather than forked: the server calls this
+    from request threads, and forking a threaded process copies locks other threads hold.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            context = multiprocessing.get_context(
+                "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            )
+            _executor = ProcessPoolExecutor(max_workers=WORKER_COUNT, mp_context=context)
+        return _executor
+
+def shutdown_executor() -> None:
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(cancel_futures=True)
+            _executor = None
+
+atexit.register(shutdown_executor)
+
+# ---------------------
+# Batch Analysis
+# ---------------------
+
+# Per worker process: submissions with the same graph structure share one layout and order
+_structures = StructureCache()
+
+def analyze_one(code: str, budget: Optional[Budget] = None) -> Dict:
+    """
+    Analyze a single program under a budget (analysis_budget() by default), returning the
+    /analyze payload plus its "structure" fingerprint, or an {"error": ...} entry.
+    """
+    budget = budget if budget is not None else analysis_budget()
+    try:
+        result = process_code_by_structure(code, _structures, budget=budget)
+    except Exception as e:
+        return {"error": str(e)}
+    payload = {
+        "nodes": result["positioned_nodes"],
+        "edges": result["edges"],
+        "order": result["order"],
+        "structure": result["structure"]
+    }
+    if result["merged"]:
+        payload["merged"] = result["merged"]
+    if result["degraded"]:
+        payload["degraded"] = result["degraded"]
+    return payload
+
+def analyze_batch(programs: Dict[str, str], parallel: bool = True) -> Dict[str, Dict]:
+    """
+    Analyze many programs in parallel across the worker pool, or one after another in this
+    process if parallel is False (as production pool workers do, which may not start
+    processes of their own).
+    Takes a mapping of submission id to source code and returns a mapping of submission id
+    to its result; a program that fails to parse or analyze only fails its own entry. Each
+    program gets its own analysis_budget().
+    """
+    if not programs:
+        return {}
+    if not parallel:
+        return {submission: analyze_one(code) for submission, code in programs.items()}
+    executor = get_executor()
+    ids = list(programs)
+    chunksize = max(1, len(ids) // (4 * WORKER_COUNT))
+    results = executor.map(analyze_one, [programs[i] for i in ids], chunksize=chunksize)
+    return dict(zip(ids, results))
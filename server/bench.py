@@ -0,0 +1,471 @@
+"""
+Per-stage benchmarks for the dependency-graph pipelines.
+
+Generates synthetic programs of controlled shape, times each stage of process_code for
+depgraph and depgraph2, and writes the results to a JSON file. The "wire" engine instead
+measures payload size and serialization time of the default and compact response formats,
+the "incremental" engine the cost of re-analyzing single-statement edits, the "stable"
+engine the warm-started layout against a from-scratch one after such edits, the
+"layout" engine the time and edge crossings of each layout engine, the "extract" engine
+the time and peak allocations of depgraph2's GraphExtractor against the visitor pair
+(depgraph.AssignmentVisitor), and the "components" engine the per-component analysis of
+a program made of several independent copies of the shape, before and after editing one
+of them. When a baseline file is
+given, any stage slower than the baseline by more than the threshold is reported as a
+regression and the exit status is 1.
+
+    python bench.py -o bench.json
+    python bench.py -o bench.json --baseline old.json --threshold 0.2
+"""
+import argparse
+import ast
+import gc
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import depgraph
+import depgraph2
+import wire
+from batch import get_executor
+from components import process_code_by_components
+from incremental import IncrementalAnalyzer
+from structure import StructureCache
+
+# ---------------------
+# Synthetic Programs
+# ---------------------
+
+def _sum_expr(names: List[str]) -> str:
+    return " + ".join(names) if names else "0"
+
+def _reduce(names: List[str], prefix: str, lines: List[str], fan: int = 16) -> str:
+    """Combine names into a single variable through a tree of at most fan-wide sums."""
+    level = 0
+    while len(names) > 1:
+        reduced = []
+        for start in range(0, len(names), fan):
+            var = f"{prefix}_{level}_{start // fan}"
+            lines.append(f"{var} = {_sum_expr(names[start:start + fan])}")
+            reduced.append(var)
+        names = reduced
+        level += 1
+    return names[0]
+
+def chain_program(n: int) -> str:
+    """A single dependency chain of n variables."""
+    lines = ["v0 = float(input())"]
+    lines += [f"v{i} = v{i - 1} * 2" for i in range(1, n)]
+    return "\n".join(lines)
+
+def fan_in_program(n: int) -> str:
+    """n inputs reduced into one output through wide sums."""
+    lines = [f"x{i} = float(input())" for i in range(n)]
+    total = _reduce([f"x{i}" for i in range(n)], "s", lines)
+    lines.append(f"result = {total}")
+    return "\n".join(lines)
+
+def fan_out_program(n: int) -> str:
+    """One input used by n intermediate variables, gathered into a single output."""
+    lines = ["base = float(input())"]
+    lines += [f"y{i} = base * {i}" for i in range(n)]
+    total = _reduce([f"y{i}" for i in range(n)], "g", lines)
+    lines.append(f"result = {total}")
+    return "\n".join(lines)
+
+def diamond_program(n: int, width: int = 8) -> str:
+    """A lattice of rows of the given width, each node depending on two neighbours above."""
+    rows = max(1, n // width)
+    lines = [f"d0_{j} = float(input())" for j in range(width)]
+    for i in range(1, rows):
+        for j in range(width):
+            lines.append(f"d{i}_{j} = d{i - 1}_{j} + d{i - 1}_{(j + 1) % width}")
+    total = _reduce([f"d{rows - 1}_{j}" for j in range(width)], "m", lines)
+    lines.append(f"result = {total}")
+    return "\n".join(lines)
+
+def many_outputs_program(n: int, length: int = 4) -> str:
+    """n // length independent short chains, each ending in its own output."""
+    lines = []
+    for c in range(max(1, n // length)):
+        lines.append(f"c{c}_0 = float(input())")
+        lines += [f"c{c}_{i} = c{c}_{i - 1} + 1" for i in range(1, length)]
+    return "\n".join(lines)
+
+def shared_program(n: int) -> str:
+    """A chain of n // 2 variables, each read by its own output together with another link of the chain."""
+    links = max(1, n // 2)
+    lines = ["b0 = float(input())"] + [f"b{i} = b{i - 1} + 1" for i in range(1, links)]
+    lines += [f"o{i} = b{i} * 2 + b{(i * 7) % links}" for i in range(links)]
+    return "\n".join(lines)
+
+def loops_program(n: int) -> str:
+    """
+    n // 3 loops, each with two variables that read each other (a cycle) feeding the next
+    loop and an accumulator shared by all of them (a self-dependency).
+    """
+    lines = ["total = 0", "p0 = float(input())"]
+    for k in range(max(1, n // 3)):
+        lines.append(f"for i{k} in range(10):")
+        lines.append(f"    a{k} = p{k} + b{k}")
+        lines.append(f"    b{k} = a{k} * i{k}")
+        lines.append(f"    total = total + b{k}")
+        lines.append(f"p{k + 1} = a{k}")
+    lines.append("result = total")
+    return "\n".join(lines)
+
+def long_edges_program(n: int) -> str:
+    """A chain of n variables that all also read the first one, so its edges reach every row."""
+    lines = ["x0 = 1"] + [f"x{i} = x{i - 1} + x0" for i in range(1, n)]
+    return "\n".join(lines)
+
+def random_program(n: int, seed: int = 0, max_deps: int = 3) -> str:
+    """n variables with random dependencies on earlier ones, gathered into one output."""
+    rng = random.Random(seed)
+    lines = []
+    used = set()
+    for i in range(n):
+        k = rng.randint(0, min(max_deps, i))
+        deps = rng.sample(range(i), k)
+        used.update(deps)
+        lines.append(f"r{i} = {_sum_expr([f'r{d}' for d in deps]) if deps else 'float(input())'}")
+    total = _reduce([f"r{i}" for i in range(n) if i not in used], "t", lines)
+    lines.append(f"result = {total}")
+    return "\n".join(lines)
+
+SHAPES: Dict[str, Callable[[int], str]] = {
+    "chain": chain_program,
+    "fan_in": fan_in_program,
+    "fan_out": fan_out_program,
+    "diamond": diamond_program,
+    "many_outputs": many_outputs_program,
+    "random": random_program,
+    "loops": loops_program,
+    "shared": shared_program,
+    "long_edges": long_edges_program,
+}
+
+# ---------------------
+# Stage Timing
+# ---------------------
+
+class StageTimer:
+    """Collects wall time per named stage."""
+
+    def __init__(self) -> None:
+        self.stages: Dict[str, float] = {}
+
+    def run(self, name: str, fn: Callable, *args):
+        start = time.perf_counter()
+        value = fn(*args)
+        self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+        return value
+
+def _visit(visitor_cls, tree):
+    visitor = visitor_cls()
+    visitor.visit(tree)
+    return {k: list(v) for k, v in visitor.graph.items()}
+
+def _extract(tree):
+    return depgraph2.GraphExtractor().extract(tree)
+
+def stages_depgraph(code: str) -> Tuple[Dict[str, float], Dict]:
+    t = StageTimer()
+    tree = t.run("ast.parse", ast.parse, code)
+    graph = t.run("AssignmentVisitor", _visit, depgraph.AssignmentVisitor, tree)
+    graph = t.run("sterilize_graph", depgraph.sterilize_graph, graph)
+    nodes, ids = t.run("calculate_node_positions", depgraph.calculate_node_positions, graph)
+    edges = t.run("generate_edges", depgraph.generate_edges, graph, ids)
+    t.run("generate_order", depgraph.generate_order, graph, ids)
+    return t.stages, {"nodes": len(nodes), "edges": len(edges)}
+
+def stages_depgraph2(code: str) -> Tuple[Dict[str, float], Dict]:
+    t = StageTimer()
+    tree = t.run("ast.parse", ast.parse, code)
+    graph = t.run("GraphExtractor", _extract, tree)
+    index = t.run("GraphIndex", depgraph2.GraphIndex, graph)
+    x_positions = t.run("layout_node_positions", depgraph2.layout_node_positions, index)
+    steps = t.run("generate_order", depgraph2.generate_order, index, x_positions)
+    t.run("materialize_nodes", depgraph2.materialize_nodes, index, x_positions)
+    t.run("generate_edges", depgraph2.generate_edges, index)
+    t.run("materialize_order", depgraph2.materialize_order, index, steps)
+    return t.stages, {"nodes": len(index), "edges": index.edge_count, "layout": depgraph2.layout_engine(index)}
+
+def stages_wire(code: str) -> Tuple[Dict[str, float], Dict]:
+    """Serialization time and payload bytes of each response encoding."""
+    result = depgraph2.process_code(code)
+    payload = {"nodes": result["positioned_nodes"], "edges": result["edges"], "order": result["order"]}
+    t = StageTimer()
+    sizes = {}
+    for name, compact in (("json", False), ("compact", True)):
+        body = t.run(name, wire.encode, payload, compact)
+        gzipped = t.run(name + "+gzip", wire.gzip_body, body)
+        t.stages[name + "+gzip"] += t.stages[name]
+        sizes[name], sizes[name + "+gzip"] = len(body), len(gzipped)
+    return t.stages, {"nodes": result["stats"]["nodes"], "edges": result["stats"]["edges"], "bytes": sizes}
+
+def _add_dependency(lines: List[str], at: int) -> str:
+    """Edit statement `at` to also depend on the target of the statement before it."""
+    edited = list(lines)
+    edited[at] = f"{edited[at]} + {lines[at - 1].split(' = ', 1)[0]}"
+    return "\n".join(edited)
+
+def stages_incremental(code: str) -> Tuple[Dict[str, float], Dict]:
+    """
+    Time IncrementalAnalyzer.update() for a one-statement edit near the start, middle and end
+    of the program (each applied to the unedited program), next to a full process_code.
+    """
+    lines = code.split("\n")
+    analyzer = IncrementalAnalyzer()
+    t = StageTimer()
+    t.run("process_code", depgraph2.process_code, code)
+    reuse = {}
+    for name, at in (("start", 1), ("middle", len(lines) // 2), ("end", len(lines) - 1)):
+        analyzer.update(code)
+        edited = _add_dependency(lines, max(1, at))
+        t.run("update/" + name, analyzer.update, edited)
+        reuse[name] = dict(analyzer.last_update)
+    stats = analyzer.update(code)["stats"]
+    return t.stages, {"nodes": stats["nodes"], "edges": stats["edges"], "reuse": reuse}
+
+def _displacement(before: Dict[str, float], index: depgraph2.GraphIndex, x_positions) -> float:
+    """Mean horizontal distance moved by the nodes present in both layouts."""
+    moves = [abs(x_positions[node] - before[name]) for node, name in enumerate(index.names) if name in before]
+    return statistics.mean(moves) if moves else 0.0
+
+def stages_stable(code: str) -> Tuple[Dict[str, float], Dict]:
+    """
+    Compare a from-scratch layout with the warm-started stable layout after one-statement
+    edits near the start, middle and end: wall time, sweeps run and mean node displacement.
+    """
+    lines = code.split("\n")
+    base_graph = _extract(ast.parse(code))
+    base = depgraph2.GraphIndex(base_graph)
+    base_x = depgraph2.calculate_node_positions(base)
+    previous = {name: base_x[node] for node, name in enumerate(base.names)}
+    t = StageTimer()
+    sweeps, displacement = {}, {}
+    for name, at in (("start", 1), ("middle", len(lines) // 2), ("end", len(lines) - 1)):
+        graph = _extract(ast.parse(_add_dependency(lines, max(1, at))))
+        index = depgraph2.GraphIndex(graph)
+        changed = {target for target, deps in graph.items() if base_graph.get(target) != deps}
+        x_full = t.run("full/" + name, depgraph2.calculate_node_positions, index)
+        x_stable, sweeps[name] = t.run("stable/" + name, depgraph2.stable_node_positions, index, previous, changed)
+        displacement["full/" + name] = _displacement(previous, index, x_full)
+        displacement["stable/" + name] = _displacement(previous, index, x_stable)
+    return t.stages, {"nodes": len(base), "edges": base.edge_count, "sweeps": sweeps, "displacement": displacement}
+
+def stages_layout(code: str) -> Tuple[Dict[str, float], Dict]:
+    """Wall time and edge crossings of each layout engine on the same graph."""
+    import sugiyama
+    index = depgraph2.GraphIndex(_extract(ast.parse(code)))
+    t = StageTimer()
+    crossings = {}
+    for name, engine in depgraph2.LAYOUT_ENGINES.items():
+        x_positions = t.run(name, engine, index)
+        crossings[name] = sugiyama.count_crossings(index, x_positions)
+    return t.stages, {"nodes": len(index), "edges": index.edge_count, "crossings": crossings}
+
+def _peak_bytes(fn: Callable, *args) -> int:
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def stages_extract(code: str) -> Tuple[Dict[str, float], Dict]:
+    """Graph extraction by the visitor pair and by GraphExtractor: wall time, then peak allocations."""
+    tree = ast.parse(code)
+    t = StageTimer()
+    graph = t.run("visitor", _visit, depgraph.AssignmentVisitor, tree)
+    t.run("extractor", _extract, tree)
+    peak = {
+        "visitor": _peak_bytes(_visit, depgraph.AssignmentVisitor, tree),
+        "extractor": _peak_bytes(_extract, tree),
+    }
+    return t.stages, {"nodes": len(graph), "edges": sum(len(deps) for deps in graph.values()), "peak_bytes": peak}
+
+class _Prefix(ast.NodeTransformer):
+    def __init__(self, prefix: str) -> None:
+        self.prefix = prefix
+
+    def visit_Name(self, node: ast.Name) -> ast.Name:
+        if node.id not in depgraph2.BUILTINS:
+            node.id = self.prefix + node.id
+        return node
+
+def _block(lines: List[str], at: int, prefix: str) -> str:
+    """The program edited at statement `at`, with every variable prefixed so blocks stay independent."""
+    return ast.unparse(_Prefix(prefix).visit(ast.parse(_add_dependency(lines, at))))
+
+COMPONENT_BLOCKS = 4
+
+def stages_components(code: str) -> Tuple[Dict[str, float], Dict]:
+    """
+    process_code against process_code_by_components on COMPONENT_BLOCKS independent copies of
+    the program (each edited at a different statement): cold, after re-editing one copy, and
+    cold with large components analyzed on the shared process pool.
+    """
+    lines = code.split("\n")
+    # Only top-level assignments can take the extra dependency
+    editable = [at for at in range(1, len(lines)) if " = " in lines[at] and not lines[at][0].isspace()
+                and not lines[at - 1][0].isspace()]
+    blocks = [_block(lines, editable[i % len(editable)], f"k{i}_") for i in range(COMPONENT_BLOCKS)]
+    program = "\n".join(blocks)
+    edited = "\n".join([_block(lines, editable[len(editable) // 2], "k0_")] + blocks[1:])
+    cache = StructureCache()
+    executor = get_executor()
+    process_code_by_components(program, StructureCache(), None, None, executor)    # Start the workers
+    t = StageTimer()
+    t.run("process_code", depgraph2.process_code, program)
+    result = t.run("components", process_code_by_components, program, cache)
+    t.run("edit/process_code", depgraph2.process_code, edited)
+    t.run("edit/components", process_code_by_components, edited, cache)
+    t.run("parallel", process_code_by_components, program, StructureCache(), None, None, executor)
+    return t.stages, {"nodes": result["stats"]["nodes"], "edges": result["stats"]["edges"],
+                      "components": result["stats"]["components"]}
+
+ENGINES = {
+    "depgraph": stages_depgraph,
+    "depgraph2": stages_depgraph2,
+    "wire": stages_wire,
+    "incremental": stages_incremental,
+    "stable": stages_stable,
+    "layout": stages_layout,
+    "extract": stages_extract,
+    "components": stages_components,
+}
+
+def bench_case(engine: str, shape: str, size: int, repeat: int) -> Dict:
+    """Time one engine on one synthetic program, keeping the median of each stage."""
+    code = SHAPES[shape](size)
+    case = {"engine": engine, "shape": shape, "size": size}
+    runs = []
+    gc_was_enabled = gc.isenabled()
+    try:
+        for _ in range(repeat):
+            gc.collect()
+            gc.disable()    # Keep collector pauses out of individual stage timings, as timeit does
+            stages, info = ENGINES[engine](code)
+            runs.append(stages)
+            case.update(info)
+    except Exception as e:
+        case["error"] = f"{type(e).__name__}: {e}"
+        return case
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    case["stages"] = {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+    case["total"] = sum(case["stages"].values())
+    return case
+
+def iter_cases(engines: List[str], shapes: List[str], sizes: List[int]) -> Iterator[Tuple[str, str, int]]:
+    for engine in engines:
+        for shape in shapes:
+            for size in sizes:
+                yield engine, shape, size
+
+# ---------------------
+# Baseline Comparison
+# ---------------------
+
+def case_key(case: Dict) -> str:
+    return f"{case['engine']}/{case['shape']}/{case['size']}"
+
+def compare(results: Dict, baseline: Dict, threshold: float, min_seconds: float = 0.001) -> List[str]:
+    """
+    Return a description of every stage slower than baseline by more than threshold
+    (a fraction). Stages faster than min_seconds in both runs are treated as noise.
+    """
+    old_cases = {case_key(case): case for case in baseline.get("cases", [])}
+    regressions = []
+    for case in results["cases"]:
+        old = old_cases.get(case_key(case))
+        if old is None or "stages" not in old or "stages" not in case:
+            continue
+        for stage, seconds in case["stages"].items():
+            before = old["stages"].get(stage)
+            if before is None or max(before, seconds) < min_seconds:
+                continue
+            if seconds > before * (1 + threshold):
+                regressions.append(
+                    f"{case_key(case)} {stage}: {before * 1000:.2f}ms -> {seconds * 1000:.2f}ms "
+                    f"(+{(seconds / before - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+# ---------------------
+# Runner
+# ---------------------
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark each stage of process_code on synthetic programs.")
+    parser.add_argument("-o", "--output", default="bench.json", help="where to write the JSON results")
+    parser.add_argument("--engines", nargs="+", choices=sorted(ENGINES), default=sorted(ENGINES))
+    parser.add_argument("--shapes", nargs="+", choices=sorted(SHAPES), default=list(SHAPES))
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100, 1000, 3000])
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case; the median is kept")
+    parser.add_argument("--baseline", help="previous results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown as a fraction (default 0.2)")
+    args = parser.parse_args(argv)
+
+    cases = []
+    for engine, shape, size in iter_cases(args.engines, args.shapes, args.sizes):
+        case = bench_case(engine, shape, size, args.repeat)
+        cases.append(case)
+        summary = case.get("error") or f"{case['total'] * 1000:.2f}ms ({case['nodes']} nodes, {case['edges']} edges)"
+        if "bytes" in case:
+            summary += "".join(
+                f"\n    {name:<13} {size:>10} bytes {case['stages'][name] * 1000:8.2f}ms"
+                for name, size in case["bytes"].items()
+            )
+        if "reuse" in case:
+            summary += "".join(
+                f"\n    {name:<20} {seconds * 1000:8.2f}ms" for name, seconds in case["stages"].items()
+            )
+        if "crossings" in case:
+            summary += "".join(
+                f"\n    {name:<20} {seconds * 1000:8.2f}ms  {'-' if case['crossings'][name] is None else case['crossings'][name]:>10} crossings"
+                for name, seconds in case["stages"].items()
+            )
+        if "peak_bytes" in case:
+            summary += "".join(
+                f"\n    {name:<20} {seconds * 1000:8.2f}ms  peak {case['peak_bytes'][name]:>12,} bytes"
+                for name, seconds in case["stages"].items()
+            )
+        if "sweeps" in case:
+            summary += "".join(
+                f"\n    {name:<20} {seconds * 1000:8.2f}ms  moved {case['displacement'][name]:7.1f}"
+                + (f"  {case['sweeps'][name.split('/')[1]]} sweeps" if name.startswith("stable/") else "")
+                for name, seconds in case["stages"].items()
+            )
+        print(f"{case_key(case):<32} {summary}", file=sys.stderr)
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "repeat": args.repeat,
+        "cases": cases,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.threshold * 100:.0f}%", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""
+Send bursts of identical POST /analyze requests to a running server, the way a class
+pastes the same projected program at once, and report how much analysis CPU each
+burst cost the server.
+
+Every burst uses a fresh random program so it misses the result cache, and all clients of
+a burst are released together. With coalescing on, the server runs one analysis per burst
+however many clients send it, so CPU per burst stays flat as --clients grows; start the
+server with DEPGRAPH_COALESCE=0 to compare.
+
+    python burst_client.py --clients 1 10 50 --bursts 5 --size 500
+
+CPU and analysis counts are read from the server's /metrics counters
+(depgraph_analysis_cpu_seconds_total and depgraph_analyses_total) before and after each
+burst, so the server should not be serving other traffic meanwhile.
+"""
+import argparse
+import http.client
+import json
+import random
+import re
+import statistics
+import sys
+import threading
+import time
+from typing import Dict, List
+from urllib.parse import urlsplit
+
+from bench import random_program
+
+_SAMPLE = re.compile(r'^(depgraph_analyses_total|depgraph_analysis_cpu_seconds_total)\{\w+="(\w+)"\} (\S+)$')
+
+# ---------------------
+# Server Counters
+# ---------------------
+
+def scrape(url: str) -> Dict[str, float]:
+    """Analysis counters from /metrics: "computed", "coalesced" and "cpu" (summed over runners)."""
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+    conn.request("GET", "/metrics")
+    text = conn.getresponse().read().decode("utf-8")
+    conn.close()
+    counters = {"computed": 0.0, "coalesced": 0.0, "cpu": 0.0}
+    for line in text.splitlines():
+        match = _SAMPLE.match(line)
+        if match is None:
+            continue
+        name, label, value = match.groups()
+        key = "cpu" if name == "depgraph_analysis_cpu_seconds_total" else label
+        counters[key] = counters.get(key, 0.0) + float(value)
+    return counters
+
+# ---------------------
+# Bursts
+# ---------------------
+
+def burst(url: str, code: str, clients: int) -> Dict:
+    """Send code from clients threads released at the same instant; return latencies and errors."""
+    parts = urlsplit(url)
+    body = json.dumps({"Original": code})
+    gate = threading.Barrier(clients)
+    latencies: List[float] = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def client() -> None:
+        conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+        conn.connect()
+        gate.wait()
+        start = time.perf_counter()
+        try:
+            conn.request("POST", "/analyze", body, {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            response.read()
+            failed = response.status != 200
+        except (OSError, http.client.HTTPException):
+            failed = True
+        elapsed = time.perf_counter() - start
+        conn.close()
+        with lock:
+            latencies.append(elapsed)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {"latencies": latencies, "errors": errors[0]}
+
+def run(url: str, clients: int, bursts: int, size: int, seed: int) -> Dict:
+    """Run bursts at one concurrency level and total the server-side counters across them."""
+    totals = {"computed": 0.0, "coalesced": 0.0, "cpu": 0.0, "errors": 0}
+    latencies: List[float] = []
+    for i in range(bursts):
+        code = random_program(size, seed + i)
+        before = scrape(url)
+        result = burst(url, code, clients)
+        after = scrape(url)
+        for key in ("computed", "coalesced", "cpu"):
+            totals[key] += after[key] - before[key]
+        totals["errors"] += result["errors"]
+        latencies.extend(result["latencies"])
+    totals["latencies"] = latencies
+    return totals
+
+def summarize(clients: int, bursts: int, totals: Dict) -> str:
+    latencies = totals["latencies"]
+    return (f"{clients:>4} clients  computed {totals['computed']:>5.0f}  coalesced {totals['coalesced']:>6.0f}  "
+            f"cpu/burst {totals['cpu'] / bursts * 1000:8.1f}ms  median {statistics.median(latencies) * 1000:8.1f}ms  "
+            f"max {max(latencies) * 1000:8.1f}ms  errors {totals['errors']}")
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Measure server CPU under bursts of identical /analyze requests.")
+    parser.add_argument("--url", default="http://127.0.0.1:5001", help="server base URL")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 50],
+                        help="concurrent identical requests per burst; one run per value")
+    parser.add_argument("--bursts", type=int, default=5, help="bursts per run, each with a new program")
+    parser.add_argument("--size", type=int, default=500, help="variables in each random program")
+    parser.add_argument("--seed", type=int, help="first program seed (default: random, so the cache is cold)")
+    args = parser.parse_args(argv)
+
+    seed = args.seed if args.seed is not None else random.randrange(1 << 30)
+    print(f"{args.bursts} bursts of a {args.size}-variable program per run", file=sys.stderr)
+    for run_index, clients in enumerate(args.clients):
+        totals = run(args.url, clients, args.bursts, args.size, seed + run_index * args.bursts)
+        print(summarize(clients, args.bursts, totals))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import ast
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Bump whenever process_code output changes so persisted entries are not reused
+CACHE_VERSION = "6"
+
+# ---------------------
+# Cache Keys
+# ---------------------
+
+def code_fingerprint(code: str, settings: str = "") -> str:
+    """
+    Return a content hash of the program's normalized AST and of settings, the options
+    the result depends on besides the code (see pool.LAYOUT_SETTINGS).
+    ast.dump omits line/column attributes and comments never reach the tree,
+    so whitespace and comment edits map to the same key.
+    Raises SyntaxError for code that does not parse.
+    """
+    normalized = ast.dump(ast.parse(code))
+    return hashlib.sha256((CACHE_VERSION + ":" + settings + ":" + normalized).encode("utf-8")).hexdigest()
+
+# ---------------------
+# Result Cache
+# ---------------------
+
+class ResultCache:
+    """
+    Bounded LRU cache of serialized analysis results, keyed by code_fingerprint.
+    The budget counts the bytes of keys and values. When a path is given, entries are
+    mirrored to a local SQLite file and reloaded so a restarted server starts warm. The file
+    is opened on first use, not on construction: pool workers import the server's main
+    module again, and must not each open the file and load the cache. Writes to the file
+    are queued under the cache lock and committed outside it, several at a time when
+    requests finish together, so lookups never wait on the disk.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, path: Optional[str] = None) -> None:
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._path = path
+        self._db = None
+        self._pending: List[Tuple[str, Optional[bytes]]] = []    # Writes not yet in the file, in order; None deletes
+        self._db_lock = threading.Lock()
+
+    def _open(self) -> None:
+        """Open the SQLite file and load it, the first time the cache is used. Called with the lock held."""
+        if not self._path:
+            return
+        path, self._path = self._path, None
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB)")
+        self._db.commit()
+        self._load()
+
+    def _load(self) -> None:
+        """Fill the in-memory cache from disk, most recently stored entries first."""
+        stale = []
+        for key, value in self._db.execute("SELECT key, value FROM results ORDER BY rowid DESC"):
+            size = len(key) + len(value)
+            if self.current_bytes + size > self.max_bytes:
+                stale.append((key,))
+                continue
+            self._entries[key] = value
+            self._entries.move_to_end(key, last=False)
+            self.current_bytes += size
+        if stale:
+            self._db.executemany("DELETE FROM results WHERE key = ?", stale)
+            self._db.commit()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            self._open()
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: bytes) -> None:
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._open()
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= len(key) + len(old)
+            self._entries[key] = value
+            self.current_bytes += size
+
+            evicted = []
+            while self.current_bytes > self.max_bytes:
+                old_key, old_value = self._entries.popitem(last=False)
+                self.current_bytes -= len(old_key) + len(old_value)
+                self.evictions += 1
+                evicted.append(old_key)
+
+            if self._db is None:
+                return
+            self._pending.append((key, value))
+            self._pending.extend((old_key, None) for old_key in evicted)
+        self._flush()
+
+    def _flush(self) -> None:
+        """Write every queued change to the file in one commit (none if another writer already took them)."""
+        with self._db_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            for key, value in pending:
+                if value is None:
+                    self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                else:
+                    self._db.execute("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)", (key, value))
+            self._db.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            self._open()
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+# ---------------------
+# Request Coalescing
+# ---------------------
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+class SingleFlight:
+    """
+    Run at most one computation per key at a time. Callers that arrive for a key while its
+    computation is in flight wait for it and share its result, or its exception, instead
+    of computing again. Nothing is kept once a computation finishes; pair it with a
+    ResultCache filled inside the computation so later callers hit the cache.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, compute: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Return compute()'s result for key and whether it was shared from another caller."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = compute()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
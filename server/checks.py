@@ -0,0 +1,232 @@
+"""
+Equivalence checks for the rewritten stages of depgraph2, run on generated programs.
+
+Several stages were rewritten for speed on the promise that their output does not change.
+Each check below holds one of those promises against a straightforward implementation on
+random programs, so a later change that breaks it shows up here:
+
+  - order: generate_order against reference_order, the original generate_order, which
+    scans the node and edge lists of the /analyze payload.
+  - incremental: IncrementalAnalyzer.update against process_code after every step of
+    random edit sequences, errors included. Run it with a low DEPGRAPH_SUGIYAMA_THRESHOLD
+    as well to cover the edits that switch layout engines.
+
+    python checks.py
+    python checks.py order --programs 2000 --seed 7
+    DEPGRAPH_SUGIYAMA_THRESHOLD=20 python checks.py incremental
+
+On a mismatch the first failing program is printed and the exit status is 1.
+"""
+import argparse
+import random
+import sys
+from typing import Callable, Dict, List
+
+from depgraph2 import BLOCKED_COLOR, TARGET_COLOR, output_colors, process_code
+from incremental import IncrementalAnalyzer
+
+# ---------------------
+# Generated Programs
+# ---------------------
+
+def random_program(rng: random.Random, size: int, max_deps: int = 3, cycles: bool = False) -> str:
+    """
+    size assignments, each reading up to max_deps earlier variables (any variables if
+    cycles is set), with inputs, and the variables no one reads summed into a few outputs.
+    """
+    names = [f"v{i}" for i in range(size)]
+    lines = []
+    read = set()
+    for i, name in enumerate(names):
+        candidates = names if cycles else names[:i]
+        deps = rng.sample(candidates, rng.randint(0, min(max_deps, len(candidates))))
+        read.update(deps)
+        if deps:
+            lines.append(f"{name} = " + " + ".join(deps))
+        else:
+            lines.append(f"{name} = float(input())" if rng.random() < 0.5 else f"{name} = {i}")
+    unread = [name for name in names if name not in read]
+    outputs = rng.randint(1, 6)
+    for j in range(outputs):
+        group = unread[j::outputs]
+        if group:
+            lines.append(f"out{j} = " + " + ".join(group))
+    return "\n".join(lines)
+
+# ---------------------
+# Order
+# ---------------------
+
+def reference_order(nodes: List[Dict], edges: List[Dict], colors: List[str]) -> List[List[str]]:
+    """
+    The original generate_order, over the /analyze node and edge dictionaries: a reverse BFS
+    from each output, left to right, that rescans the lists for every lookup.
+    """
+    output_nodes = []
+    input_node_ids = set()
+    seen = set()
+    blocked_edge_ids = set()    # Stop when a black edge is reached, don't recolor target
+    order = []
+
+    for node in nodes:
+        if node["mytype"] == "customoutput":
+            output_nodes.append(node)
+        elif node["mytype"] == "custominput":
+            input_node_ids.add(node["id"])
+    output_nodes.sort(key=lambda x: x["position"]["x"])
+
+    def target_found(node):
+        trace([node], TARGET_COLOR)
+        for edge in edges:
+            if edge["source"] == node["id"]:
+                blocked_edge_ids.add(edge["id"])
+                order.append([edge["id"], BLOCKED_COLOR])
+
+    def trace(start_nodes, color):
+        cur_node_ids = set()
+        while start_nodes:
+            next_edges = []
+            for node in start_nodes:
+                if color != TARGET_COLOR and node["id"] in seen:
+                    target_found(node)
+                else:
+                    order.append([node["id"], color])
+                    seen.add(node["id"])
+                    next_edges.append([edge for edge in edges
+                                       if edge["target"] == node["id"] and edge["id"] not in blocked_edge_ids])
+
+            next_nodes = []
+            for edge_group in next_edges:
+                for edge in edge_group:
+                    for node in nodes:
+                        if node["id"] == edge["source"] and node["id"] not in cur_node_ids:
+                            next_nodes.append(node)
+                            cur_node_ids.add(node["id"])
+            next_nodes.sort(key=lambda x: x["position"]["x"])
+
+            for edge_group in next_edges:
+                if len(edge_group) == 1:
+                    order.append([edge_group[0]["id"], color])
+                else:
+                    for node in next_nodes:
+                        for edge in edge_group:
+                            if edge["source"] == node["id"]:
+                                order.append([edge["id"], color])
+            start_nodes = [node for node in next_nodes if node["id"] not in input_node_ids]
+
+    for node, color in zip(output_nodes, colors):
+        trace([node], color)
+    return order
+
+def check_order(rng: random.Random, programs: int) -> bool:
+    """process_code's order against reference_order on the same layout."""
+    for i in range(programs):
+        code = random_program(rng, rng.randint(1, 60), cycles=i % 4 == 3)
+        result = process_code(code)
+        colors = output_colors(result["stats"]["outputs"])
+        if result["order"] != reference_order(result["positioned_nodes"], result["edges"], colors):
+            print(f"order: mismatch on program {i}:\n{code}")
+            return False
+    print(f"order: {programs} programs match")
+    return True
+
+# ---------------------
+# Incremental Analysis
+# ---------------------
+
+EDITS_PER_PROGRAM = 15
+
+def _target(block: List[str]) -> str:
+    """The variable a single-line assignment block sets, or "" for any other block."""
+    return block[0].split(" = ")[0] if len(block) == 1 and " = " in block[0] else ""
+
+def edit_program(rng: random.Random, blocks: List[List[str]]) -> None:
+    """
+    Apply one random edit to a program held as top-level statements, each a list of lines:
+    rewrite, insert or delete an assignment, or insert the statements that make splitting
+    the source hard (compound statements, definitions, multi-line strings and brackets,
+    comments, syntax errors).
+    """
+    at = rng.randrange(len(blocks) + 1)
+    names = [name for name in map(_target, blocks[:at]) if name] or ["1"]
+    choice = rng.random()
+    if choice < 0.3 and blocks:
+        j = rng.randrange(len(blocks))
+        if _target(blocks[j]):
+            earlier = [name for name in map(_target, blocks[:j]) if name]
+            deps = rng.sample(earlier, min(len(earlier), rng.randint(0, 3)))
+            blocks[j] = [f"{_target(blocks[j])} = " + (" + ".join(deps) if deps else "1")]
+    elif choice < 0.45:
+        deps = rng.sample(names, min(len(names), rng.randint(1, 3)))
+        blocks.insert(at, [f"{rng.choice(['out0', 'out1', 'new0', 'new1'])} = " + " * ".join(deps)])
+    elif choice < 0.6 and blocks:
+        del blocks[rng.randrange(len(blocks))]
+    elif choice < 0.67:
+        blocks.insert(at, ["if cond:", f"    out0 = {rng.choice(names)}", "else:", f"    w0 = {rng.choice(names)}"])
+    elif choice < 0.7:
+        blocks.insert(at, ['s = """', "x = 1", '"""'])
+    elif choice < 0.73:
+        blocks.insert(at, [f"t = ({rng.choice(names)} +", "b)"])
+    elif choice < 0.78:
+        blocks.insert(at, [f"# note {rng.randrange(100)}"])
+    elif choice < 0.8:
+        blocks.insert(at, ["z = ("])
+    elif choice < 0.86 and blocks:
+        j = rng.randrange(len(blocks))
+        blocks[j] = blocks[j][:-1] + [blocks[j][-1] + "  # tail"]
+    elif choice < 0.93:
+        blocks.insert(at, ["def f(p):", f"    new1 = p + {rng.choice(names)}", "    return new1"])
+    elif choice < 0.96:
+        blocks.insert(at, ["@dec", "def g():", "    pass"])
+    else:
+        blocks.insert(at, ["try:", f"    out1 = {rng.choice(names)}", "except E:", "    out1 = 0", "finally:", "    pass"])
+    if rng.random() < 0.7:    # Syntax errors usually get fixed on the next edit
+        blocks[:] = [block for block in blocks if block != ["z = ("]]
+
+def _outcome(analyze: Callable[[str], Dict], code: str):
+    """The result of analyze(code), or the type of the error it raised."""
+    try:
+        return analyze(code)
+    except Exception as e:
+        return type(e).__name__
+
+def check_incremental(rng: random.Random, programs: int) -> bool:
+    """IncrementalAnalyzer.update against process_code after each of EDITS_PER_PROGRAM edits per program."""
+    for i in range(programs):
+        blocks = [[line] for line in random_program(rng, rng.randint(5, 60), cycles=i % 4 == 3).split("\n")]
+        analyzer = IncrementalAnalyzer()
+        for step in range(EDITS_PER_PROGRAM):
+            code = "\n".join(line for block in blocks for line in block)
+            if _outcome(analyzer.update, code) != _outcome(process_code, code):
+                print(f"incremental: mismatch on program {i}, edit {step}:\n{code}")
+                return False
+            edit_program(rng, blocks)
+    print(f"incremental: {programs * EDITS_PER_PROGRAM} edits over {programs} programs match")
+    return True
+
+# ---------------------
+# Command Line
+# ---------------------
+
+CHECKS: Dict[str, Callable[[random.Random, int], bool]] = {
+    "order": check_order,
+    "incremental": check_incremental,
+}
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Check rewritten stages against reference results on generated programs.")
+    parser.add_argument("checks", nargs="*", metavar="CHECK", help=f"checks to run: {', '.join(sorted(CHECKS))} (default: all)")
+    parser.add_argument("--programs", type=int, default=500, help="generated programs per check")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.checks if name not in CHECKS]
+    if unknown:
+        parser.error(f"unknown checks: {', '.join(unknown)}")
+
+    passed = True
+    for name in args.checks or sorted(CHECKS):
+        passed = CHECKS[name](random.Random(args.seed), args.programs) and passed
+    return 0 if passed else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
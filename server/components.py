@@ -0,0 +1,226 @@
+"""
+Analysis of a dependency graph one weakly connected component at a time.
+
+Programs often hold several independent computations. Laid out as one graph, an edit to any
+of them means laying out and ordering all of them again. Here each component is analyzed on
+its own, on its canonical graph (see structure.py), and cached by its structural
+fingerprint: after an edit only the component that changed is analyzed, and a structure
+that appears several times, in one program or across programs, is analyzed once.
+
+The components are then packed side by side, in the order their first variable appears in
+the program, and their orders are concatenated left to right. Outputs are colored left to
+right across the whole graph, as process_code does. Node ids, edges and stats are the same
+as process_code's; positions differ, since the rows of different components no longer
+interleave.
+
+When an executor is given and several components of at least PARALLEL_COMPONENT_NODES nodes
+miss the cache, they are analyzed on its worker processes. component_executor() gives none
+inside the production pool's workers, which may not start processes of their own: there,
+components are analyzed one after another, and the pool's parallelism is across requests.
+"""
+import multiprocessing
+import os
+import time
+from array import array
+from concurrent.futures import Executor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from depgraph2 import (
+    HORIZONTAL_SPACING, Budget, GraphIndex, generate_edges, generate_order, graph_stats, index_code,
+    layout_node_positions, materialize_nodes, materialize_order, output_colors,
+)
+from structure import StructureCache, _Structure, canonical_graph, structure_fingerprint
+
+# Cache misses this large are analyzed on worker processes when there are at least two of them.
+PARALLEL_COMPONENT_NODES = int(os.environ.get("DEPGRAPH_PARALLEL_COMPONENT_NODES", 1000))
+
+# ---------------------
+# Components
+# ---------------------
+
+def weak_components(index: GraphIndex) -> List[List[int]]:
+    """Weakly connected components, each a sorted list of node ids, ordered by their first node."""
+    n = len(index)
+    seen = bytearray(n)
+    components = []
+    for root in range(n):
+        if seen[root]:
+            continue
+        seen[root] = 1
+        nodes = [root]
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            neighbors = list(index.dependencies(node))
+            neighbors.extend(index.users[index.user_offsets[node]:index.user_offsets[node + 1]])
+            for other in neighbors:
+                if not seen[other]:
+                    seen[other] = 1
+                    nodes.append(other)
+                    stack.append(other)
+        nodes.sort()
+        components.append(nodes)
+    return components
+
+def component_graph(index: GraphIndex, nodes: List[int]) -> Dict[str, List[str]]:
+    """The subgraph of a component, every node listed in id order."""
+    names = index.names
+    return {names[node]: [names[dep] for dep in index.dependencies(node)] for node in nodes}
+
+def _signature(index: GraphIndex, nodes: List[int]) -> Tuple:
+    """The dependencies of a component by position in nodes; equal signatures mean the same labels."""
+    position = {node: i for i, node in enumerate(nodes)}
+    return tuple(tuple(position[dep] for dep in index.dependencies(node)) for node in nodes)
+
+# ---------------------
+# Component Analysis
+# ---------------------
+
+def analyze_component(graph: Dict[str, List[str]], budget: Optional[Budget] = None) -> _Structure:
+    """
+    Lay out and order a canonical component graph. Order steps carry the output's slot
+    (0, 1, ... left to right) in place of its color, so the result does not depend on
+    where the component ends up in the packed graph.
+    """
+    index = GraphIndex(graph)
+    x_positions = layout_node_positions(index, budget)
+    return _Structure(index, x_positions, generate_order(index, x_positions, budget, colors=range(len(index))))
+
+def _analyze_remote(graph: Dict[str, List[str]], budget: Optional[Budget]) -> Tuple[_Structure, List[str]]:
+    """analyze_component on a worker process; also returns the shortcuts taken there."""
+    if budget is not None:
+        budget.degraded = []
+    structure = analyze_component(graph, budget)
+    return structure, budget.degraded if budget is not None else []
+
+def component_executor() -> Optional[Executor]:
+    """The shared process pool for large components, or None where workers cannot be started."""
+    if multiprocessing.current_process().daemon:    # Pool workers may not have children
+        return None
+    from batch import get_executor
+    return get_executor()
+
+# ---------------------
+# Packing
+# ---------------------
+
+def _place(index: GraphIndex, nodes: List[int], labels: array, shared: _Structure, left: float,
+           x_positions: array, palette: List[str], first_slot: int, steps: List) -> float:
+    """
+    Copy a component's shared layout and order into the whole graph, starting at x = left;
+    its outputs take the colors from first_slot on. Returns the component's right edge.
+    """
+    canonical = shared.index
+    to_node = array('i', bytes(4 * len(nodes)))    # Canonical node -> node of the whole graph
+    for node, label in zip(nodes, labels):
+        to_node[label] = node
+    shift = left - min(shared.x_positions)
+    for label, node in enumerate(to_node):
+        x_positions[node] = shared.x_positions[label] + shift
+
+    # Canonical dependencies are sorted by label, so edges are matched by their endpoints
+    to_edge = array('i', bytes(4 * canonical.edge_count))
+    for label, node in enumerate(to_node):
+        edges = {index.deps[edge]: edge for edge in range(index.dep_offsets[node], index.dep_offsets[node + 1])}
+        for edge in range(canonical.dep_offsets[label], canonical.dep_offsets[label + 1]):
+            to_edge[edge] = edges[to_node[canonical.deps[edge]]]
+
+    for is_edge, item, color in shared.steps:
+        if isinstance(color, int):
+            color = palette[first_slot + color]
+        steps.append((is_edge, to_edge[item] if is_edge else to_node[item], color))
+    return max(shared.x_positions) + shift
+
+# ---------------------
+# Main Process Function
+# ---------------------
+
+def process_code_by_components(code: str, cache: StructureCache, timings: Optional[Dict[str, float]] = None,
+                               budget: Optional[Budget] = None, executor: Optional[Executor] = None,
+                               progress: Optional[Callable[[str], None]] = None) -> Dict:
+    """
+    Same keys as process_code, with the graph analyzed per weakly connected component
+    (see the module docstring) and the number of components added to 'stats'. Components
+    are looked up in and added to cache; results that took budget shortcuts are not cached.
+    Large components are analyzed on executor if one is given. progress is called as in
+    process_code.
+    """
+    report = progress if progress is not None else lambda stage: None
+    clock = time.perf_counter
+    graph, index = index_code(code, budget, timings, report)
+    indexed = clock()
+
+    components = []
+    misses: Dict[str, Tuple[GraphIndex, array]] = {}
+    shared: Dict[str, _Structure] = {}
+    written: Dict[Tuple, Tuple[str, array]] = {}    # Components written alike share their labels
+    node_sets = weak_components(index)
+    for nodes in node_sets:
+        signature = _signature(index, nodes)
+        if signature in written:
+            components.append((nodes,) + written[signature])
+            continue
+        component = index if len(node_sets) == 1 else GraphIndex(component_graph(index, nodes))
+        fingerprint, labels = written[signature] = structure_fingerprint(component)
+        components.append((nodes, fingerprint, labels))
+        if fingerprint in shared or fingerprint in misses:
+            continue
+        entry = cache.get(fingerprint)
+        if entry is None:
+            misses[fingerprint] = (component, labels)
+        else:
+            shared[fingerprint] = entry
+    split = clock()
+
+    remote = [fingerprint for fingerprint, (component, _) in misses.items()
+              if len(component) >= PARALLEL_COMPONENT_NODES] if executor is not None else []
+    futures = {
+        fingerprint: executor.submit(_analyze_remote, canonical_graph(*misses[fingerprint]), budget)
+        for fingerprint in remote
+    } if len(remote) > 1 else {}
+    for fingerprint, (component, labels) in misses.items():
+        if fingerprint in futures:
+            continue
+        degraded = len(budget.degraded) if budget is not None else 0
+        shared[fingerprint] = analyze_component(canonical_graph(component, labels), budget)
+        if budget is None or len(budget.degraded) == degraded:
+            cache.put(fingerprint, shared[fingerprint])
+    for fingerprint, future in futures.items():
+        shared[fingerprint], degraded = future.result()
+        if degraded:
+            budget.degraded.extend(degraded)
+        else:
+            cache.put(fingerprint, shared[fingerprint])
+    analyzed = clock()
+    report("layout")    # Each component is laid out and ordered in one go
+    report("order")
+
+    stats = graph_stats(index)
+    stats["components"] = len(components)
+    palette = output_colors(stats["outputs"])
+    x_positions = array('d', bytes(8 * len(index)))
+    steps: List = []
+    left, right, first_slot = 0.0, 0.0, 0
+    for nodes, fingerprint, labels in components:
+        right = _place(index, nodes, labels, shared[fingerprint], left, x_positions, palette, first_slot, steps)
+        left = right + HORIZONTAL_SPACING
+        first_slot += sum(1 for node in nodes if index.is_output(node))
+    for node in range(len(index)):    # Center the packed row on x = 0
+        x_positions[node] -= right / 2
+
+    result = {
+        "sterilized_graph": graph,
+        "positioned_nodes": materialize_nodes(index, x_positions),
+        "edges": generate_edges(index),
+        "order": materialize_order(index, steps),
+        "stats": stats,
+        "merged": index.merged,
+        "degraded": list(dict.fromkeys(budget.degraded)) if budget is not None else []    # Once per shortcut
+    }
+    if timings is not None:
+        timings.update({
+            "components": split - indexed,
+            "analyze": analyzed - split,
+            "materialize": clock() - analyzed,
+        })
+    return result
@@ -0,0 +1,202 @@
+"""
+Bulk dependency-graph extraction over a corpus of student programs.
+
+Reads either a directory tree of .py files or a JSONL file of {"id": ..., "code": ...}
+records, analyzes programs in parallel and appends one JSON result per line to the output.
+The output doubles as the progress record: rerunning with the same output file skips
+every id already written, so a crashed run resumes where it stopped.
+
+    python corpus.py submissions/ -o results.jsonl
+    python corpus.py archive.jsonl -o results.jsonl --workers 8
+
+With the depgraph2 engine every record also carries the "structure" fingerprint of its graph
+(see structure.py), and programs of the same structure share one layout and order within a
+worker, and is analyzed under the same DEPGRAPH_MAX_* limits as a request (see
+depgraph2.analysis_budget): a record over the syntax node limit is an error, and one whose
+layout or order was cut short lists it under "degraded". --clusters groups the ids in the
+output by structure, in one pass over it.
+
+    python corpus.py submissions/ -o results.jsonl --clusters clusters.json
+"""
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterator, List, Set, Tuple
+
+ENGINES = ("depgraph2", "depgraph")
+
+# ---------------------
+# Input Streams
+# ---------------------
+
+def iter_directory(root: str) -> Iterator[Tuple[str, str]]:
+    """Yield (relative path, source) for every .py file under root, in sorted order."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not filename.endswith(".py"):
+                continue
+            path = os.path.join(dirpath, filename)
+            with open(path, encoding="utf-8", errors="replace") as f:
+                yield os.path.relpath(path, root), f.read()
+
+def iter_jsonl(path: str, id_field: str, code_field: str) -> Iterator[Tuple[str, str]]:
+    """Yield (id, source) per JSONL record; records without an id use their line number."""
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield str(record.get(id_field, line_number)), record.get(code_field, "")
+
+def iter_programs(source: str, id_field: str = "id", code_field: str = "code") -> Iterator[Tuple[str, str]]:
+    if os.path.isdir(source):
+        return iter_directory(source)
+    return iter_jsonl(source, id_field, code_field)
+
+# ---------------------
+# Resume Support
+# ---------------------
+
+def completed_ids(output_path: str) -> Set[str]:
+    """
+    Collect the ids already present in the output file.
+    A partially written final line (from a crash mid-write) is truncated away.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    valid_end = 0
+    with open(output_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                done.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                break
+            valid_end += len(line)
+    if valid_end != os.path.getsize(output_path):
+        with open(output_path, "r+b") as f:
+            f.truncate(valid_end)
+    return done
+
+# ---------------------
+# Worker
+# ---------------------
+
+_structures = None    # StructureCache of this worker process, created on first use
+
+def analyze(engine: str, program_id: str, code: str) -> str:
+    """Analyze one program in a worker process and return its serialized output line."""
+    global _structures
+    record = {"id": program_id}
+    try:
+        if engine == "depgraph2":
+            from depgraph2 import analysis_budget
+            from structure import StructureCache, process_code_by_structure
+            if _structures is None:
+                _structures = StructureCache()
+            result = process_code_by_structure(code, _structures, budget=analysis_budget())
+        else:
+            result = importlib.import_module(engine).process_code(code)
+        record.update({
+            "nodes": result["positioned_nodes"],
+            "edges": result["edges"],
+            "order": result["order"]
+        })
+        if result.get("merged"):    # depgraph2 only
+            record["merged"] = result["merged"]
+        if "structure" in result:
+            record["structure"] = result["structure"]
+        if result.get("degraded"):
+            record["degraded"] = result["degraded"]
+    except Exception as e:
+        record["error"] = str(e)
+    return json.dumps(record, separators=(",", ":")) + "\n"
+
+# ---------------------
+# Clustering
+# ---------------------
+
+def cluster_results(output_path: str) -> List[Dict]:
+    """
+    Group the ids of an output file by structure fingerprint, in a single pass. Clusters are
+    listed largest first; records without a structure (errors, depgraph engine) are left out.
+    """
+    clusters: Dict[str, List[str]] = {}
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            structure = record.get("structure")
+            if structure is not None:
+                clusters.setdefault(structure, []).append(record["id"])
+    ordered = sorted(clusters.items(), key=lambda item: (-len(item[1]), item[0]))
+    return [{"structure": structure, "size": len(ids), "ids": ids} for structure, ids in ordered]
+
+# ---------------------
+# Runner
+# ---------------------
+
+def run(source: str, output_path: str, workers: int, engine: str = "depgraph2",
+        id_field: str = "id", code_field: str = "code", progress_every: int = 100) -> int:
+    """Process every not-yet-completed program and return how many were written."""
+    done = completed_ids(output_path)
+    if done:
+        print(f"Resuming: {len(done)} programs already in {output_path}", file=sys.stderr)
+
+    max_in_flight = 4 * workers    # Bound memory: only this many programs are held at once
+    written = skipped = 0
+    next_report = progress_every
+    start = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as out, ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+
+        def drain(block_until: int) -> None:
+            nonlocal pending, written, next_report
+            while len(pending) > block_until:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    out.write(future.result())
+                    written += 1
+                out.flush()
+                if written >= next_report:
+                    next_report += progress_every
+                    rate = written / (time.perf_counter() - start)
+                    print(f"{written} written, {skipped} skipped ({rate:.1f}/s)", file=sys.stderr)
+
+        for program_id, code in iter_programs(source, id_field, code_field):
+            if program_id in done:
+                skipped += 1
+                continue
+            done.add(program_id)
+            pending.add(executor.submit(analyze, engine, program_id, code))
+            drain(max_in_flight - 1)
+        drain(0)
+
+    print(f"Done: {written} written, {skipped} skipped", file=sys.stderr)
+    return written
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Extract dependency graphs for a corpus of Python programs.")
+    parser.add_argument("source", help="directory of .py files or a JSONL file of programs")
+    parser.add_argument("-o", "--output", required=True, help="JSONL file to append results to (also used to resume)")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1, help="worker processes (default: CPU count)")
+    parser.add_argument("--engine", choices=ENGINES, default="depgraph2", help="analysis module to use")
+    parser.add_argument("--id-field", default="id", help="JSONL field holding the submission id")
+    parser.add_argument("--code-field", default="code", help="JSONL field holding the source code")
+    parser.add_argument("--clusters", help="afterwards, write the ids grouped by graph structure to this JSON file")
+    args = parser.parse_args(argv)
+    run(args.source, args.output, args.workers, args.engine, args.id_field, args.code_field)
+    if args.clusters:
+        clusters = cluster_results(args.output)
+        with open(args.clusters, "w", encoding="utf-8") as f:
+            json.dump({"clusters": clusters}, f)
+        print(f"{len(clusters)} structures", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
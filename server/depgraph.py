@@ -224,6 +224,32 @@ def generate_edges(sterilized: Dict[str, List[str]], variable_to_node_id: Dict[s
     return edges
 
 
+def ancestor_bitsets(graph: Dict[str, List[str]], nodes: List[str]) -> Tuple[Dict[str, int], Dict[str, int]]:
+    """
+    Reachability index for the given nodes. Returns the bit of every node (its position in
+    the topological order) and, for each requested node, the bitset of the node itself and
+    all of its transitive dependencies.
+    Built in one pass over the topological order, dependencies first; the set of an
+    intermediate node is dropped once all of its users have been built from it.
+    """
+    order = topological_sort(graph)
+    bits = {node: 1 << position for position, node in enumerate(order)}
+    pending_users: Dict[str, int] = defaultdict(int)
+    for node in order:
+        for dep in graph.get(node, []):
+            pending_users[dep] += 1
+    keep = set(nodes)
+    sets: Dict[str, int] = {}
+    for node in order:
+        reach = bits[node]
+        for dep in graph.get(node, []):
+            reach |= sets[dep]
+            pending_users[dep] -= 1
+            if not pending_users[dep] and dep not in keep:
+                del sets[dep]
+        sets[node] = reach
+    return bits, {node: sets[node] for node in nodes}
+
 def generate_order(sterilized: Dict[str, List[str]], variable_to_node_id: Dict[str, str]) -> List[List[str]]:
     order_steps: List[List[str]] = []
     node_colors: Dict[str, str] = {}
@@ -231,6 +257,20 @@ def generate_order(sterilized: Dict[str, List[str]], variable_to_node_id: Dict[s
     edge_colors: Dict[str, str] = {}  # Track colors of all edges
     color_palette = ["#0000FF", "#FFFF00", "#00FF00", "#FFA500", "#800080"]
 
+    users: Dict[str, List[str]] = defaultdict(list)
+    for child, deps in sterilized.items():
+        for dep in deps:
+            users[dep].append(child)
+    output_nodes = [n for n in sterilized if n not in users]
+
+    # Only nodes reachable from two or more outputs can be reached again by a later branch
+    # (a "target"); find them by intersecting the outputs' ancestor sets.
+    bits, ancestors = ancestor_bitsets(sterilized, output_nodes)
+    shared = reached = 0
+    for out_node in output_nodes:
+        shared |= reached & ancestors[out_node]
+        reached |= ancestors[out_node]
+
     def get_edge_id(source: str, target: str) -> str:
         s_id = variable_to_node_id[source]
         t_id = variable_to_node_id[target]
@@ -241,13 +281,26 @@ def generate_order(sterilized: Dict[str, List[str]], variable_to_node_id: Dict[s
         if item_id.startswith("edge"):
             edge_colors[item_id] = color
 
-    def trace_branch(start_node: str, color: str):
-        queue = deque([(start_node, None, True)])  # (current_node, incoming_edge, all_edges_current_color)
-        visited = set()
+    # Branches being traced, innermost last: (start node, queue, visited, color). A target
+    # found while tracing a branch pushes the red trace of its ancestors, which runs to
+    # completion before the branch resumes.
+    branches = []
+
+    def start_branch(start_node: str, color: str):
+        branches.append((start_node, deque([(start_node, None, True)]), set(), color))  # (current_node, incoming_edge, all_edges_current_color)
+
+    for idx, out_node in enumerate(output_nodes):
+        if out_node in node_colors:
+            continue
+        start_branch(out_node, color_palette[idx % len(color_palette)])
 
-        while queue:
+        while branches:
+            start_node, queue, visited, color = branches[-1]
+            if not queue:
+                branches.pop()
+                continue
             current_node, incoming_edge, all_edges_current = queue.popleft()
-            
+
             # Process edge first if exists
             if incoming_edge is not None:
                 if incoming_edge not in pruned_edges:
@@ -261,13 +314,15 @@ def generate_order(sterilized: Dict[str, List[str]], variable_to_node_id: Dict[s
                 else:
                     if edge_colors.get(incoming_edge) != color:
                         all_edges_current = False
-            
+
             # Skip if already processed (except for target nodes)
             if current_node in visited and node_colors.get(current_node) != "#FF0000":
                 continue
-            
+
             # Process node coloring
             if color == "#FF0000":
+                if node_colors.get(current_node) == "#FF0000" and current_node != start_node:
+                    continue    # A red trace has already colored its ancestors and pruned their edges
                 if current_node not in node_colors or node_colors.get(current_node) != "#FF0000":
                     record(variable_to_node_id[current_node], "#FF0000")
                     node_colors[current_node] = "#FF0000"
@@ -281,19 +336,18 @@ def generate_order(sterilized: Dict[str, List[str]], variable_to_node_id: Dict[s
                     else:
                         record(variable_to_node_id[current_node], color)
                         node_colors[current_node] = color
-                elif node_colors[current_node] != "#FF0000":
+                elif node_colors[current_node] != "#FF0000" and shared & bits[current_node]:
                     if sterilized.get(current_node):
                         record(variable_to_node_id[current_node], "#FF0000")
                         node_colors[current_node] = "#FF0000"
-                        
-                        for child in sterilized:
-                            if current_node in sterilized[child]:
-                                edge_id = get_edge_id(current_node, child)
-                                if edge_id not in pruned_edges:
-                                    record(edge_id, "#000000")
-                                    pruned_edges.add(edge_id)
-                        
-                        trace_branch(current_node, "#FF0000")
+
+                        for child in users[current_node]:
+                            edge_id = get_edge_id(current_node, child)
+                            if edge_id not in pruned_edges:
+                                record(edge_id, "#000000")
+                                pruned_edges.add(edge_id)
+
+                        start_branch(current_node, "#FF0000")
                         continue
 
             visited.add(current_node)
@@ -312,13 +366,6 @@ def generate_order(sterilized: Dict[str, List[str]], variable_to_node_id: Dict[s
                             parent_all_edges_current = False
                     queue.append((parent, edge_id, parent_all_edges_current))
 
-    used_as_dependency = set().union(*sterilized.values()) if sterilized else set()
-    output_nodes = [n for n in sterilized if n not in used_as_dependency]
-    
-    for idx, out_node in enumerate(output_nodes):
-        if out_node not in node_colors:
-            trace_branch(out_node, color_palette[idx % len(color_palette)])
-
     return order_steps
 
 # ---------------------
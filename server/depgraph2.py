@@ -1,323 +1,1081 @@
 import json
 import ast
-import random
-from collections import defaultdict, deque
-from typing import Dict, List, Tuple, Set
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, defaultdict
+from typing import Callable, Dict, FrozenSet, Iterator, List, Optional, Sequence, Tuple, Set
 
 SELECTED_PROGRAM = "Original"
 BUILTINS = {'input', 'float', 'int', 'print', 'round', 'math'}
+HORIZONTAL_SPACING = 150.0
+VERTICAL_SPACING = 150.0
 
 # ---------------------
-# AST Visitors
+# Graph Extraction
 # ---------------------
 
-class DependencyCollector(ast.NodeVisitor):
-    def __init__(self) -> None:
-        self.dependencies: Set[str] = set()
-    
-    def visit_Name(self, node: ast.AST) -> None:
-        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and node.id not in BUILTINS:
-            self.dependencies.add(node.id)
+_COMPREHENSIONS = (ast.ListComp, ast.SetComp, ast.GeneratorExp, ast.DictComp)
+_FUNCTIONS = (ast.FunctionDef, ast.AsyncFunctionDef)
+_SEQUENCES = (ast.Tuple, ast.List)
+
+class _Scope:
+    """
+    A function or class body. Names it binds are qualified with the scope path ("f.x",
+    "Point.__init__.self"); global and nonlocal declarations are recorded in declared.
+    """
+    __slots__ = ("parent", "name", "prefix", "is_class", "bound", "declared")
+
+    def __init__(self, parent: Optional["_Scope"], name: str, is_class: bool) -> None:
+        self.parent = parent
+        self.name = name
+        self.prefix = (parent.prefix if parent is not None else "") + name + "."
+        self.is_class = is_class
+        self.bound: Set[str] = set()
+        self.declared: Dict[str, bool] = {}    # True for global, False for nonlocal
+
+    def bind(self, name: str) -> None:
+        if name not in self.declared:
+            self.bound.add(name)
+
+    def resolve(self, name: str) -> str:
+        """Graph name of a variable used in this scope, by Python's scoping rules."""
+        scope = self
+        while scope is not None:
+            declared = scope.declared.get(name)
+            if declared:
+                return name
+            # Class bodies are not visible from the functions defined inside them
+            if declared is None and name in scope.bound and (scope is self or not scope.is_class):
+                return scope.prefix + name
+            scope = scope.parent
+        return name
+
+def _resolve(scope: Optional[_Scope], name: str) -> str:
+    return name if scope is None else scope.resolve(name)
+
+class _Restore:
+    """Stack marker that restores the names bound by enclosing lambdas and comprehensions."""
+    __slots__ = ("bound",)
+
+    def __init__(self, bound: FrozenSet[str]) -> None:
+        self.bound = bound
+
+def _stored_names(target: ast.AST) -> List[str]:
+    names = []
+    stack = [target]
+    while stack:
+        node = stack.pop()
+        if type(node) is ast.Name:
+            names.append(node.id)
+        elif type(node) is ast.Starred:
+            stack.append(node.value)
+        elif isinstance(node, _SEQUENCES):
+            stack.extend(reversed(node.elts))
+    return names
+
+def _parameters(args: ast.arguments) -> List[str]:
+    names = [arg.arg for arg in args.posonlyargs + args.args + args.kwonlyargs]
+    names.extend(arg.arg for arg in (args.vararg, args.kwarg) if arg is not None)
+    return names
+
+_CHILD_FIELDS: Dict[type, Tuple[str, ...]] = {}    # Expression fields to walk, per node class, last first
+_SCAN_LIMIT = 8
+
+class GraphExtractor:
+    """
+    Builds the dependency graph in one pass over the syntax tree, with explicit stacks
+    instead of visitor dispatch. Each assignment's (target, dependency) pairs go straight
+    into the dependency lists of graph, without duplicates; dependencies keep the order in
+    which they first appear.
+
+    Assignments covered: plain (a = b = value), augmented (a += value, which also
+    depends on a), annotated with a value, tuple and list unpacking (paired element-wise
+    when both sides have the same shape, otherwise every name gets every dependency),
+    for targets (depend on the iterable) and with ... as targets. Names bound by lambdas
+    and comprehensions are not dependencies.
+
+    Variables of a function or class body are qualified with its name ("f.total"), and
+    a function depends on the values it returns. Free variables and global declarations
+    resolve to the enclosing or module-level names. Attribute and subscript targets are
+    not variables and are skipped.
+    """
 
-class AssignmentVisitor(ast.NodeVisitor):
     def __init__(self) -> None:
-        self.graph: Dict[str, Set[str]] = defaultdict(set)
-    
-    def visit_Assign(self, node: ast.AST) -> None:
-        collector = DependencyCollector()
-        collector.visit(node.value)
-        for target in node.targets:
-            if isinstance(target, ast.Name):
-                self.graph[target.id].update(collector.dependencies)
+        self.graph: Dict[str, List[str]] = {}
+        self._wide: Dict[str, Set[str]] = {}    # Dependency sets of targets with many dependencies
+        self._pending: Optional[List[Tuple]] = None    # Records inside the current top-level def or class
+
+    def record(self, target: str, dependencies: List[str]) -> None:
+        """Merge one assignment's dependencies into the graph (hook for statement-level consumers)."""
+        deps = self.graph.get(target)
+        if deps is None:
+            deps = self.graph[target] = []
+        wide = self._wide.get(target)
+        for dep in dependencies:
+            if wide is not None:
+                if dep in wide:
+                    continue
+                wide.add(dep)
+            elif dep in deps:    # Short lists are cheaper to scan than to mirror in a set
+                continue
+            deps.append(dep)
+            if wide is None and len(deps) > _SCAN_LIMIT:
+                wide = self._wide[target] = set(deps)
+
+    def extract(self, tree: ast.AST) -> Dict[str, List[str]]:
+        """Walk a module and return its graph (also kept in self.graph)."""
+        stack: List[Tuple[object, Optional[_Scope]]] = [(stmt, None) for stmt in reversed(tree.body)]
+        while stack:
+            node, scope = stack.pop()
+            cls = type(node)
+            if cls is ast.Assign:
+                if len(node.targets) == 1:
+                    self._assign(node.targets[0], node.value, None, scope)
+                else:
+                    deps = self._loads(node.value)
+                    for target in node.targets:
+                        self._assign(target, None, deps, scope)
+            elif cls is ast.AugAssign:
+                if type(node.target) is ast.Name:
+                    name = node.target.id
+                    if scope is not None:
+                        scope.bind(name)
+                    self._emit(scope, name, scope, [name] + self._loads(node.value))
+            elif cls is ast.AnnAssign:
+                if node.value is not None:
+                    self._assign(node.target, node.value, None, scope)
+                elif scope is not None and type(node.target) is ast.Name:
+                    scope.bind(node.target.id)
+            elif cls is _Scope:    # End of a def or class body
+                if scope is None:
+                    pending, self._pending = self._pending, None
+                    for target_scope, target, dep_scope, deps in pending:
+                        self.record(_resolve(target_scope, target), [_resolve(dep_scope, dep) for dep in deps])
+            elif cls in _FUNCTIONS or cls is ast.ClassDef:
+                if scope is None:
+                    self._pending = []
+                else:
+                    scope.bind(node.name)
+                body_scope = _Scope(scope, node.name, cls is ast.ClassDef)
+                if cls is not ast.ClassDef:
+                    for name in _parameters(node.args):
+                        body_scope.bind(name)
+                stack.append((body_scope, scope))
+                stack.extend((stmt, body_scope) for stmt in reversed(node.body))
+            elif cls is ast.Return:
+                if node.value is not None and scope is not None and not scope.is_class:
+                    self._emit(scope.parent, scope.name, scope, self._loads(node.value))
+            elif cls is ast.Global or cls is ast.Nonlocal:
+                if scope is not None:
+                    for name in node.names:
+                        scope.declared[name] = cls is ast.Global
+            elif cls is ast.Import or cls is ast.ImportFrom:
+                if scope is not None:
+                    for alias in node.names:
+                        scope.bind(alias.asname or alias.name.split(".")[0])
+            else:
+                if cls is ast.For or cls is ast.AsyncFor:
+                    self._assign(node.target, None, self._loads(node.iter), scope)
+                elif cls is ast.With or cls is ast.AsyncWith:
+                    for item in node.items:
+                        if item.optional_vars is not None:
+                            self._assign(item.optional_vars, None, self._loads(item.context_expr), scope)
+                # Nested statement blocks: bodies, else branches, except handlers, match cases
+                for field in reversed(node._fields):
+                    value = getattr(node, field, None)
+                    if type(value) is list:
+                        for item in reversed(value):
+                            if isinstance(item, ast.stmt):
+                                stack.append((item, scope))
+                            elif isinstance(item, (ast.excepthandler, ast.match_case)):
+                                stack.extend((stmt, scope) for stmt in reversed(item.body))
+        return self.graph
+
+    def _emit(self, target_scope: Optional[_Scope], target: str, dep_scope: Optional[_Scope], deps: List[str]) -> None:
+        if self._pending is None:
+            self.record(target, deps)
+        else:    # Names are resolved once every enclosing scope has seen all its bindings
+            self._pending.append((target_scope, target, dep_scope, deps))
+
+    def _assign(self, target: ast.AST, value: Optional[ast.AST], deps: Optional[List[str]],
+                scope: Optional[_Scope]) -> None:
+        """Record the names in an assignment target, from value or from precomputed deps."""
+        work = [(target, value, deps)]
+        while work:
+            target, value, deps = work.pop()
+            cls = type(target)
+            if cls is ast.Name:
+                if scope is not None:
+                    scope.bind(target.id)
+                self._emit(scope, target.id, scope, deps if deps is not None else self._loads(value))
+            elif cls is ast.Starred:
+                work.append((target.value, value, deps))
+            elif cls in _SEQUENCES:
+                if (deps is None and type(value) in _SEQUENCES and len(value.elts) == len(target.elts)
+                        and not any(type(elt) is ast.Starred for elt in target.elts + value.elts)):
+                    work.extend((elt, item, None) for elt, item in zip(reversed(target.elts), reversed(value.elts)))
+                else:
+                    if deps is None:
+                        deps = self._loads(value)
+                    work.extend((elt, None, deps) for elt in reversed(target.elts))
+
+    def _loads(self, expr: ast.AST) -> List[str]:
+        """Variables read by an expression, in source order (builtins excluded)."""
+        deps = []
+        bound: FrozenSet[str] = frozenset()
+        stack = [expr]
+        while stack:
+            node = stack.pop()
+            cls = type(node)
+            if cls is ast.Name:
+                name = node.id
+                if type(node.ctx) is ast.Load and name not in BUILTINS and name not in bound:
+                    deps.append(name)
+            elif cls is ast.Constant or node is None:
+                continue
+            elif cls is _Restore:
+                bound = node.bound
+            elif cls is ast.Lambda:
+                args = node.args
+                stack.extend(reversed([d for d in args.defaults + args.kw_defaults if d is not None]))
+                stack.append(_Restore(bound))
+                bound = bound.union(_parameters(args))
+                stack.append(node.body)
+            elif cls in _COMPREHENSIONS:
+                generators = node.generators
+                stack.append(generators[0].iter)    # Evaluated in the enclosing scope
+                stack.append(_Restore(bound))
+                bound = bound.union(name for gen in generators for name in _stored_names(gen.target))
+                for gen in reversed(generators):
+                    stack.extend(reversed(gen.ifs))
+                    if gen is not generators[0]:
+                        stack.append(gen.iter)
+                stack.extend((node.value, node.key) if cls is ast.DictComp else (node.elt,))
+            else:
+                fields = _CHILD_FIELDS.get(cls)
+                if fields is None:
+                    fields = _CHILD_FIELDS[cls] = tuple(
+                        field for field in reversed(cls._fields) if field not in ("ctx", "op", "ops")
+                    )
+                for field in fields:
+                    value = getattr(node, field, None)
+                    if type(value) is list:
+                        stack.extend(reversed(value))
+                    elif isinstance(value, ast.AST):
+                        stack.append(value)
+        return deps
 
 # ---------------------
-# Graph Utility Functions
+# Graph Index
 # ---------------------
 
-def topological_sort(graph: Dict[str, List[str]]) -> List[str]:
-    """Return a topologically sorted list of nodes from the dependency graph."""
-    visited = set()
-    order = []
-    stack = []
-    visiting = set()
-    for node in graph:
-        if node not in visited:
-            stack.append((node, False))
-            while stack:
-                current, processed = stack.pop()
-                if processed:
-                    order.append(current)
-                    visited.add(current)
-                    visiting.remove(current)
-                    continue
-                if current in visiting:
-                    raise ValueError("Cycle detected in dependency graph")
-                if current in visited:
+class GraphIndex:
+    """
+    Integer-indexed form of a dependency graph, built once per request and shared by
+    the layout, edge and order stages.
+
+    Variables are interned to ids 0..n-1, graph keys first (in graph order) followed by
+    dependency-only variables in order of first appearance. Adjacency is stored CSR-style:
+      - the dependencies of node i are deps[dep_offsets[i]:dep_offsets[i + 1]];
+        the position of a dependency in that buffer is also its edge index,
+      - the users of node i are users[user_offsets[i]:user_offsets[i + 1]], with the
+        matching edge indexes in user_edges.
+    The topological order and the depth of every node are computed once on construction.
+
+    Cycles never reach the stages: a variable that depends on itself (total = total + x)
+    loses that edge, and the variables of each larger cycle are merged into a single node
+    named after all of them. The merged groups are listed in `merged`.
+    """
+
+    def __init__(self, graph: Dict[str, List[str]]) -> None:
+        self._build(graph)
+        components = self._components()
+        # Variables on a cycle are merged into one node; the stages below then see a DAG.
+        self.merged: List[List[str]] = [
+            [self.names[node] for node in sorted(component)] for component in components if len(component) > 1
+        ]
+        if self.merged:
+            self._build(self._condense(graph, self.merged))
+            components = self._components()
+        n = len(self.names)
+
+        self.topo = array('i', (component[0] for component in components))
+        self.depth = array('i', bytes(4 * n))
+        for node in self.topo:
+            start, end = self.dep_offsets[node], self.dep_offsets[node + 1]
+            if start != end:
+                self.depth[node] = 1 + max(self.depth[dep] for dep in self.deps[start:end])
+
+        # Frontend node numbers follow the topological order
+        self.rank = array('i', bytes(4 * n))
+        for position, node in enumerate(self.topo):
+            self.rank[node] = position + 1
+
+    def _build(self, graph: Dict[str, List[str]]) -> None:
+        """Intern the variables and fill both adjacency lists; self-dependencies are dropped."""
+        self.names: List[str] = []
+        self.ids: Dict[str, int] = {}
+        for var in graph:
+            self._intern(var)
+        for deps in graph.values():
+            for dep in deps:
+                self._intern(dep)
+        n = len(self.names)
+
+        # Forward adjacency (node -> dependencies)
+        self.dep_offsets = array('i', [0])
+        self.deps = array('i')
+        for var in self.names:
+            self.deps.extend(self.ids[dep] for dep in graph.get(var, ()) if dep != var)
+            self.dep_offsets.append(len(self.deps))
+
+        # Reverse adjacency (node -> users), filled by counting sort to keep edge order
+        self.user_offsets = array('i', bytes(4 * (n + 1)))
+        for dep in self.deps:
+            self.user_offsets[dep + 1] += 1
+        for i in range(n):
+            self.user_offsets[i + 1] += self.user_offsets[i]
+        fill = self.user_offsets[:-1]
+        self.users = array('i', bytes(4 * len(self.deps)))
+        self.user_edges = array('i', bytes(4 * len(self.deps)))
+        for node in range(n):
+            for edge in range(self.dep_offsets[node], self.dep_offsets[node + 1]):
+                dep = self.deps[edge]
+                self.users[fill[dep]] = node
+                self.user_edges[fill[dep]] = edge
+                fill[dep] += 1
+
+    def _intern(self, var: str) -> int:
+        node = self.ids.get(var)
+        if node is None:
+            node = self.ids[var] = len(self.names)
+            self.names.append(var)
+        return node
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @property
+    def edge_count(self) -> int:
+        return len(self.deps)
+
+    def dependencies(self, node: int) -> array:
+        return self.deps[self.dep_offsets[node]:self.dep_offsets[node + 1]]
+
+    def edge_target(self, edge: int) -> int:
+        """Return the node whose dependency list holds the given edge."""
+        return bisect_right(self.dep_offsets, edge) - 1
+
+    def _components(self) -> List[List[int]]:
+        """
+        Strongly connected components (Tarjan's algorithm, iterative), each listed after the
+        components it depends on. Roots are visited in id order and dependencies in edge
+        order, so on a DAG this is the depth-first post-order with one node per component.
+        """
+        n = len(self.names)
+        offsets, deps = self.dep_offsets, self.deps
+        discovered = array('i', [-1]) * n
+        low = array('i', bytes(4 * n))
+        on_stack = bytearray(n)
+        stack = []
+        components = []
+        counter = 0
+        for root in range(n):
+            if discovered[root] != -1:
+                continue
+            discovered[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = 1
+            calls = [[root, offsets[root]]]    # Node and next edge to follow
+            while calls:
+                frame = calls[-1]
+                node, edge = frame
+                if edge < offsets[node + 1]:
+                    frame[1] = edge + 1
+                    dep = deps[edge]
+                    if discovered[dep] == -1:
+                        discovered[dep] = low[dep] = counter
+                        counter += 1
+                        stack.append(dep)
+                        on_stack[dep] = 1
+                        calls.append([dep, offsets[dep]])
+                    elif on_stack[dep] and discovered[dep] < low[node]:
+                        low[node] = discovered[dep]
                     continue
-                visiting.add(current)
-                stack.append((current, True))
-                for dep in reversed(graph.get(current, [])):
-                    if dep not in visited:
-                        stack.append((dep, False))
-    return order
+                calls.pop()
+                if calls and low[node] < low[calls[-1][0]]:
+                    low[calls[-1][0]] = low[node]
+                if low[node] == discovered[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = 0
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+        return components
+
+    @staticmethod
+    def _condense(graph: Dict[str, List[str]], merged: List[List[str]]) -> Dict[str, List[str]]:
+        """
+        The graph with each group of merged variables replaced by one variable named after
+        all of them ("a, b"); dependencies inside a group are dropped.
+        """
+        label = {}
+        for group in merged:
+            for var in group:
+                label[var] = ", ".join(group)
+        condensed: Dict[str, Dict[str, None]] = {}
+        for var, deps in graph.items():
+            node = label.get(var, var)
+            node_deps = condensed.setdefault(node, {})
+            for dep in deps:
+                dep = label.get(dep, dep)
+                if dep != node:
+                    node_deps[dep] = None
+        return {var: list(deps) for var, deps in condensed.items()}
+
+    def is_output(self, node: int) -> bool:
+        """Outputs are nodes that are not used as a dependency."""
+        return self.user_offsets[node] == self.user_offsets[node + 1]
 
-def get_all_nodes(raw_graph: Dict[str, List[str]]) -> Set[str]:
-    """Return a set of all nodes present in the raw graph."""
-    nodes = set(raw_graph.keys())
-    for deps in raw_graph.values():
-        nodes.update(deps)
-    return nodes
+    def is_input(self, node: int) -> bool:
+        """Inputs have no dependencies (outputs take precedence)."""
+        return self.dep_offsets[node] == self.dep_offsets[node + 1] and not self.is_output(node)
+
+    def node_id(self, node: int) -> str:
+        return "node" + str(self.rank[node])
+
+    def edge_id(self, edge: int) -> str:
+        return "edge" + str(self.rank[self.deps[edge]]) + "-" + str(self.rank[self.edge_target(edge)])
+
+# ---------------------
+# Analysis Budget
+# ---------------------
 
+class BudgetExceeded(ValueError):
+    """Raised when a program is too large to analyze at all."""
 
-def calculate_node_positions(sterilized_graph: Dict[str, List[str]]) -> Tuple[List[Dict], Dict[str, str]]:
+class Budget:
     """
-    Compute node positions for the frontend.
-    Nodes on the same row are spaced 150 apart horizontally, and rows are spaced 150 vertically.
-    Each node's type is determined as:
-      - "customoutput" if the node is not used as a dependency,
-      - "custominput" if it has no dependencies (but is not an output),
-      - "step" otherwise.
-    Returns a list of positioned node dictionaries and a mapping from variable to node id.
-    """
-    HORIZONTAL_SPACING = 150.0
-    VERTICAL_SPACING = 150.0
-    MAX_ITERATIONS = 10
-
-    all_nodes = list(get_all_nodes(sterilized_graph))
-    topo_order = topological_sort(sterilized_graph)
-    missing_nodes = [n for n in all_nodes if n not in topo_order]
-    topo_order = missing_nodes + topo_order
-
-    # Compute depth for each node.
-    depth_map = {node: 0 for node in all_nodes}
-    for node in topo_order:
-        if sterilized_graph.get(node):
-            try:
-                depth_map[node] = 1 + max(depth_map[dep] for dep in sterilized_graph[node])
-            except Exception:
-                depth_map[node] = 0
+    Limits for a single analysis; create a fresh Budget per request.
+      - max_ast_nodes: programs with more AST nodes are rejected with BudgetExceeded,
+      - max_nodes / max_edges: larger graphs get the cheap layout (no median sweeps),
+      - max_seconds: wall time after which the layout sweeps and the order generation
+        stop cooperatively, keeping what they have so far.
+    Every shortcut taken is recorded in degraded and reported in the response.
+    """
+
+    def __init__(self, max_ast_nodes: Optional[int] = None, max_nodes: Optional[int] = None,
+                 max_edges: Optional[int] = None, max_seconds: Optional[float] = None) -> None:
+        self.max_ast_nodes = max_ast_nodes
+        self.max_nodes = max_nodes
+        self.max_edges = max_edges
+        self.max_seconds = max_seconds
+        self.deadline: Optional[float] = None
+        self.degraded: List[str] = []
+
+    def start(self) -> None:
+        """Start the clock; later calls keep the first deadline."""
+        if self.max_seconds is not None and self.deadline is None:
+            self.deadline = time.perf_counter() + self.max_seconds
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.perf_counter() >= self.deadline
+
+    def check_tree(self, tree: ast.AST) -> None:
+        if self.max_ast_nodes is not None:
+            self.check_size(sum(1 for _ in ast.walk(tree)))
+
+    def check_size(self, count: int) -> None:
+        """Raise BudgetExceeded if a program of count syntax nodes is over the limit."""
+        if self.max_ast_nodes is not None and count > self.max_ast_nodes:
+            raise BudgetExceeded(f"Program has {count} syntax nodes, the limit is {self.max_ast_nodes}")
+
+    def graph_too_large(self, index: "GraphIndex") -> bool:
+        return ((self.max_nodes is not None and len(index) > self.max_nodes)
+                or (self.max_edges is not None and index.edge_count > self.max_edges))
 
+def _env_limit(name: str, cast, default):
+    value = os.environ.get(name, default)
+    return cast(value) if value not in (None, "", "none") else None
+
+def analysis_budget() -> Budget:
+    """Build a fresh per-request Budget from the DEPGRAPH_MAX_* environment variables."""
+    return Budget(
+        max_ast_nodes=_env_limit("DEPGRAPH_MAX_AST_NODES", int, 200000),
+        max_nodes=_env_limit("DEPGRAPH_MAX_GRAPH_NODES", int, 5000),
+        max_edges=_env_limit("DEPGRAPH_MAX_GRAPH_EDGES", int, 20000),
+        max_seconds=_env_limit("DEPGRAPH_MAX_SECONDS", float, 5.0),
+    )
+
+def job_budget() -> Budget:
+    """Budget for a background job (see jobs.py), from the DEPGRAPH_JOB_MAX_* variables: ten times the request limits."""
+    return Budget(
+        max_ast_nodes=_env_limit("DEPGRAPH_JOB_MAX_AST_NODES", int, 2000000),
+        max_nodes=_env_limit("DEPGRAPH_JOB_MAX_GRAPH_NODES", int, 50000),
+        max_edges=_env_limit("DEPGRAPH_JOB_MAX_GRAPH_EDGES", int, 200000),
+        max_seconds=_env_limit("DEPGRAPH_JOB_MAX_SECONDS", float, 50.0),
+    )
+
+# ---------------------
+# Graph Utility Functions
+# ---------------------
+
+def layout_rows(index: GraphIndex) -> Dict[int, List[int]]:
+    """Group node ids by depth; each row lists its nodes in id order."""
     depth_groups = defaultdict(list)
-    node_depth = {}
-    for node, depth in depth_map.items():
-        depth_groups[depth].append(node)
-        node_depth[node] = depth
-
-    # Build adjacency lists (parents and children).
-    upper_adj = defaultdict(list)
-    lower_adj = defaultdict(list)
-    for node, deps in sterilized_graph.items():
-        for dep in deps:
-            upper_adj[dep].append(node)
-            lower_adj[node].append(dep)
+    for node in range(len(index)):
+        depth_groups[index.depth[node]].append(node)
+    return depth_groups
+
+def place_row(index: GraphIndex, depth: int, nodes: List[int], x_positions: array) -> None:
+    """Initial placement of one row: by name on row 0, by dependency barycenter below."""
+    if depth == 0:
+        sorted_nodes = sorted(nodes, key=index.names.__getitem__)
+    else:
+        sorted_nodes = sorted(
+            nodes,
+            key=lambda n: sum(x_positions[d] for d in index.dependencies(n)) / max(1, len(index.dependencies(n)))
+        )
+    for idx, node in enumerate(sorted_nodes):
+        x_positions[node] = (idx - len(nodes) / 2) * HORIZONTAL_SPACING
+
+def refine_row(index: GraphIndex, nodes: List[int], x_positions: array) -> None:
+    """One median sweep over a row: reorder it by the median position of each node's dependencies."""
+    node_medians = []
+    for node in nodes:
+        dep_positions = sorted(x_positions[dep] for dep in index.dependencies(node))
+        node_medians.append((node, dep_positions[len(dep_positions) // 2]))
+    node_medians.sort(key=lambda x: x[1])
+    for idx, (node, _) in enumerate(node_medians):
+        x_positions[node] = idx * HORIZONTAL_SPACING - (len(node_medians) - 1) * HORIZONTAL_SPACING / 2
+
+MAX_ITERATIONS = 10
+
+def calculate_node_positions(index: GraphIndex, budget: Optional[Budget] = None) -> array:
+    """
+    Compute the horizontal position of every node, indexed by node id.
+    Rows come from index.depth; nodes on the same row are spaced 150 apart horizontally.
+    Row 0 is ordered by name, deeper rows start from the barycenter of their dependencies
+    and are refined with median sweeps. Under a budget, the sweeps are skipped for graphs
+    over the size limits and stop early once the time limit is reached.
+    """
+    depth_groups = layout_rows(index)
+    depths = sorted(depth_groups.keys())
 
     # Compute horizontal positions.
-    x_positions = {}
-    for depth in sorted(depth_groups.keys()):
-        nodes = depth_groups[depth]
-        if depth == 0:
-            sorted_nodes = sorted(nodes)
-        else:
-            sorted_nodes = sorted(
-                nodes,
-                key=lambda n: sum(x_positions[d] for d in sterilized_graph[n]) / max(1, len(sterilized_graph[n]))
-            )
-        for idx, node in enumerate(sorted_nodes):
-            x_positions[node] = (idx - len(nodes) / 2) * HORIZONTAL_SPACING
-
-    # Refine x positions iteratively.
+    x_positions = array('d', bytes(8 * len(index)))
+    for depth in depths:
+        place_row(index, depth, depth_groups[depth], x_positions)
+
+    if budget is not None and budget.graph_too_large(index):
+        budget.degraded.append("layout_simplified")
+        return x_positions
+
+    # Refine x positions iteratively. Each row only reads the rows above it.
     for _ in range(MAX_ITERATIONS):
-        for depth in sorted(depth_groups.keys(), reverse=True):
+        for depth in reversed(depths):
             if depth == 0:
                 continue
-            current_nodes = depth_groups[depth]
-            node_medians = []
-            for node in current_nodes:
-                deps = lower_adj[node]
-                if deps:
-                    dep_positions = sorted(x_positions[dep] for dep in deps)
-                    median = dep_positions[len(dep_positions) // 2]
-                    node_medians.append((node, median))
-                else:
-                    node_medians.append((node, 0))
-            node_medians.sort(key=lambda x: x[1])
-            sorted_nodes = [n for n, _ in node_medians]
-            for idx, node in enumerate(sorted_nodes):
-                x_positions[node] = idx * HORIZONTAL_SPACING - (len(sorted_nodes) - 1) * HORIZONTAL_SPACING / 2
-
-    # Determine output nodes: those not used as dependency.
-    used_as_dependency = set()
-    for deps in sterilized_graph.values():
-        used_as_dependency.update(deps)
-    output_nodes_set = {n for n in all_nodes if n not in used_as_dependency}
+            if budget is not None and budget.expired():
+                budget.degraded.append("layout_truncated")
+                return x_positions
+            refine_row(index, depth_groups[depth], x_positions)
+    return x_positions
 
-    positioned_nodes = []
-    variable_to_node_id = {}
-    counter = 1
-    for var in topological_sort(sterilized_graph):
-        node_id = "node" + str(counter)
-        variable_to_node_id[var] = node_id
+def stable_node_positions(index: GraphIndex, previous: Dict[str, float], changed: Set[str] = frozenset(),
+                          max_iterations: int = MAX_ITERATIONS,
+                          budget: Optional[Budget] = None) -> Tuple[array, int]:
+    """
+    Warm-started layout for a graph that was laid out before, such as after a small edit.
+    previous maps node names to their x in the earlier layout. A node that was laid out
+    before and whose dependencies are not in changed is anchored: each row keeps its anchored
+    nodes in their previous left-to-right order, even if some moved between rows. Other
+    nodes start from their previous position, or the barycenter of their dependencies if
+    they are new (new inputs go to the right end of row 0), and move by median sweeps, which
+    stop as soon as a sweep leaves the order of every row unchanged. Under a budget, the
+    sweeps also stop at its deadline.
+    Returns the positions and the number of sweeps run.
+    """
+    names = index.names
+    depth_groups = layout_rows(index)
+    depths = sorted(depth_groups.keys())
+    starts = {node: previous[name] for node, name in enumerate(names) if name in previous}
+    anchors = {node for node in starts if names[node] not in changed}
 
-        if var in output_nodes_set:
-            mytype = "customoutput"
-        elif not sterilized_graph.get(var, []):
-            mytype = "custominput"
+    x_positions = array('d', bytes(8 * len(index)))
+
+    def arrange(nodes, key):
+        ordered = sorted(nodes, key=key)
+        for idx, node in enumerate(ordered):
+            x_positions[node] = idx * HORIZONTAL_SPACING - (len(ordered) - 1) * HORIZONTAL_SPACING / 2
+        return ordered
+
+    def start(node):
+        if node in starts:
+            return starts[node]
+        deps = index.dependencies(node)
+        return sum(x_positions[d] for d in deps) / max(1, len(deps))
+
+    def median(node):
+        if node in anchors:    # Current slot: anchored nodes never pass each other
+            return x_positions[node]
+        dep_positions = sorted(x_positions[dep] for dep in index.dependencies(node))
+        return dep_positions[len(dep_positions) // 2]
+
+    row_orders = {}
+    for depth in depths:
+        if depth == 0:    # Inputs are never swept; placed as in place_row
+            ordered = sorted(depth_groups[0], key=lambda n: (0, starts[n], "") if n in starts else (1, 0.0, names[n]))
+            for idx, node in enumerate(ordered):
+                x_positions[node] = (idx - len(ordered) / 2) * HORIZONTAL_SPACING
         else:
-            mytype = "step"
+            row_orders[depth] = arrange(depth_groups[depth], start)
 
-        positioned_nodes.append({
-            "id": node_id,
-            "mytype": mytype,
-            "data": {"label": var},
-            "position": {"x": x_positions[var], "y": node_depth[var] * VERTICAL_SPACING},
-            "style": {"borderRadius": "50%", "width": 100, "height": 100}
-        })
-        counter += 1
-    return positioned_nodes, variable_to_node_id
+    # Rows made only of anchored nodes cannot change order, so only the others are swept.
+    free_rows = [
+        depth for depth in reversed(depths)
+        if depth != 0 and any(node not in anchors for node in depth_groups[depth])
+    ]
+    sweeps = 0
+    while free_rows and sweeps < max_iterations:
+        if budget is not None and budget.expired():
+            budget.degraded.append("layout_truncated")
+            break
+        sweeps += 1
+        reordered = False
+        for depth in free_rows:
+            ordered = arrange(row_orders[depth], median)    # Ties keep the current order
+            if ordered != row_orders[depth]:
+                row_orders[depth] = ordered
+                reordered = True
+        if not reordered:
+            break
+    return x_positions, sweeps
+
+def sugiyama_node_positions(index: GraphIndex, budget: Optional[Budget] = None) -> array:
+    """Layered layout with crossing minimization, computed with NumPy (see sugiyama.py)."""
+    from sugiyama import sugiyama_layout    # NumPy is only loaded once a large graph needs it
+    return sugiyama_layout(index, budget)
 
-def generate_edges(sterilized: Dict[str, List[str]], variable_to_node_id: Dict[str, str]) -> List[Dict]:
-    """Generate the list of edge dictionaries for the frontend.
-       An edge is created only if its target node is not a custominput.
+# Layout engines by name; all take (index, budget) and return x positions indexed by node id.
+LAYOUT_ENGINES = {
+    "median": calculate_node_positions,
+    "sugiyama": sugiyama_node_positions,
+}
+# Graphs with at least this many nodes are laid out by the sugiyama engine by default.
+SUGIYAMA_THRESHOLD = int(os.environ.get("DEPGRAPH_SUGIYAMA_THRESHOLD", 2000))
+# ...unless their edges pass more than this many rows per node in total (see edge_dummies).
+SUGIYAMA_MAX_DUMMIES = int(os.environ.get("DEPGRAPH_SUGIYAMA_MAX_DUMMIES", 32))
+
+def edge_dummies(index: GraphIndex) -> int:
     """
-    edges = []
-    for target, deps in sterilized.items():
-        for source in deps:
-            s_id = variable_to_node_id.get(source)
-            t_id = variable_to_node_id.get(target)
-            if s_id and t_id:
-                edge_id = "edge" + s_id.replace("node", "") + "-" + t_id.replace("node", "")
-                edges.append({
-                    "id": edge_id,
-                    "source": s_id,
-                    "target": t_id,
-                    "type": "straight",
-                    "style": {"stroke": "#00FFCC", "strokeWidth": 2}
-                })
-    return edges
+    Rows passed by the edges of a graph without ending there, summed over all edges: the
+    dummy points a layered drawing cuts its long edges at. Grows with the square of the
+    depth for a variable read by every row, such as a constant used throughout a chain.
+    """
+    depth, deps, offsets = index.depth, index.deps, index.dep_offsets
+    total = 0
+    for node in range(len(index)):
+        row = depth[node] - 1
+        for edge in range(offsets[node], offsets[node + 1]):
+            total += row - depth[deps[edge]]
+    return total
+
+def sugiyama_fits(index: GraphIndex) -> bool:
+    """Whether the sugiyama engine's time and memory stay proportional to the graph's size."""
+    return edge_dummies(index) <= SUGIYAMA_MAX_DUMMIES * len(index)
+
+def layout_engine(index: GraphIndex) -> str:
+    """
+    Name of the default layout engine for a graph: median below SUGIYAMA_THRESHOLD nodes,
+    and for graphs whose long edges the sugiyama engine cannot afford (see sugiyama_fits).
+    """
+    return "sugiyama" if len(index) >= SUGIYAMA_THRESHOLD and sugiyama_fits(index) else "median"
+
+def layout_node_positions(index: GraphIndex, budget: Optional[Budget] = None, engine: Optional[str] = None) -> array:
+    """Lay out the graph with the named engine, or the default one for its size."""
+    return LAYOUT_ENGINES[engine or layout_engine(index)](index, budget)
+
+class _OrderTimeout(Exception):
+    pass
+
+OUTPUT_PALETTE = ["#0000FF", "#FFFF00", "#00FF00", "#FFA500", "#800080"]
+TARGET_COLOR = "#FF0000"
+BLOCKED_COLOR = "#000000"
 
-def unique_color(color_palette):
+# ---------------------
+# Output Colors
+# ---------------------
+
+def _srgb_to_lab(color: str) -> Tuple[float, float, float]:
+    """CIE L*a*b* (D65) coordinates of a #RRGGBB color."""
+    def linear(channel: int) -> float:
+        c = channel / 255
+        return c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4
+    r, g, b = (linear(int(color[i:i + 2], 16)) for i in (1, 3, 5))
+    x = (0.4124 * r + 0.3576 * g + 0.1805 * b) / 0.95047
+    y = 0.2126 * r + 0.7152 * g + 0.0722 * b
+    z = (0.0193 * r + 0.1192 * g + 0.9505 * b) / 1.08883
+    def f(t: float) -> float:
+        return t ** (1 / 3) if t > 0.008856 else 7.787 * t + 16 / 116
+    fx, fy, fz = f(x), f(y), f(z)
+    return 116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz)
+
+def build_palette(size: int, levels: int = 9) -> List[str]:
     """
-    If outputs exceed hardcoded 5 colors, generate as unique as possible using euclidean distance
+    OUTPUT_PALETTE followed by colors chosen by farthest-point sampling in L*a*b*: each next
+    color is the candidate farthest from every color chosen so far, the target and blocked
+    colors, and white (the background). Candidates come from a levels^3 sRGB grid, without
+    the colors too dark or too light to tell apart from black and white. Deterministic.
     """
-    def hex_to_rgb(h): return tuple(int(h[i:i+2], 16) for i in (1, 3, 5))
-    def color_dist(c1, c2): return sum((a - b) ** 2 for a, b in zip(c1, c2)) ** 0.5
+    step = 255 / (levels - 1)
+    candidates, labs = [], []
+    for r in range(levels):
+        for g in range(levels):
+            for b in range(levels):
+                color = f"#{round(r * step):02X}{round(g * step):02X}{round(b * step):02X}"
+                lab = _srgb_to_lab(color)
+                if 30 <= lab[0] <= 90:
+                    candidates.append(color)
+                    labs.append(lab)
+    nearest = [float("inf")] * len(candidates)    # Squared distance to the closest color taken
+
+    def take(lab):
+        for i, other in enumerate(labs):
+            d = (lab[0] - other[0]) ** 2 + (lab[1] - other[1]) ** 2 + (lab[2] - other[2]) ** 2
+            if d < nearest[i]:
+                nearest[i] = d
+
+    palette = list(OUTPUT_PALETTE)
+    for color in palette + [TARGET_COLOR, BLOCKED_COLOR, "#FFFFFF"]:
+        take(_srgb_to_lab(color))
+    while len(palette) < size:
+        best = max(range(len(candidates)), key=nearest.__getitem__)
+        palette.append(candidates[best])
+        take(labs[best])
+    return palette
 
-    existing_rgb = [hex_to_rgb(c) for c in color_palette + ["#FF0000", "#000000"]]
-    while True:
-        new_color = f'#{random.randint(0, 0xFFFFFF):06X}'
-        if all(color_dist(hex_to_rgb(new_color), c) > 100 for c in existing_rgb):
-            return new_color
+# Output colors, computed once; outputs beyond its length reuse it from the start.
+COLOR_TABLE = build_palette(64)
 
-def generate_order(nodes: List[Dict], edges: List[Dict]) -> List[List[str]]:
+def output_colors(count: int) -> List[str]:
+    """Colors for count outputs, left to right; the same count always gets the same colors."""
+    return [COLOR_TABLE[i % len(COLOR_TABLE)] for i in range(count)]
+
+# ---------------------
+# Order Generation
+# ---------------------
+
+class OrderTracer:
     """
-    Generate an ordered 2d list of [element (node or edge), color] to be colored
+    State of the reverse BFS that produces the animation order.
+    Each output is traced in turn (one "segment" per output) against the shared seen-node
+    and blocked-edge state; a node step marks the node seen and a black edge step blocks
+    the edge, so replaying a segment's steps with mark() reproduces its effect on the state.
     """
-    color_palette = ["#0000FF", "#FFFF00", "#00FF00", "#FFA500", "#800080"]
-    
-    output_nodes = []
-    input_node_ids = set()
-    seen = set()
-    blocked_edge_ids = set()    # Stop when a black edge is reached, don't recolor target
-    order = []
 
-    for node in nodes:
-        if node["mytype"] == "customoutput":
-            output_nodes.append(node)
-        elif node["mytype"] == "custominput":
-            input_node_ids.add(node["id"])
-
-    output_nodes.sort(key=lambda x: x["position"]["x"]) #force start left to right 
-
-    def target_found(node):
-        trace([node], "#FF0000")
-        for edge in edges:
-            if edge["source"] == node["id"]:
-                blocked_edge_ids.add(edge["id"])
-                order.append([edge["id"], "#000000"])
-
-    def trace(start_nodes, color):
-        cur_node_ids = set()    # avoid false target discovery if two nodes of same color share ancestor
+    def __init__(self, index: GraphIndex, x_positions: array, budget: Optional[Budget] = None) -> None:
+        self.index = index
+        self.x_positions = x_positions
+        self.budget = budget
+        self.seen = bytearray(len(index))
+        self.blocked_edges = bytearray(index.edge_count)    # Stop when a black edge is reached, don't recolor target
+
+    def outputs(self, colors: Optional[Sequence] = None) -> List[Tuple[int, str]]:
+        """Output nodes left to right, each paired with its color (output_colors unless colors are given)."""
+        index = self.index
+        output_nodes = [node for node in index.topo if index.is_output(node)]
+        output_nodes.sort(key=self.x_positions.__getitem__) #force start left to right 
+        if colors is None:
+            colors = output_colors(len(output_nodes))
+        return list(zip(output_nodes, colors))
+
+    def mark(self, step: Tuple[bool, int, str]) -> None:
+        """Apply the state change of a step produced by an earlier trace."""
+        is_edge, item, color = step
+        if not is_edge:
+            self.seen[item] = 1
+        elif color == BLOCKED_COLOR:
+            self.blocked_edges[item] = 1
+
+    def target_found(self, node: int) -> Iterator[Tuple[bool, int, str]]:
+        index = self.index
+        yield from self.trace([node], TARGET_COLOR)
+        for pos in range(index.user_offsets[node], index.user_offsets[node + 1]):
+            edge = index.user_edges[pos]
+            self.blocked_edges[edge] = 1
+            yield (True, edge, BLOCKED_COLOR)
+
+    def trace(self, start_nodes: List[int], color: str) -> Iterator[Tuple[bool, int, str]]:
+        index, x_positions, budget = self.index, self.x_positions, self.budget
+        seen, blocked_edges = self.seen, self.blocked_edges
+        cur_nodes = set()    # avoid false target discovery if two nodes of same color share ancestor
        
         while start_nodes:
+            if budget is not None and budget.expired():
+                raise _OrderTimeout
             next_edges = []
             for node in start_nodes:
-                if color != "#FF0000" and node["id"] in seen:   # Avoid infinite recursion with target discovery
-                    target_found(node)
+                if color != TARGET_COLOR and seen[node]:   # Avoid infinite recursion with target discovery
+                    yield from self.target_found(node)
 
                 else: # Color node and form list of edges connecting to it
-                    order.append([node["id"], color])
-                    seen.add(node["id"])
+                    yield (False, node, color)
+                    seen[node] = 1
                         # Use a list of lists for edge groups that share target. Allows sorting of these edges left to right
-                    edge_group = []
-                    for edge in edges:
-                        if edge["target"] == node["id"] and edge["id"] not in blocked_edge_ids:
-                            edge_group.append(edge)
-                    next_edges.append(edge_group)
+                    next_edges.append([
+                        edge for edge in range(index.dep_offsets[node], index.dep_offsets[node + 1])
+                        if not blocked_edges[edge]
+                    ])
         
             # Generate next layer of nodes
             next_nodes = []
             for edge_group in next_edges:   
                 for edge in edge_group:
-                    for node in nodes:
-                        if node["id"] == edge["source"]: # Leave input nodes in for sorting edge order logic
-                            if node["id"] not in cur_node_ids:
-                                next_nodes.append(node)
-                                cur_node_ids.add(node["id"])
+                    source = index.deps[edge]
+                    if source not in cur_nodes: # Leave input nodes in for sorting edge order logic
+                        next_nodes.append(source)
+                        cur_nodes.add(source)
             
-            next_nodes.sort(key=lambda x: x["position"]["x"])
+            next_nodes.sort(key=x_positions.__getitem__)
+            next_rank = {node: idx for idx, node in enumerate(next_nodes)}
             
             # Color edges before processing next layer of nodes
             for edge_group in next_edges:
                 if len(edge_group) == 1:    # Node sourced by one edge
-                    order.append([edge_group[0]["id"], color])
+                    yield (True, edge_group[0], color)
                 else:   # Node sourced by multiple edges, sort to color left to right consistently
-                    for node in next_nodes: # already sorted by x position, use to determine edge color order
-                        for edge in edge_group:
-                            if edge["source"] == node["id"]:
-                                order.append([edge["id"], color])
+                    ranked = [edge for edge in edge_group if index.deps[edge] in next_rank]
+                    ranked.sort(key=lambda edge: next_rank[index.deps[edge]])   # stable, next_nodes already sorted by x
+                    for edge in ranked:
+                        yield (True, edge, color)
                                 
-            new_start = []
-            for node in next_nodes:
-                if node["id"] not in input_node_ids:    # Remove input nodes from coloring logic
-                    new_start.append(node)
-            start_nodes = new_start
+            start_nodes = [node for node in next_nodes if not index.is_input(node)]    # Remove input nodes from coloring logic
 
-    # Ensure enough unique colors exist
-    if len(output_nodes) > len(color_palette):
-        for i in range(len(output_nodes - len(color_palette))):
-            color_palette.append(unique_color(color_palette))
+def iter_order(index: GraphIndex, x_positions: array, budget: Optional[Budget] = None,
+               colors: Optional[Sequence] = None) -> Iterator[Tuple[bool, int, str]]:
+    """
+    Yield (is_edge, node or edge index, color) steps to be colored, in animation order.
+    Steps are produced as the reverse BFS reaches them, so callers can stream them out.
+    Outputs are colored from colors left to right if given, else from output_colors; any
+    value other than TARGET_COLOR and BLOCKED_COLOR can stand for a color.
+    Under a budget, the generator stops once the time limit is reached (flagged as truncated).
+    """
+    tracer = OrderTracer(index, x_positions, budget)
 
     # Reverse BFS from each output node
-    for node, color in zip(output_nodes, color_palette):
-        trace([node], color)
-    return order
+    try:
+        for node, color in tracer.outputs(colors):
+            yield from tracer.trace([node], color)
+    except _OrderTimeout:
+        budget.degraded.append("order_truncated")
+
+def generate_order(index: GraphIndex, x_positions: array, budget: Optional[Budget] = None,
+                   colors: Optional[Sequence] = None) -> List[Tuple[bool, int, str]]:
+    """Generate the full list of order steps (see iter_order)."""
+    return list(iter_order(index, x_positions, budget, colors))
+
+# ---------------------
+# Frontend Materialization
+# ---------------------
+
+def materialize_nodes(index: GraphIndex, x_positions: array) -> List[Dict]:
+    """
+    Build the positioned node dictionaries for the frontend, in topological order.
+    Each node's type is determined as:
+      - "customoutput" if the node is not used as a dependency,
+      - "custominput" if it has no dependencies (but is not an output),
+      - "step" otherwise.
+    """
+    positioned_nodes = []
+    for node in index.topo:
+        if index.is_output(node):
+            mytype = "customoutput"
+        elif index.is_input(node):
+            mytype = "custominput"
+        else:
+            mytype = "step"
+
+        positioned_nodes.append({
+            "id": index.node_id(node),
+            "mytype": mytype,
+            "data": {"label": index.names[node]},
+            "position": {"x": x_positions[node], "y": index.depth[node] * VERTICAL_SPACING},
+            "style": {"borderRadius": "50%", "width": 100, "height": 100}
+        })
+    return positioned_nodes
+
+def generate_edges(index: GraphIndex) -> List[Dict]:
+    """Generate the list of edge dictionaries for the frontend, one per dependency."""
+    edges = []
+    for target in range(len(index)):
+        t_num = str(index.rank[target])
+        for edge in range(index.dep_offsets[target], index.dep_offsets[target + 1]):
+            s_num = str(index.rank[index.deps[edge]])
+            edges.append({
+                "id": "edge" + s_num + "-" + t_num,
+                "source": "node" + s_num,
+                "target": "node" + t_num,
+                "type": "straight",
+                "style": {"stroke": "#00FFCC", "strokeWidth": 2}
+            })
+    return edges
+
+def materialize_step(index: GraphIndex, step: Tuple[bool, int, str]) -> List[str]:
+    """Translate one order step into an [element id, color] pair for the frontend."""
+    is_edge, item, color = step
+    return [index.edge_id(item) if is_edge else index.node_id(item), color]
+
+def materialize_order(index: GraphIndex, steps: List[Tuple[bool, int, str]]) -> List[List[str]]:
+    """Translate order steps into [element id, color] pairs for the frontend."""
+    return [materialize_step(index, step) for step in steps]
 
 # ---------------------
 # Main Process Function
 # ---------------------
 
-def process_code(code: str) -> Dict:
+# Stages reported to the progress callback of process_code, in order
+PROGRESS_STAGES = ("parsed", "graph", "layout", "order")
+
+def graph_stats(index: GraphIndex) -> Dict[str, int]:
+    """Size counters for a graph: nodes, edges, outputs and number of rows (depth)."""
+    return {
+        "nodes": len(index),
+        "edges": index.edge_count,
+        "outputs": sum(1 for node in range(len(index)) if index.is_output(node)),
+        "depth": max(index.depth) + 1 if len(index) else 0,
+    }
+
+def extract_graph(code: str, budget: Optional[Budget] = None, timings: Optional[Dict[str, float]] = None,
+                  progress: Optional[Callable[[str], None]] = None) -> Dict[str, List[str]]:
+    """
+    The stages every analysis starts with: start the budget, parse code, check the tree
+    against the budget and extract the dependency graph. Stores the "parse" and "visit"
+    times in timings and reports "parsed" to progress.
+    """
+    clock = time.perf_counter
+    start = clock()
+    if budget is not None:
+        budget.start()
+    tree = ast.parse(code)
+    if budget is not None:
+        budget.check_tree(tree)
+    parsed = clock()
+    if progress is not None:
+        progress("parsed")
+    graph = GraphExtractor().extract(tree)
+    if timings is not None:
+        timings.update({"parse": parsed - start, "visit": clock() - parsed})
+    return graph
+
+def index_code(code: str, budget: Optional[Budget] = None, timings: Optional[Dict[str, float]] = None,
+               progress: Optional[Callable[[str], None]] = None) -> Tuple[Dict[str, List[str]], GraphIndex]:
+    """extract_graph, then the graph's GraphIndex; also stores the "index" time and reports "graph"."""
+    graph = extract_graph(code, budget, timings, progress)
+    start = time.perf_counter()
+    index = GraphIndex(graph)
+    if timings is not None:
+        timings["index"] = time.perf_counter() - start
+    if progress is not None:
+        progress("graph")
+    return graph, index
+
+class ProgramCache:
+    """
+    Bounded LRU of values built from a program's source, for requests that usually follow one
+    another on the same code (expanding clusters, opening scopes). get() calls
+    build(code, *args, budget=budget, timings=timings) on a miss only, so timings only hold
+    stages that ran for this call. Entries are keyed by the code, the budget's syntax node
+    limit and args.
+    """
+
+    def __init__(self, build: Callable, max_entries: int = 16) -> None:
+        self.build = build
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, object]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, code: str, *args, budget: Budget, timings: Dict[str, float]):
+        key = (code, budget.max_ast_nodes) + args
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = self.build(code, *args, budget=budget, timings=timings)
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+def process_code(code: str, timings: Optional[Dict[str, float]] = None, budget: Optional[Budget] = None,
+                 progress: Optional[Callable[[str], None]] = None) -> Dict:
     """
     Process the provided Python code and return a dictionary containing:
       - 'sterilized_graph': The dependency graph after pruning.
       - 'positioned_nodes': Nodes with computed positions and types.
       - 'edges': Edge definitions.
       - 'order': Animation order for nodes and edges.
+      - 'stats': Graph size counters (see graph_stats).
+      - 'merged': Groups of variables on a cycle, each drawn as one node (see GraphIndex).
+      - 'degraded': Shortcuts taken to stay within the budget, if one was given.
+    If a timings dict is given, the wall time of each stage in seconds is stored in it.
+    If progress is given, it is called with each of PROGRESS_STAGES as that stage finishes.
     """
-    tree = ast.parse(code)
-    visitor = AssignmentVisitor()
-    visitor.visit(tree)
-    graph = {k: list(v) for k, v in visitor.graph.items()}
-    nodes, variable_to_node_id = calculate_node_positions(graph)
-    edges = generate_edges(graph, variable_to_node_id)
-    order = generate_order(nodes, edges)
+    report = progress if progress is not None else lambda stage: None
+    clock = time.perf_counter
+    graph, index = index_code(code, budget, timings, report)
+    indexed = clock()
+    x_positions = layout_node_positions(index, budget)
+    laid_out = clock()
+    report("layout")
+    steps = generate_order(index, x_positions, budget)
+    ordered = clock()
+    report("order")
 
-    return {
+    result = {
         "sterilized_graph": graph,
-        "positioned_nodes": nodes,
-        "edges": edges,
-        "order": order
+        "positioned_nodes": materialize_nodes(index, x_positions),
+        "edges": generate_edges(index),
+        "order": materialize_order(index, steps),
+        "stats": graph_stats(index),
+        "merged": index.merged,
+        "degraded": budget.degraded if budget is not None else []
     }
+    if timings is not None:
+        timings.update({
+            "layout": laid_out - indexed,
+            "order": ordered - laid_out,
+            "materialize": clock() - ordered,
+        })
+    return result
+
+def stream_code(code: str, budget: Optional[Budget] = None) -> Iterator:
+    """
+    Streaming counterpart of process_code. Yields the frontend payload in pieces:
+      - first {"nodes": ..., "edges": ...} once the layout is done, with "merged" if
+        variables on a cycle were merged,
+      - then each [element id, color] order step as generate_order produces it,
+      - finally {"done": True, "degraded": [...]}.
+    Parse and analysis errors are raised before the first item is yielded.
+    """
+    _, index = index_code(code, budget)
+    x_positions = layout_node_positions(index, budget)
+
+    first = {"nodes": materialize_nodes(index, x_positions), "edges": generate_edges(index)}
+    if index.merged:
+        first["merged"] = index.merged
+    yield first
+    for step in iter_order(index, x_positions, budget):
+        yield materialize_step(index, step)
+    yield {"done": True, "degraded": budget.degraded if budget is not None else []}
 
 # ---------------------
 # Test Runner
@@ -0,0 +1,374 @@
+"""
+Incremental re-analysis of a program that is being edited.
+
+An IncrementalAnalyzer keeps the state of the last analysis and, given the next version
+of the source, redoes only the work an edit can affect:
+
+  - Parsing: the source is split into top-level statements at lines that start in column
+    0. Statements whose text is unchanged reuse their recorded (target, dependencies)
+    contributions; only new or edited statements are parsed and visited. If a split
+    does not parse on its own (a multi-line string, a bracket closed in column 0...)
+    the whole source is parsed instead, so errors and results never depend on the split.
+  - Graph: rebuilt from the contributions in statement order, which reproduces the graph
+    GraphExtractor builds. An edit that leaves the graph unchanged returns the
+    previous result.
+  - Layout: a row's positions only depend on the rows above it, so rows above the first
+    row whose membership or dependencies changed keep their positions. The positions of
+    every node after each sweep are kept so the rows below can be recomputed exactly.
+    Graphs large enough for another layout engine (see depgraph2.layout_engine) are laid
+    out in full, and so are graphs with merged cycles and the first graph after them.
+  - Order: each output's trace (a "segment") only reads its ancestors, so segments are
+    reused from the left until one whose ancestors changed, and traced from there on.
+
+update() returns exactly what process_code returns for the same source, under the same
+budget: the syntax nodes of a program are counted per statement, and the layout sweeps and
+the order stop at the budget's deadline as they do in process_code. A result that took a
+shortcut is returned but not kept, so the next update starts from the last complete one.
+The GraphIndex and the frontend dictionaries are still rebuilt in full on every edit that
+changes the graph.
+
+With stable_layout=True, every update after the first is laid out by stable_node_positions
+instead, warm-started from the previous positions: unchanged nodes keep their order and the
+sweeps stop once rows settle. Positions then depend on the edit history and no longer
+match process_code; the order is still generated from them exactly as process_code would.
+"""
+import ast
+import re
+from array import array
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+from depgraph2 import (MAX_ITERATIONS, Budget, GraphExtractor, GraphIndex, OrderTracer, _OrderTimeout, generate_edges,
+                       graph_stats, layout_engine, layout_node_positions, layout_rows, materialize_nodes,
+                       materialize_order, place_row, refine_row, stable_node_positions)
+
+Contribution = Tuple[str, List[str]]
+NamedStep = Tuple[bool, object, str]    # (is_edge, node name or (source, target) names, color)
+
+# ---------------------
+# Statement Splitting
+# ---------------------
+
+_CONTINUATION = re.compile(r"(else|elif|except|finally)\b")
+
+def split_statements(code: str) -> List[str]:
+    """
+    Split source into chunks that each start with a top-level statement.
+    A chunk starts at every line beginning in column 0 that does not continue the previous
+    statement (else/elif/except/finally, a closing bracket, or a decorated definition).
+    Joining the chunks with newlines gives back the source.
+    """
+    chunks = []
+    current: List[str] = []
+    decorated = False
+    for line in code.split("\n"):
+        starts = (
+            current and line and line[0] not in " \t\f\r#)]}"
+            and not decorated and not _CONTINUATION.match(line)
+        )
+        if starts:
+            chunks.append("\n".join(current))
+            current = []
+        current.append(line)
+        if line and line[0] not in " \t\f\r#":
+            decorated = line[0] == "@"
+    chunks.append("\n".join(current))
+    return chunks
+
+class _StatementVisitor(GraphExtractor):
+    """GraphExtractor that keeps each assignment's contribution instead of merging them."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.contributions: List[Contribution] = []
+
+    def record(self, target: str, dependencies: List[str]) -> None:
+        self.contributions.append((target, dependencies))
+
+def statement_contributions(tree: ast.AST) -> List[Contribution]:
+    visitor = _StatementVisitor()
+    visitor.extract(tree)
+    return visitor.contributions
+
+def syntax_nodes(tree: ast.AST) -> int:
+    """Nodes of a parsed chunk, as Budget.check_tree counts them."""
+    return sum(1 for _ in ast.walk(tree))
+
+def build_graph(contributions: List[List[Contribution]]) -> Dict[str, List[str]]:
+    """Merge contributions in order, exactly as GraphExtractor does."""
+    extractor = GraphExtractor()
+    for chunk in contributions:
+        for target, dependencies in chunk:
+            extractor.record(target, dependencies)
+    return extractor.graph
+
+# ---------------------
+# Incremental Analyzer
+# ---------------------
+
+class IncrementalAnalyzer:
+    """
+    Analysis state for one evolving program; see the module docstring.
+    After each update(), `last_update` holds counters describing how much work was reused.
+    """
+
+    def __init__(self, stable_layout: bool = False) -> None:
+        self.stable_layout = stable_layout
+        self.last_update: Dict[str, int] = {}
+        self._chunks: Dict[str, Tuple[List[Contribution], int]] = {}    # Contributions and syntax nodes per chunk
+        self._graph: Optional[Dict[str, List[str]]] = None
+        self._result: Optional[Dict] = None
+        self._rows: Dict[int, List[str]] = {}
+        self._history: Dict[str, List[float]] = {}     # x after placement and after each sweep
+        self._segments: List[Tuple[str, str, List[NamedStep], FrozenSet[str]]] = []
+        self._positions: Dict[str, float] = {}     # x per name, in stable mode
+        self._merged = False
+
+    def update(self, code: str, budget: Optional[Budget] = None) -> Dict:
+        """
+        Analyze the new version of the source; same result as process_code(code, budget=budget)
+        unless stable_layout is set.
+        """
+        counters = self.last_update = {"chunks_parsed": 0, "chunks_reused": 0}
+        if budget is not None:
+            budget.start()
+        contributions, size = self._contributions(code, counters)
+        if budget is not None:
+            budget.check_size(size)
+        graph = build_graph(contributions)
+
+        old_graph = self._graph
+        if old_graph is not None and graph == old_graph and list(graph) == list(old_graph):
+            counters["unchanged"] = 1
+            return self._result
+
+        index = GraphIndex(graph)
+        changed = self._changed_nodes(graph, old_graph)
+        if index.merged or self._merged:
+            changed = set(index.names)    # Merged nodes are not graph keys: redo layout and order
+        too_large = budget is not None and budget.graph_too_large(index)
+        if self.stable_layout and self._positions and not too_large:
+            x_positions, counters["layout_sweeps"] = stable_node_positions(index, self._positions, changed,
+                                                                           budget=budget)
+            moved = {
+                name for node, name in enumerate(index.names)
+                if self._positions.get(name) != x_positions[node]
+            }
+            rows, history = {}, {}
+        elif layout_engine(index) != "median" or too_large:
+            x_positions = layout_node_positions(index, budget)
+            moved, rows, history = set(index.names), {}, {}
+        else:
+            x_positions, moved, rows, history = self._layout(index, changed, counters, budget)
+        steps, segments = self._order(index, x_positions, graph, old_graph, changed, moved, counters, budget)
+
+        result = {
+            "sterilized_graph": graph,
+            "positioned_nodes": materialize_nodes(index, x_positions),
+            "edges": generate_edges(index),
+            "order": materialize_order(index, steps),
+            "stats": graph_stats(index),
+            "merged": index.merged,
+            "degraded": budget.degraded if budget is not None else [],
+        }
+        if result["degraded"]:    # Shortcuts depend on load and limits; later edits start from the last complete result
+            return result
+        # Only keep the new state once every stage has succeeded.
+        self._graph, self._result, self._merged = graph, result, bool(index.merged)
+        self._rows, self._history, self._segments = rows, history, segments
+        if self.stable_layout:
+            self._positions = {name: x_positions[node] for node, name in enumerate(index.names)}
+        return result
+
+    # Parsing
+
+    def _contributions(self, code: str, counters: Dict[str, int]) -> Tuple[List[List[Contribution]], int]:
+        """
+        The contributions of each chunk, in order, and the syntax nodes of the whole program:
+        those of its chunks, less the Module node each chunk has of its own.
+        """
+        chunks = {}
+        ordered = []
+        size = 1
+        for text in split_statements(code):
+            entry = chunks.get(text)
+            if entry is None:
+                entry = self._chunks.get(text)
+                if entry is None:
+                    try:
+                        tree = ast.parse(text)
+                    except SyntaxError:
+                        counters["full_parse"] = 1
+                        tree = ast.parse(code)
+                        return [statement_contributions(tree)], syntax_nodes(tree)
+                    entry = (statement_contributions(tree), syntax_nodes(tree))
+                    counters["chunks_parsed"] += 1
+                else:
+                    counters["chunks_reused"] += 1
+                chunks[text] = entry
+            ordered.append(entry[0])
+            size += entry[1] - 1
+        self._chunks = chunks
+        return ordered, size
+
+    @staticmethod
+    def _changed_nodes(graph: Dict[str, List[str]], old_graph: Optional[Dict[str, List[str]]]) -> Set[str]:
+        """Names whose dependency list differs from the previous graph."""
+        if old_graph is None:
+            return set(graph)
+        changed = {name for name, deps in graph.items() if old_graph.get(name) != deps}
+        changed.update(name for name in old_graph if name not in graph)
+        return changed
+
+    # Layout
+
+    def _layout(self, index: GraphIndex, changed: Set[str], counters: Dict[str, int], budget: Optional[Budget] = None):
+        """
+        Recompute rows from the first dirty one down, reading the rows above from history.
+        Returns the positions, the names whose final position moved, and the new row and
+        history state. Sweeps stop at the budget's deadline, as in calculate_node_positions.
+        """
+        names = index.names
+        depth_groups = layout_rows(index)
+        depths = sorted(depth_groups.keys())
+        rows = {depth: [names[node] for node in depth_groups[depth]] for depth in depths}
+
+        first_dirty = len(depths)
+        for position, depth in enumerate(depths):
+            if rows[depth] != self._rows.get(depth) or not changed.isdisjoint(rows[depth]):
+                first_dirty = position
+                break
+        clean, dirty = depths[:first_dirty], depths[first_dirty:]
+        counters["rows_reused"], counters["rows_laid_out"] = len(clean), len(dirty)
+
+        x_positions = array('d', bytes(8 * len(index)))
+        history, old_history = {}, self._history
+        for depth in clean:
+            for name in rows[depth]:
+                history[name] = old_history[name]
+
+        dirty_nodes = [node for depth in dirty for node in depth_groups[depth]]
+        dirty_set = set(dirty_nodes)
+        frontier = sorted({dep for node in dirty_nodes for dep in index.dependencies(node) if dep not in dirty_set})
+        frontier_history = [history[names[node]] for node in frontier]
+
+        for node, past in zip(frontier, frontier_history):
+            x_positions[node] = past[0]
+        for depth in dirty:
+            place_row(index, depth, depth_groups[depth], x_positions)
+        dirty_history = [[x_positions[node]] for node in dirty_nodes]
+
+        for sweep in range(1, MAX_ITERATIONS + 1):
+            for node, past in zip(frontier, frontier_history):
+                x_positions[node] = past[sweep - 1]
+            for depth in reversed(dirty):
+                if depth == 0:
+                    continue
+                if budget is not None and budget.expired():
+                    budget.degraded.append("layout_truncated")
+                    break
+                refine_row(index, depth_groups[depth], x_positions)
+            else:
+                for node, past in zip(dirty_nodes, dirty_history):
+                    past.append(x_positions[node])
+                continue
+            break
+
+        moved = set()
+        for node, past in zip(dirty_nodes, dirty_history):
+            name = names[node]
+            previous = old_history.get(name)
+            if previous is None or previous[-1] != past[-1]:
+                moved.add(name)
+            history[name] = past
+        for depth in clean:
+            for node in depth_groups[depth]:
+                x_positions[node] = history[names[node]][-1]
+
+        return x_positions, moved, rows, history
+
+    # Order
+
+    def _order(self, index: GraphIndex, x_positions: array, graph: Dict[str, List[str]],
+               old_graph: Optional[Dict[str, List[str]]], changed: Set[str], moved: Set[str],
+               counters: Dict[str, int], budget: Optional[Budget] = None):
+        """
+        Reuse leading segments whose output, color and ancestors are unchanged, trace the rest.
+        A segment reads the dependencies, users and positions of its ancestors only; ancestor
+        sets themselves can only change through a node in the old set whose dependencies changed.
+        Tracing stops at the budget's deadline, as in iter_order.
+        """
+        names = index.names
+        segments = self._segments
+        dirty = changed | moved
+        if old_graph is not None:
+            old_keys = [name for name in old_graph if name in graph]
+            if old_keys != [name for name in graph if name in old_graph]:
+                segments = []    # Users are listed in id order, which has been reshuffled
+            for name in changed:
+                dirty.update(graph.get(name, ()))    # Their user lists changed
+                dirty.update(old_graph.get(name, ()))
+
+        tracer = OrderTracer(index, x_positions, budget)
+        steps = []
+        new_segments = []
+        reusing = True
+        for node, color in tracer.outputs():
+            name = names[node]
+            if reusing and len(new_segments) < len(segments):
+                old_name, old_color, named_steps, ancestors = segments[len(new_segments)]
+                if old_name == name and old_color == color and dirty.isdisjoint(ancestors):
+                    for step in self._resolve(index, named_steps):
+                        tracer.mark(step)
+                        steps.append(step)
+                    new_segments.append(segments[len(new_segments)])
+                    continue
+            reusing = False
+            segment = []
+            try:
+                for step in tracer.trace([node], color):
+                    segment.append(step)
+            except _OrderTimeout:
+                budget.degraded.append("order_truncated")
+                steps.extend(segment)
+                break
+            steps.extend(segment)
+            new_segments.append((name, color, self._name_steps(index, segment), self._ancestors(index, node)))
+
+        counters["segments_reused"] = sum(1 for a, b in zip(new_segments, segments) if a is b)
+        counters["segments_traced"] = len(new_segments) - counters["segments_reused"]
+        return steps, new_segments
+
+    @staticmethod
+    def _ancestors(index: GraphIndex, node: int) -> FrozenSet[str]:
+        seen = {node}
+        stack = [node]
+        while stack:
+            for dep in index.dependencies(stack.pop()):
+                if dep not in seen:
+                    seen.add(dep)
+                    stack.append(dep)
+        return frozenset(index.names[n] for n in seen)
+
+    @staticmethod
+    def _name_steps(index: GraphIndex, steps: List[Tuple[bool, int, str]]) -> List[NamedStep]:
+        names = index.names
+        return [
+            (True, (names[index.deps[item]], names[index.edge_target(item)]), color) if is_edge
+            else (False, names[item], color)
+            for is_edge, item, color in steps
+        ]
+
+    @staticmethod
+    def _resolve(index: GraphIndex, named_steps: List[NamedStep]) -> List[Tuple[bool, int, str]]:
+        ids, deps, offsets = index.ids, index.deps, index.dep_offsets
+        steps = []
+        for is_edge, item, color in named_steps:
+            if is_edge:
+                source, target = ids[item[0]], ids[item[1]]
+                edge = offsets[target]
+                while deps[edge] != source:
+                    edge += 1
+                steps.append((True, edge, color))
+            else:
+                steps.append((False, ids[item], color))
+        return steps
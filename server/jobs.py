@@ -0,0 +1,141 @@
+"""
+Analyses run as background jobs.
+
+A synchronous /analyze request holds its connection until the analysis finishes, which for
+a large program can outlast the browser's or a proxy's timeout. A job is accepted at once
+and given an id; clients then follow its events (queued, running, each stage of
+depgraph2.PROGRESS_STAGES as it finishes, then done or failed) and fetch its result.
+
+Jobs wait in an in-process queue and are run by a few threads, so nothing beyond this
+process is needed. Finished jobs are kept for ttl seconds, then forgotten. In production mode
+a job thread waits for a pool worker rather than failing when the pool is busy, and a job
+runs under its own, larger limits: JOB_TIMEOUT seconds and depgraph2.job_budget().
+"""
+import os
+import queue
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Tuple
+
+from depgraph2 import BudgetExceeded
+from pool import AnalysisTimeout, PoolBusy
+
+# Threads running jobs, jobs allowed to wait for them, and seconds a finished job is kept
+JOB_THREADS = int(os.environ.get("DEPGRAPH_JOB_THREADS", 2))
+JOB_QUEUE_DEPTH = int(os.environ.get("DEPGRAPH_JOB_QUEUE", 64))
+JOB_TTL = float(os.environ.get("DEPGRAPH_JOB_TTL", 300))
+# Seconds a job may run on a pool worker before it is cancelled
+JOB_TIMEOUT = float(os.environ.get("DEPGRAPH_JOB_TIMEOUT", 60))
+
+# HTTP status reported for a failed job, by error (anything else is 500), as for /analyze
+ERROR_STATUS = ((PoolBusy, 503), (AnalysisTimeout, 504), (BudgetExceeded, 413))
+
+# ---------------------
+# Jobs
+# ---------------------
+
+class Job:
+    """
+    One queued analysis. Events are appended as the job moves along, each {"stage": ...,
+    "seconds": ...} (seconds since the job was submitted); a failed job's last event also
+    has "error" and "status". Readers wait on the job's condition for new events.
+    """
+
+    def __init__(self, job_id: str, code: str) -> None:
+        self.id = job_id
+        self.code = code
+        self.state = "queued"
+        self.events: List[Dict] = []
+        self.result: Optional[bytes] = None
+        self.submitted = time.monotonic()
+        self.finished: Optional[float] = None
+        self._changed = threading.Condition()
+        self.add("queued")
+
+    def add(self, stage: str, **details) -> None:
+        with self._changed:
+            self.events.append({"stage": stage, "seconds": round(time.monotonic() - self.submitted, 6), **details})
+            self._changed.notify_all()
+
+    def start(self) -> None:
+        with self._changed:
+            self.state = "running"
+            self.add("running")
+
+    def finish(self, state: str, result: Optional[bytes] = None, **details) -> None:
+        """End the job as "done" with its result, or as "failed" with details of the error."""
+        with self._changed:
+            self.state = state
+            self.result = result
+            self.finished = time.monotonic()
+            self.code = ""    # Only the result is needed from here on
+            self.add(state, **details)
+
+    def wait(self, after: int, timeout: float) -> Tuple[List[Dict], str]:
+        """Events from number after on, waiting up to timeout seconds for one; and the job's state."""
+        with self._changed:
+            self._changed.wait_for(lambda: len(self.events) > after, timeout)
+            return self.events[after:], self.state
+
+class JobStore:
+    """
+    In-process job queue and store. run(code, progress) does the work of a job and returns
+    its result; progress is called with each stage as it finishes. submit() raises PoolBusy
+    when queue_depth jobs are already waiting.
+    """
+
+    def __init__(self, run: Callable[[str, Callable[[str], None]], bytes], threads: int = JOB_THREADS,
+                 queue_depth: int = JOB_QUEUE_DEPTH, ttl: float = JOB_TTL) -> None:
+        self.run = run
+        self.threads = threads
+        self.ttl = ttl
+        self._queue: "queue.Queue[Job]" = queue.Queue(maxsize=queue_depth)
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._workers: List[threading.Thread] = []
+
+    def submit(self, code: str) -> Job:
+        job = Job(uuid.uuid4().hex, code)
+        with self._lock:
+            self._evict()
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                raise PoolBusy("Job queue is full")
+            self._jobs[job.id] = job
+            if not self._workers:    # Started on first use, so importing the server starts no threads
+                for i in range(self.threads):
+                    worker = threading.Thread(target=self._work, name=f"depgraph-job-{i}", daemon=True)
+                    worker.start()
+                    self._workers.append(worker)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            self._evict()
+            return self._jobs.get(job_id)
+
+    def _evict(self) -> None:
+        """Forget jobs that finished more than ttl seconds ago. Called with the lock held."""
+        cutoff = time.monotonic() - self.ttl
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished is not None and job.finished < cutoff]:
+            del self._jobs[job_id]
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            job.start()
+            try:
+                result = self.run(job.code, job.add)
+            except Exception as e:
+                status = next((status for error, status in ERROR_STATUS if isinstance(e, error)), 500)
+                job.finish("failed", error=str(e), status=status)
+            else:
+                job.finish("done", result)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            self._evict()
+            states = [job.state for job in self._jobs.values()]
+        return {state: states.count(state) for state in ("queued", "running", "done", "failed")}
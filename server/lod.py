@@ -0,0 +1,430 @@
+"""
+Level-of-detail views of large dependency graphs.
+
+A program with thousands of variables produces a graph too large to draw. A view shows at
+most max_nodes elements, each either a variable or a cluster of variables:
+
+  1. Chains, runs of variables each used only by the next (which uses nothing else), are
+     collapsed into one cluster each, longest first, until the view fits.
+  2. If it still does not fit, neighbors in topological order are merged into "group"
+     clusters until it does, densest pair first: edges between them plus one, over the
+     product of their sizes. The extra edge lets small unconnected neighbors (a row of
+     inputs) merge before a large group grows further. Each group is an interval of the
+     topological order, so the clusters still form a DAG.
+
+Only the view is laid out and ordered, so time and response size follow max_nodes rather
+than program size. Expanding a cluster returns the view of its own subgraph, clustered
+again if it is still too large; its nested clusters are named after it ("cluster3.1").
+Views are computed fresh from the code on each call and come out the same every time, so
+cluster ids stay valid between calls made with the same max_nodes.
+"""
+import heapq
+import itertools
+import os
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from depgraph2 import (
+    VERTICAL_SPACING, Budget, GraphIndex, ProgramCache, generate_order, index_code, layout_node_positions,
+)
+
+# Elements shown by default in a view
+LOD_MAX_NODES = int(os.environ.get("DEPGRAPH_LOD_NODES", 200))
+
+class UnknownCluster(LookupError):
+    """Raised when a cluster id does not name a cluster of the view."""
+
+# ---------------------
+# Clustering
+# ---------------------
+
+def chains(index: GraphIndex) -> List[List[int]]:
+    """Maximal chains of at least two nodes, each in dependency order."""
+    offsets, user_offsets = index.dep_offsets, index.user_offsets
+    successor = array('i', [-1]) * len(index)
+    has_predecessor = bytearray(len(index))
+    for node in range(len(index)):
+        if user_offsets[node + 1] - user_offsets[node] == 1:
+            user = index.users[user_offsets[node]]
+            if offsets[user + 1] - offsets[user] == 1:
+                successor[node] = user
+                has_predecessor[user] = 1
+    runs = []
+    for node in index.topo:
+        if has_predecessor[node] or successor[node] == -1:
+            continue
+        run = [node]
+        while successor[run[-1]] != -1:
+            run.append(successor[run[-1]])
+        runs.append(run)
+    return runs
+
+def _collapse_chains(index: GraphIndex, max_nodes: int) -> Tuple[List[List[int]], List[bool]]:
+    """
+    Units of the view after collapsing the longest chains until at most max_nodes remain
+    (a chain covering the whole graph is never collapsed). Units are listed by the
+    topological position of their first node, which keeps them in topological order.
+    """
+    count = len(index)
+    collapsed: Dict[int, List[int]] = {}
+    for run in sorted(chains(index), key=len, reverse=True):
+        if count <= max_nodes:
+            break
+        if len(run) == len(index):
+            continue
+        collapsed[run[0]] = run
+        count -= len(run) - 1
+    inside = bytearray(len(index))
+    for run in collapsed.values():
+        for node in run[1:]:
+            inside[node] = 1
+    units, is_chain = [], []
+    for node in index.topo:
+        if inside[node]:
+            continue
+        run = collapsed.get(node)
+        units.append(run if run is not None else [node])
+        is_chain.append(run is not None)
+    return units, is_chain
+
+class _Group:
+    __slots__ = ("first", "last", "size", "previous", "next", "weights", "version")
+
+    def __init__(self, unit: int, size: int) -> None:
+        self.first = self.last = unit    # Groups are runs of consecutive units
+        self.size = size
+        self.previous: Optional["_Group"] = None
+        self.next: Optional["_Group"] = None
+        self.weights: Dict["_Group", int] = {}    # Edges to each neighboring group, either way
+        self.version = 0
+
+def _merge_groups(index: GraphIndex, units: List[List[int]], max_groups: int) -> List[List[int]]:
+    """
+    Merge consecutive units into at most max_groups groups, densest adjacent pair first
+    (average linkage); returns the unit numbers of each group.
+    """
+    unit_of = array('i', bytes(4 * len(index)))
+    for number, unit in enumerate(units):
+        for node in unit:
+            unit_of[node] = number
+    groups = [_Group(number, len(unit)) for number, unit in enumerate(units)]
+    for left, right in zip(groups, groups[1:]):
+        left.next, right.previous = right, left
+    for node in range(len(index)):
+        for dep in index.dependencies(node):
+            a, b = groups[unit_of[dep]], groups[unit_of[node]]
+            if a is not b:
+                a.weights[b] = a.weights.get(b, 0) + 1
+                b.weights[a] = b.weights.get(a, 0) + 1
+
+    heap = []
+    pushed = itertools.count()    # Keeps heap entries comparable without comparing groups
+
+    def push(left: _Group) -> None:
+        right = left.next
+        density = (left.weights.get(right, 0) + 1) / (left.size * right.size)
+        heapq.heappush(heap, (-density, left.size + right.size, left.first,
+                              left.version, right.version, next(pushed), left, right))
+
+    for left in groups[:-1]:
+        push(left)
+    count = len(groups)
+    while count > max_groups:
+        _, _, _, left_version, right_version, _, left, right = heapq.heappop(heap)
+        if left.next is not right or left.version != left_version or right.version != right_version:
+            continue
+        # The pair becomes one group: the one with more neighbors absorbs the other's table
+        kept, gone = (left, right) if len(left.weights) >= len(right.weights) else (right, left)
+        for neighbor, weight in gone.weights.items():
+            if neighbor is kept:
+                continue
+            kept.weights[neighbor] = kept.weights.get(neighbor, 0) + weight
+            del neighbor.weights[gone]
+            neighbor.weights[kept] = kept.weights[neighbor]
+        kept.weights.pop(gone, None)
+        kept.first, kept.last = left.first, right.last
+        kept.size = left.size + right.size
+        kept.version += 1
+        gone.version += 1
+        kept.previous, kept.next = left.previous, right.next
+        if kept.previous is not None:
+            kept.previous.next = kept
+        if kept.next is not None:
+            kept.next.previous = kept
+        if left is groups[0]:
+            groups[0] = kept
+        count -= 1
+        if kept.previous is not None:
+            push(kept.previous)
+        if kept.next is not None:
+            push(kept)
+
+    merged = []
+    group = groups[0] if groups else None
+    while group is not None:
+        merged.append(list(range(group.first, group.last + 1)))
+        group = group.next
+    return merged
+
+# ---------------------
+# Views
+# ---------------------
+
+class View:
+    """
+    One level of detail: a graph (the program's, or a cluster's subgraph) cut down to at
+    most max_nodes elements. nodes maps this graph's node ids to the program's; elements
+    lists the nodes of each element in topological order, and cluster_ids holds the id of
+    each element that is a cluster (None for single variables).
+    """
+
+    def __init__(self, index: GraphIndex, nodes: List[int], prefix: str, max_nodes: int) -> None:
+        self.index = index
+        self.nodes = nodes
+        if len(index) <= max_nodes:
+            self.elements = [[node] for node in index.topo]
+            kinds: List[Optional[str]] = [None] * len(index)
+        else:
+            units, is_chain = _collapse_chains(index, max_nodes)
+            if len(units) <= max_nodes:
+                self.elements = units
+                kinds = ["chain" if chain else None for chain in is_chain]
+            else:
+                self.elements, kinds = [], []
+                for group in _merge_groups(index, units, max_nodes):
+                    if len(group) == 1:
+                        self.elements.append(units[group[0]])
+                        kinds.append("chain" if is_chain[group[0]] else None)
+                    else:
+                        self.elements.append([node for unit in group for node in units[unit]])
+                        kinds.append("group")
+        self.kinds = kinds
+        self.cluster_ids: List[Optional[str]] = []
+        clusters = 0
+        for kind in kinds:
+            if kind is None:
+                self.cluster_ids.append(None)
+            else:
+                clusters += 1
+                self.cluster_ids.append(prefix + str(clusters))
+
+        self.element_of = array('i', bytes(4 * len(index)))
+        for number, element in enumerate(self.elements):
+            for node in element:
+                self.element_of[node] = number
+        # Elements are named by number; edge counts between them are kept for the response
+        self.edge_counts: Dict[Tuple[int, int], int] = {}
+        graph: Dict[str, List[str]] = {str(number): [] for number in range(len(self.elements))}
+        for node in range(len(index)):
+            target = self.element_of[node]
+            for dep in index.dependencies(node):
+                source = self.element_of[dep]
+                if source != target:
+                    key = (source, target)
+                    if key not in self.edge_counts:
+                        graph[str(target)].append(str(source))
+                    self.edge_counts[key] = self.edge_counts.get(key, 0) + 1
+        self.graph = GraphIndex(graph)
+
+    def cluster(self, cluster_id: str) -> int:
+        """Element number of a cluster of this view."""
+        for number, candidate in enumerate(self.cluster_ids):
+            if candidate == cluster_id:
+                return number
+        raise UnknownCluster(f"Unknown cluster '{cluster_id}'")
+
+    def expand(self, number: int, max_nodes: int) -> "View":
+        """The view of one cluster's subgraph."""
+        members = self.elements[number]
+        return View(GraphIndex(_subgraph(self.index, members)), [self.nodes[node] for node in members],
+                    self.cluster_ids[number] + ".", max_nodes)
+
+def _subgraph(index: GraphIndex, members: List[int]) -> Dict[str, List[str]]:
+    """The graph restricted to members, listed in the order given."""
+    names = index.names
+    inside = set(members)
+    return {names[node]: [names[dep] for dep in index.dependencies(node) if dep in inside] for node in members}
+
+def _element_id(root: GraphIndex, view: View, number: int) -> str:
+    cluster_id = view.cluster_ids[number]
+    return cluster_id if cluster_id is not None else root.node_id(view.nodes[view.elements[number][0]])
+
+def _element_key(root: GraphIndex, view: View, number: int) -> str:
+    """How an element appears in edge ids: node rank (as in /analyze) or cluster id."""
+    cluster_id = view.cluster_ids[number]
+    return cluster_id if cluster_id is not None else str(root.rank[view.nodes[view.elements[number][0]]])
+
+# ---------------------
+# Materialization
+# ---------------------
+
+def materialize_view(root: GraphIndex, view: View, budget: Optional[Budget] = None,
+                     timings: Optional[Dict[str, float]] = None) -> Dict:
+    """
+    Lay out and order a view and build its frontend payload: nodes, edges and order as in
+    /analyze, plus "clusters" describing each cluster node. Clusters have type "cluster"
+    and their label names their first and last variable.
+    """
+    clock = time.perf_counter
+    start = clock()
+    graph = view.graph
+    x_positions = layout_node_positions(graph, budget)
+    laid_out = clock()
+    steps = generate_order(graph, x_positions, budget)
+    ordered = clock()
+
+    # View node i is element i (elements are listed in graph order, so interned in that order)
+    ids = [_element_id(root, view, number) for number in range(len(view.elements))]
+    keys = [_element_key(root, view, number) for number in range(len(view.elements))]
+    nodes, clusters = [], {}
+    for number in graph.topo:
+        element = view.elements[number]
+        data = {"label": view.index.names[element[0]]}
+        if view.kinds[number] is not None:
+            mytype = "cluster"
+            data["label"] = f"{view.index.names[element[0]]} … {view.index.names[element[-1]]}"
+            data["size"] = len(element)
+            clusters[ids[number]] = {"kind": view.kinds[number], "size": len(element)}
+        elif graph.is_output(number):
+            mytype = "customoutput"
+        elif graph.is_input(number):
+            mytype = "custominput"
+        else:
+            mytype = "step"
+        nodes.append({
+            "id": ids[number],
+            "mytype": mytype,
+            "data": data,
+            "position": {"x": x_positions[number], "y": graph.depth[number] * VERTICAL_SPACING},
+            "style": {"borderRadius": "50%", "width": 100, "height": 100}
+        })
+
+    edge_ids = []
+    edges = []
+    for target in range(len(graph)):
+        for edge in range(graph.dep_offsets[target], graph.dep_offsets[target + 1]):
+            source = graph.deps[edge]
+            edge_ids.append("edge" + keys[source] + "-" + keys[target])
+            edges.append({
+                "id": edge_ids[-1],
+                "source": ids[source],
+                "target": ids[target],
+                "type": "straight",
+                "style": {"stroke": "#00FFCC", "strokeWidth": 2},
+                "data": {"edges": view.edge_counts[(source, target)]}
+            })
+    order = [[edge_ids[item] if is_edge else ids[item], color] for is_edge, item, color in steps]
+    if timings is not None:
+        timings.update({"layout": laid_out - start, "order": ordered - laid_out, "materialize": clock() - ordered})
+    return {"nodes": nodes, "edges": edges, "order": order, "clusters": clusters}
+
+def _boundary(root: GraphIndex, path: List[View], number: int, inner: View, max_nodes: int) -> Tuple[List[Dict], int]:
+    """
+    Edges between an expanded cluster and the rest of what is shown: each links an element
+    of the cluster's view to the element around it that holds the other end, taken from
+    the innermost view along path that still shows that end, and counts the dependencies it
+    stands for in data.edges. Only the max_nodes links standing for the most dependencies
+    are kept; also returns how many were left out.
+    """
+    member_nodes = {path[-1].nodes[node] for node in path[-1].elements[number]}
+    local = {node: i for i, node in enumerate(inner.nodes)}
+    positions = [{node: i for i, node in enumerate(view.nodes)} for view in path]
+
+    def outside(node: int) -> Tuple[str, str]:
+        for view, position in zip(reversed(path), reversed(positions)):
+            if node in position:
+                element = view.element_of[position[node]]
+                return _element_key(root, view, element), _element_id(root, view, element)
+        raise AssertionError("every node is in the program's view")
+
+    links: Dict[str, Dict] = {}
+
+    def link(edge_id: str, source: str, target: str) -> None:
+        entry = links.get(edge_id)
+        if entry is None:
+            links[edge_id] = {"id": edge_id, "source": source, "target": target, "data": {"edges": 1}}
+        else:
+            entry["data"]["edges"] += 1
+
+    for program_node in inner.nodes:
+        element = inner.element_of[local[program_node]]
+        inner_key, inner_id = _element_key(root, inner, element), _element_id(root, inner, element)
+        for dep in root.dependencies(program_node):
+            if dep not in member_nodes:
+                key, element_id = outside(dep)
+                link("edge" + key + "-" + inner_key, element_id, inner_id)
+        for pos in range(root.user_offsets[program_node], root.user_offsets[program_node + 1]):
+            user = root.users[pos]
+            if user not in member_nodes:
+                key, element_id = outside(user)
+                link("edge" + inner_key + "-" + key, inner_id, element_id)
+    boundary = list(links.values())
+    if len(boundary) > max_nodes:    # Heaviest first; ties keep the order they were found in
+        boundary = sorted(boundary, key=lambda entry: -entry["data"]["edges"])[:max_nodes]
+    return boundary, len(links) - len(boundary)
+
+# ---------------------
+# Main Process Functions
+# ---------------------
+
+def _program_view(code: str, max_nodes: int, budget: Budget, timings: Dict[str, float]) -> Tuple[GraphIndex, View]:
+    """The program's graph and its view."""
+    _, index = index_code(code, budget, timings)
+    start = time.perf_counter()
+    view = View(index, list(range(len(index))), "cluster", max_nodes)
+    timings["cluster"] = time.perf_counter() - start
+    return index, view
+
+# Kept for the expansions that usually follow, which start from the same view
+_program_views = ProgramCache(_program_view)
+
+def analyze_lod(code: str, max_nodes: int = LOD_MAX_NODES, budget: Optional[Budget] = None,
+                timings: Optional[Dict[str, float]] = None) -> Dict:
+    """
+    The level-of-detail view of a program: the /analyze payload of at most max_nodes
+    elements, with "clusters" listing each cluster's kind and size, and "stats" counting the
+    program's nodes and edges.
+    """
+    budget = budget if budget is not None else Budget()
+    budget.start()
+    timings = timings if timings is not None else {}
+    index, view = _program_views.get(code, max_nodes, budget=budget, timings=timings)
+    result = materialize_view(index, view, budget, timings)
+    result["stats"] = {"nodes": len(index), "edges": index.edge_count, "visible": len(view.elements)}
+    if budget.degraded:
+        result["degraded"] = budget.degraded
+    return result
+
+def expand_cluster(code: str, cluster_id: str, max_nodes: int = LOD_MAX_NODES, budget: Optional[Budget] = None,
+                   timings: Optional[Dict[str, float]] = None) -> Dict:
+    """
+    The view of one cluster (an id from analyze_lod or an earlier expansion, computed with
+    the same max_nodes): its elements laid out around x = 0, their edges and order, plus
+    at most max_nodes "boundary" edges linking them to the elements around the cluster
+    ("boundary_omitted" counts the rest).
+    Raises UnknownCluster if the id names no cluster.
+    """
+    budget = budget if budget is not None else Budget()
+    budget.start()
+    timings = timings if timings is not None else {}
+    index, view = _program_views.get(code, max_nodes, budget=budget, timings=timings)
+    start = time.perf_counter()
+    if not cluster_id.startswith("cluster"):
+        raise UnknownCluster(f"Unknown cluster '{cluster_id}'")
+    # "cluster3.1" is cluster 1 of the view of cluster3
+    path = [view]
+    parts = cluster_id[len("cluster"):].split(".")
+    for depth in range(len(parts)):
+        number = path[-1].cluster("cluster" + ".".join(parts[:depth + 1]))
+        inner = path[-1].expand(number, max_nodes)
+        if depth < len(parts) - 1:
+            path.append(inner)
+    timings["expand"] = time.perf_counter() - start
+    result = materialize_view(index, inner, budget, timings)
+    result["boundary"], omitted = _boundary(index, path, number, inner, max_nodes)
+    if omitted:
+        result["boundary_omitted"] = omitted
+    if budget.degraded:
+        result["degraded"] = budget.degraded
+    return result
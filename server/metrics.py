@@ -0,0 +1,116 @@
+import threading
+from bisect import bisect_left
+from typing import Dict, List, Sequence, Tuple
+
+# ---------------------
+# Histograms
+# ---------------------
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+class Histogram:
+    """
+    Prometheus-style cumulative histogram with one series per label value.
+    Observing is a bisect and two additions under a lock; text is only rendered on scrape.
+    """
+
+    def __init__(self, name: str, help_text: str, label: str, buckets: Sequence[float]) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series: Dict[str, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float) -> None:
+        slot = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][slot] += 1
+            series[1][0] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {key: (list(counts), total[0]) for key, (counts, total) in self._series.items()}
+        for label_value in sorted(snapshot):
+            counts, total = snapshot[label_value]
+            label = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound:g}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {total!r}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+# ---------------------
+# Counters
+# ---------------------
+
+class Counter:
+    """Prometheus-style monotonic counter with one series per label value."""
+
+    def __init__(self, name: str, help_text: str, label: str) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._series: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value: str, amount: float = 1) -> None:
+        with self._lock:
+            self._series[label_value] = self._series.get(label_value, 0) + amount
+
+    def value(self, label_value: str) -> float:
+        with self._lock:
+            return self._series.get(label_value, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = dict(self._series)
+        for label_value in sorted(snapshot):
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {snapshot[label_value]!r}')
+        return lines
+
+# ---------------------
+# Registry
+# ---------------------
+
+stage_seconds = Histogram(
+    "depgraph_stage_seconds", "Wall time spent in each process_code stage.", "stage", LATENCY_BUCKETS)
+request_seconds = Histogram(
+    "depgraph_request_seconds", "Wall time to produce an /analyze response, by cache outcome.", "cache", LATENCY_BUCKETS)
+endpoint_seconds = Histogram(
+    "depgraph_endpoint_seconds", "Wall time to produce responses of the other analysis endpoints, by endpoint.",
+    "endpoint", LATENCY_BUCKETS)
+analyses_total = Counter(
+    "depgraph_analyses_total", "/analyze cache misses that ran an analysis or shared an identical in-flight one.", "outcome")
+analysis_cpu_seconds = Counter(
+    "depgraph_analysis_cpu_seconds_total", "CPU time spent running analyses, by where they ran.", "runner")
+graph_size = Histogram(
+    "depgraph_graph_size", "Size of analyzed dependency graphs.", "measure", SIZE_BUCKETS)
+
+REGISTRY = [stage_seconds, request_seconds, endpoint_seconds, graph_size, analyses_total, analysis_cpu_seconds]
+
+def record_analysis(timings: Dict[str, float], stats: Dict[str, int]) -> None:
+    for stage, seconds in timings.items():
+        stage_seconds.observe(stage, seconds)
+    for measure, value in stats.items():
+        graph_size.observe(measure, value)
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """Format stage timings (seconds) as a Server-Timing header value in milliseconds."""
+    return ", ".join(f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in timings.items())
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,221 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from batch import analyze_batch
+from components import component_executor, process_code_by_components
+from depgraph2 import (SUGIYAMA_MAX_DUMMIES, SUGIYAMA_THRESHOLD, Budget, BudgetExceeded, analysis_budget,
+                       process_code)
+from metrics import analysis_cpu_seconds
+from structure import StructureCache
+from wire import encode
+
+class PoolBusy(Exception):
+    """Raised when every worker is busy and the wait queue is full."""
+
+class AnalysisTimeout(Exception):
+    """Raised when an analysis does not finish within the per-request timeout."""
+
+# ---------------------
+# Analysis
+# ---------------------
+
+# DEPGRAPH_COMPONENTS=1 analyzes graphs per connected component, cached in each process. Off by
+# default: the other endpoints lay out whole graphs, and both layouts should agree across endpoints.
+SPLIT_COMPONENTS = os.environ.get("DEPGRAPH_COMPONENTS", "0") == "1"
+_components = StructureCache()
+
+# Settings that change what render_analysis returns for the same code (see cache.code_fingerprint)
+LAYOUT_SETTINGS = f"sugiyama={SUGIYAMA_THRESHOLD},{SUGIYAMA_MAX_DUMMIES};components={int(SPLIT_COMPONENTS)}"
+
+def render_analysis(code: str, timings: Optional[Dict[str, float]] = None, budget: Optional[Budget] = None,
+                    compact: bool = False, progress: Optional[Callable[[str], None]] = None
+                    ) -> Tuple[bytes, Dict[str, int], List[str]]:
+    """
+    Run process_code_by_components (or process_code) under a budget (analysis_budget() by
+    default) and return the serialized /analyze payload (in the compact wire format if
+    requested), the graph stats and the list of shortcuts taken to stay within budget.
+    progress is passed on to report each stage as it finishes.
+    """
+    budget = budget if budget is not None else analysis_budget()
+    if SPLIT_COMPONENTS:
+        result = process_code_by_components(code, _components, timings, budget, component_executor(), progress)
+    else:
+        result = process_code(code, timings, budget, progress)
+    payload = {
+        "nodes": result["positioned_nodes"],
+        "edges": result["edges"],
+        "order": result["order"]
+    }
+    if result["merged"]:
+        payload["merged"] = result["merged"]
+    if result["degraded"]:
+        payload["degraded"] = result["degraded"]
+    return encode(payload, compact), result["stats"], result["degraded"]
+
+def render_batch(programs: Dict[str, str], timings: Optional[Dict[str, float]] = None,
+                 progress: Optional[Callable[[str], None]] = None) -> Tuple[bytes, Dict[str, int], List[str]]:
+    """
+    Analyze a batch of programs one after another (see batch.analyze_batch) and return the
+    serialized /analyze/batch payload, with the same contract as render_analysis. The stats
+    count the programs and the entries that failed.
+    """
+    start = time.perf_counter()
+    results = analyze_batch(programs, parallel=False)
+    if timings is not None:
+        timings["batch"] = time.perf_counter() - start
+    stats = {"programs": len(results), "errors": sum(1 for result in results.values() if "error" in result)}
+    return encode({"results": results}), stats, []
+
+# Work a pool worker can be asked to do, by name; each takes its arguments by keyword plus
+# timings and progress, and returns (body, stats, degraded) as render_analysis does.
+TASKS = {
+    "analyze": render_analysis,
+    "batch": render_batch,
+}
+
+def _worker_main(conn) -> None:
+    """
+    Worker loop: receive (task name, keyword arguments), send ("stage", name) as each stage
+    finishes, then reply with ("ok", body, stats, degraded, timings), ("budget", message) or
+    ("error", message), followed by the CPU seconds the task took.
+    """
+    while True:
+        try:
+            task, arguments = conn.recv()
+        except EOFError:
+            return
+        timings = {}
+        cpu_start = time.process_time()
+        try:
+            body, stats, degraded = TASKS[task](timings=timings, progress=lambda stage: conn.send(("stage", stage)),
+                                                **arguments)
+            reply = ("ok", body, stats, degraded, timings)
+        except BudgetExceeded as e:
+            reply = ("budget", str(e))
+        except Exception as e:
+            reply = ("error", str(e))
+        conn.send(reply + (time.process_time() - cpu_start,))
+
+# ---------------------
+# Worker Pool
+# ---------------------
+
+class _Worker:
+    def __init__(self, context) -> None:
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+class AnalysisPool:
+    """
+    Fixed pool of preforked analysis workers behind a bounded wait queue.
+    At most workers + queue_depth requests are admitted at once; beyond that run() fails
+    fast with PoolBusy. A request that does not finish within timeout seconds (including
+    time spent queued) raises AnalysisTimeout, and its worker is killed and replaced.
+    """
+
+    def __init__(self, workers: int, queue_depth: int, timeout: float) -> None:
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self._context = multiprocessing.get_context(
+            "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        )
+        self._admission = threading.BoundedSemaphore(workers + queue_depth)
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        for _ in range(workers):
+            self._idle.put(_Worker(self._context))
+
+    def acquire_slot(self) -> None:
+        """
+        Reserve one admission slot, raising PoolBusy if none is free.
+        Used directly by work that runs outside the workers (such as streaming responses)
+        so it still counts against the same limit; pair with release_slot().
+        """
+        if not self._admission.acquire(blocking=False):
+            raise PoolBusy("Analysis queue is full")
+
+    def release_slot(self) -> None:
+        self._admission.release()
+
+    def run(self, code: str, timings: Optional[Dict[str, float]] = None, compact: bool = False,
+            progress: Optional[Callable[[str], None]] = None, budget: Optional[Budget] = None,
+            timeout: Optional[float] = None, wait: bool = False) -> Tuple[bytes, Dict[str, int], List[str]]:
+        """
+        Analyze code on a pool worker; same contract as render_analysis. timeout replaces the
+        pool's own, and with wait the call waits for an admission slot and a worker instead
+        of failing fast, and the timeout only starts once a worker has the task.
+        """
+        return self._call("analyze", {"code": code, "compact": compact, "budget": budget}, timings, progress,
+                          timeout, wait)
+
+    def run_batch(self, programs: Dict[str, str],
+                  timings: Optional[Dict[str, float]] = None) -> Tuple[bytes, Dict[str, int], List[str]]:
+        """Analyze a batch of programs on one pool worker; same contract as render_batch."""
+        return self._call("batch", {"programs": programs}, timings)
+
+    def _call(self, task: str, arguments: Dict, timings: Optional[Dict[str, float]] = None,
+              progress: Optional[Callable[[str], None]] = None, timeout: Optional[float] = None,
+              wait: bool = False) -> Tuple[bytes, Dict[str, int], List[str]]:
+        """Run one of TASKS on a pool worker within the admission limit and the timeout (see run)."""
+        timeout = timeout if timeout is not None else self.timeout
+        if wait:
+            self._admission.acquire()
+        else:
+            self.acquire_slot()
+        try:
+            deadline = time.monotonic() + timeout
+            try:
+                worker = self._idle.get(timeout=None if wait else timeout)
+            except queue.Empty:
+                raise AnalysisTimeout("Timed out waiting for a free analysis worker")
+            if wait:
+                deadline = time.monotonic() + timeout
+            replied = False    # Only a worker whose pipe holds nothing more of this request is reused
+            try:
+                worker.conn.send((task, arguments))
+                while True:
+                    if not worker.conn.poll(max(0.0, deadline - time.monotonic())):
+                        raise AnalysisTimeout(f"Analysis exceeded {timeout:g}s and was cancelled")
+                    reply = worker.conn.recv()
+                    if reply[0] != "stage":
+                        break
+                    if progress is not None:
+                        progress(reply[1])
+                replied = True
+            except (EOFError, OSError):
+                raise RuntimeError("Analysis worker exited unexpectedly")
+            finally:
+                if not replied:    # Timed out, died, or interrupted (by progress or otherwise) mid-request
+                    worker.kill()
+                    worker = _Worker(self._context)
+                self._idle.put(worker)
+        finally:
+            self.release_slot()
+
+        analysis_cpu_seconds.inc("pool", reply[-1])
+        if reply[0] == "budget":
+            raise BudgetExceeded(reply[1])
+        if reply[0] == "error":
+            raise ValueError(reply[1])
+        _, body, stats, degraded, worker_timings, _ = reply
+        if timings is not None:
+            timings.update(worker_timings)
+        return body, stats, degraded
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().kill()
+            except queue.Empty:
+                return
@@ -0,0 +1,192 @@
+"""
+Scope-by-scope views of a program's dependency graph.
+
+GraphExtractor names the variables of a function or class after their scope ("f.x",
+"Point.move.self"), and the name a def or class binds depends on what the body returns.
+That splits the graph into levels, one per scope:
+
+  - The module level holds the module's variables, with everything inside a top-level
+    function or class folded into the node of its name. It summarizes how data flows between
+    module variables, functions and classes.
+  - The level of a scope holds that scope's variables, with nested scopes folded the same
+    way and the variables it reads from enclosing scopes shown as inputs.
+
+Only the module level is laid out when a program is opened; a scope's level is laid out and
+ordered when it is opened. Results are cached by the hash of the level's graph, so a scope
+whose body did not change is not analyzed again after an edit elsewhere in the program, and
+one opened twice costs only the lookup.
+"""
+import hashlib
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+
+from depgraph2 import (
+    Budget, GraphIndex, ProgramCache, extract_graph, generate_edges, generate_order, graph_stats,
+    layout_node_positions, materialize_nodes, materialize_order,
+)
+from structure import StructureCache, _Structure
+
+class UnknownScope(LookupError):
+    """Raised when a scope name does not name a function or class with variables of its own."""
+
+# ---------------------
+# Levels
+# ---------------------
+
+Items = List[Tuple[str, List[str]]]
+
+def scope_level(items: Items, prefix: str) -> Tuple[Dict[str, List[str]], Dict[str, Items]]:
+    """
+    The graph of one level from the variables under prefix ("" for the module, "f." for the
+    scope f): variables of nested scopes fold into the node of their scope, and dependencies
+    from outside the level are kept as they are. Also returns the variables of each nested
+    scope, by scope name.
+    """
+    level: Dict[str, Dict[str, None]] = {}
+    children: Dict[str, Items] = {}
+
+    def fold(name: str) -> str:
+        if not name.startswith(prefix):
+            return name
+        head, dot, _ = name[len(prefix):].partition(".")
+        return prefix + head if dot else name
+
+    for target, deps in items:
+        node = fold(target)
+        if node != target:
+            children.setdefault(node, []).append((target, deps))
+        node_deps = level.setdefault(node, {})
+        for dep in deps:
+            dep = fold(dep)
+            if dep != node:
+                node_deps[dep] = None
+    return {node: list(deps) for node, deps in level.items()}, children
+
+def level_hash(level: Dict[str, List[str]]) -> str:
+    """Hash of a level's graph; levels with equal hashes get the same layout and order."""
+    return hashlib.sha256(json.dumps(level, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+# ---------------------
+# Analysis
+# ---------------------
+
+# Analyzed levels, by level_hash
+_levels = StructureCache()
+
+def _analyze_level(level: Dict[str, List[str]], fingerprint: str, budget: Budget) -> _Structure:
+    """The layout and order of a level, from _levels unless it was never analyzed."""
+    entry = _levels.get(fingerprint)
+    if entry is None:
+        degraded = len(budget.degraded)
+        index = GraphIndex(level)
+        x_positions = layout_node_positions(index, budget)
+        entry = _Structure(index, x_positions, generate_order(index, x_positions, budget))
+        if len(budget.degraded) == degraded:
+            _levels.put(fingerprint, entry)
+    return entry
+
+def _label(name: str, prefix: str) -> str:
+    """A node's name with the level's scope left out, one variable at a time for merged nodes."""
+    return ", ".join(part[len(prefix):] if part.startswith(prefix) else part for part in name.split(", "))
+
+class _Program:
+    """
+    A program's graph grouped by scope. Each level is built, and hashed, the first time it
+    or the level around it is opened, and then kept with the program.
+    """
+
+    def __init__(self, graph: Dict[str, List[str]]) -> None:
+        self.members: Dict[str, Items] = {}    # Variables under each scope, nested ones included
+        for target, deps in graph.items():
+            self.members.setdefault("", []).append((target, deps))
+            parts = target.split(".")
+            for depth in range(1, len(parts)):
+                self.members.setdefault(".".join(parts[:depth]), []).append((target, deps))
+        self._levels: Dict[str, Tuple[Dict[str, List[str]], str, List[str]]] = {}
+
+    def level(self, scope: str) -> Tuple[Dict[str, List[str]], str, List[str]]:
+        """The graph of a scope's level, its level_hash and its nested scopes. Raises UnknownScope."""
+        entry = self._levels.get(scope)
+        if entry is None:
+            items = self.members.get(scope)
+            if not items:
+                raise UnknownScope(f"Unknown scope '{scope}'")
+            level, children = scope_level(items, scope + "." if scope else "")
+            entry = self._levels[scope] = (level, level_hash(level), list(children))
+        return entry
+
+    def scopes(self, scope: str) -> Dict[str, Dict]:
+        """The nested scopes of a level, each with its variable count and level hash."""
+        return {
+            child: {"variables": len(self.members[child]), "hash": self.level(child)[1]}
+            for child in self.level(scope)[2]
+        }
+
+def _program(code: str, budget: Budget, timings: Dict[str, float]) -> _Program:
+    """The program grouped by scope."""
+    graph = extract_graph(code, budget, timings)
+    start = time.perf_counter()
+    program = _Program(graph)
+    timings["group"] = time.perf_counter() - start
+    return program
+
+# Kept for the scopes opened after it, which start from the same code and reuse the levels already built
+_programs = ProgramCache(_program)
+
+# ---------------------
+# Main Process Function
+# ---------------------
+
+def open_scope(code: str, scope: str = "", budget: Optional[Budget] = None,
+               timings: Optional[Dict[str, float]] = None) -> Dict:
+    """
+    The view of one level of a program: the module level if scope is "", otherwise the
+    level of the function or class named scope ("f", "Point.move"), as listed under
+    "scopes" by the level around it. Replies with the /analyze payload of the level (node
+    labels drop the scope's prefix; nodes standing for nested scopes list them in
+    data.scopes, and variables from enclosing scopes are marked data.external), its "hash",
+    its nested "scopes" and its "stats".
+    Raises UnknownScope if scope names no level.
+    """
+    budget = budget if budget is not None else Budget()
+    budget.start()
+    timings = timings if timings is not None else {}
+    clock = time.perf_counter
+    program = _programs.get(code, budget=budget, timings=timings)
+
+    start = clock()
+    level, fingerprint, children = program.level(scope)
+    scopes = program.scopes(scope)
+    sliced = clock()
+    shared = _analyze_level(level, fingerprint, budget)
+    analyzed = clock()
+
+    index = shared.index
+    prefix = scope + "." if scope else ""
+    nested_scopes = set(children)
+    nodes = materialize_nodes(index, shared.x_positions)
+    for node, item in zip(index.topo, nodes):
+        name = index.names[node]
+        item["data"]["label"] = _label(name, prefix)
+        nested = [part for part in name.split(", ") if part in nested_scopes]
+        if nested:
+            item["data"]["scopes"] = nested
+        elif not name.startswith(prefix):
+            item["data"]["external"] = True
+    stats = graph_stats(index)
+    stats["variables"] = len(program.members[scope])
+    result = {
+        "scope": scope,
+        "hash": fingerprint,
+        "nodes": nodes,
+        "edges": generate_edges(index),
+        "order": materialize_order(index, shared.steps),
+        "scopes": scopes,
+        "merged": index.merged,
+        "stats": stats,
+    }
+    if budget.degraded:
+        result["degraded"] = budget.degraded
+    timings.update({"slice": sliced - start, "analyze": analyzed - sliced, "materialize": clock() - analyzed})
+    return result
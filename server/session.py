@@ -0,0 +1,162 @@
+"""
+Editing sessions that answer each program update with a diff of the graph.
+
+A session keeps the last graph, layout and order it sent and analyzes each new version of
+the program incrementally (see incremental.py). The first reply of a session is a full
+snapshot; later replies only carry what changed:
+
+    {"type": "snapshot", "seq": 1, "nodes": [...], "edges": [...], "order": [...]}
+    {"type": "diff", "seq": 2,
+     "nodes": {"added": [...], "removed": [ids], "moved": {id: {"x", "y"}}, "updated": [...]},
+     "edges": {"added": [...], "removed": [ids]},
+     "order": {"start": i, "delete": k, "insert": [[id, color], ...]}}
+    {"type": "error", "seq": 3, "error": "..."}
+
+Empty parts of a diff are left out. "order" replaces order[start:start + delete] with
+insert. Node ids are stable for the lifetime of a session: a variable keeps its id while
+other nodes are added or removed around it, unlike /analyze where ids follow the
+topological order. An update that fails (for example a syntax error while typing) leaves
+the session state as it was, so the next diff is against the last good graph.
+
+Updates run under the same Budget as /analyze: a program over its syntax node limit is an
+error reply, and a reply whose layout or order was cut short at the deadline lists the
+shortcuts under "degraded".
+"""
+from typing import Dict, List, Optional
+
+from depgraph2 import Budget
+from incremental import IncrementalAnalyzer
+
+def _order_splice(old: List[List[str]], new: List[List[str]]) -> Optional[Dict]:
+    """Smallest single replacement turning old into new, or None if they are equal."""
+    if old == new:
+        return None
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    limit -= prefix
+    while suffix < limit and old[len(old) - 1 - suffix] == new[len(new) - 1 - suffix]:
+        suffix += 1
+    return {"start": prefix, "delete": len(old) - prefix - suffix, "insert": new[prefix:len(new) - suffix]}
+
+def diff_payloads(old: Dict, new: Dict) -> Dict:
+    """Describe how to turn one session payload into the next (see the module docstring)."""
+    diff = {}
+    old_nodes = {node["id"]: node for node in old["nodes"]}
+    new_nodes = {node["id"]: node for node in new["nodes"]}
+    added, moved, updated = [], {}, []
+    for node_id, node in new_nodes.items():
+        previous = old_nodes.get(node_id)
+        if previous is None:
+            added.append(node)
+        elif previous != node:
+            if previous["position"] != node["position"]:
+                moved[node_id] = node["position"]
+            if {**previous, "position": None} != {**node, "position": None}:
+                updated.append(node)
+    removed = [node_id for node_id in old_nodes if node_id not in new_nodes]
+    nodes = {"added": added, "removed": removed, "moved": moved, "updated": updated}
+    nodes = {key: value for key, value in nodes.items() if value}
+    if nodes:
+        diff["nodes"] = nodes
+
+    old_edges = {edge["id"] for edge in old["edges"]}
+    new_edges = {edge["id"] for edge in new["edges"]}
+    edges = {
+        "added": [edge for edge in new["edges"] if edge["id"] not in old_edges],
+        "removed": [edge["id"] for edge in old["edges"] if edge["id"] not in new_edges],
+    }
+    edges = {key: value for key, value in edges.items() if value}
+    if edges:
+        diff["edges"] = edges
+
+    order = _order_splice(old["order"], new["order"])
+    if order is not None:
+        diff["order"] = order
+    return diff
+
+def apply_diff(payload: Dict, diff: Dict) -> Dict:
+    """Apply a diff to a session payload (what a client does); node and edge lists are unordered."""
+    nodes = {node["id"]: node for node in payload["nodes"]}
+    node_diff = diff.get("nodes", {})
+    for node_id in node_diff.get("removed", ()):
+        del nodes[node_id]
+    for node in node_diff.get("added", []) + node_diff.get("updated", []):
+        nodes[node["id"]] = node
+    for node_id, position in node_diff.get("moved", {}).items():
+        nodes[node_id] = {**nodes[node_id], "position": position}
+
+    edge_diff = diff.get("edges", {})
+    removed = set(edge_diff.get("removed", ()))
+    edges = [edge for edge in payload["edges"] if edge["id"] not in removed] + edge_diff.get("added", [])
+
+    order = list(payload["order"])
+    if "order" in diff:
+        splice = diff["order"]
+        order[splice["start"]:splice["start"] + splice["delete"]] = splice["insert"]
+    return {"nodes": list(nodes.values()), "edges": edges, "order": order}
+
+class AnalysisSession:
+    """
+    Per-connection analysis state: the incremental analyzer and the last payload sent.
+    With stable_layout, positions are warm-started from the previous layout so unchanged
+    nodes keep their places (see depgraph2.stable_node_positions).
+    """
+
+    def __init__(self, stable_layout: bool = False) -> None:
+        self.analyzer = IncrementalAnalyzer(stable_layout)
+        self.seq = 0
+        self._numbers: Dict[str, str] = {}     # variable name -> stable node number
+        self._result: Optional[Dict] = None
+        self._payload: Optional[Dict] = None
+
+    def _number(self, label: str) -> str:
+        number = self._numbers.get(label)
+        if number is None:
+            number = self._numbers[label] = str(len(self._numbers) + 1)
+        return number
+
+    def _stable_payload(self, result: Dict) -> Dict:
+        """Rename the nodes, edges and order of a process_code result to session ids."""
+        renamed = {}
+        nodes = []
+        for node in result["positioned_nodes"]:
+            number = self._number(node["data"]["label"])
+            renamed[node["id"]] = "node" + number
+            nodes.append({**node, "id": "node" + number})
+        edges = []
+        for edge in result["edges"]:
+            source, target = renamed[edge["source"]], renamed[edge["target"]]
+            edge_id = "edge" + source[4:] + "-" + target[4:]
+            renamed[edge["id"]] = edge_id
+            edges.append({**edge, "id": edge_id, "source": source, "target": target})
+        order = [[renamed[element], color] for element, color in result["order"]]
+        return {"nodes": nodes, "edges": edges, "order": order}
+
+    def update(self, code: str, snapshot: bool = False, budget: Optional[Budget] = None) -> Dict:
+        """
+        Analyze the next version of the program and return the reply message: a snapshot
+        for the first update (or when asked for), a diff otherwise. Analysis errors propagate.
+        """
+        result = self.analyzer.update(code, budget)
+        self.seq += 1
+        if result is not self._result:
+            self._result = result
+            payload = self._stable_payload(result)
+        else:
+            payload = self._payload     # The edit did not change the graph
+        previous, self._payload = self._payload, payload
+        if previous is None or snapshot:
+            reply = {"type": "snapshot", "seq": self.seq, **payload}
+        else:
+            diff = {} if payload is previous else diff_payloads(previous, payload)
+            reply = {"type": "diff", "seq": self.seq, **diff}
+        if result["degraded"]:
+            reply["degraded"] = result["degraded"]
+        return reply
+
+    def error(self, message: str) -> Dict:
+        self.seq += 1
+        return {"type": "error", "seq": self.seq, "error": message}
@@ -0,0 +1,141 @@
+"""
+Replay an editing trace against a running server, once through POST /analyze and once
+through a /session WebSocket, and compare bytes on the wire and latency.
+
+Two kinds of traces are generated from a program:
+  - typing: the program is typed one word at a time (many states do not parse yet),
+  - edits: the finished program receives a series of one-statement edits, either a
+    constant term toggled (the graph is unchanged) or a dependency swapped for another
+    variable defined earlier.
+
+    python session_client.py --trace typing
+    python session_client.py --trace edits --size 1000 --edits 200 --url http://127.0.0.1:5001
+
+Byte counts cover request and response bodies (WebSocket message text), not HTTP
+headers or frame overhead.
+"""
+import argparse
+import http.client
+import json
+import random
+import re
+import statistics
+import sys
+import time
+from typing import Dict, List
+from urllib.parse import urlsplit
+
+import simple_websocket
+
+from bench import random_program
+
+_NAME = re.compile(r"\b[A-Za-z_]\w*\b")
+
+# ---------------------
+# Editing Traces
+# ---------------------
+
+def typing_trace(code: str) -> List[str]:
+    """Every state of the buffer while the program is typed one word at a time."""
+    states = []
+    lines = code.split("\n")
+    for i, line in enumerate(lines):
+        words = line.split(" ")
+        for j in range(1, len(words) + 1):
+            states.append("\n".join(lines[:i] + [" ".join(words[:j])]))
+    return states
+
+def edit_trace(code: str, count: int, seed: int = 0) -> List[str]:
+    """count successive one-statement edits of a finished program."""
+    rng = random.Random(seed)
+    lines = code.split("\n")
+    assignments = [i for i, line in enumerate(lines) if " = " in line and not line[:1].isspace()]
+    states = []
+    for _ in range(count):
+        at = rng.choice(assignments)
+        target, expr = lines[at].split(" = ", 1)
+        earlier = [lines[i].split(" = ", 1)[0] for i in assignments if i < at]
+        names = [m for m in _NAME.finditer(expr) if m.group() != "input" and m.group() != "float"]
+        if rng.random() < 0.5 or not earlier or not names:
+            expr = expr[:-4] if expr.endswith(" + 1") else expr + " + 1"
+        else:
+            name = rng.choice(names)
+            expr = expr[:name.start()] + rng.choice(earlier) + expr[name.end():]
+        lines[at] = f"{target} = {expr}"
+        states.append("\n".join(lines))
+    return states
+
+# ---------------------
+# Transports
+# ---------------------
+
+def replay_post(url: str, states: List[str], gzipped: bool = False) -> Dict:
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+    headers = {"Content-Type": "application/json"}
+    if gzipped:
+        headers["Accept-Encoding"] = "gzip"
+    sent = received = errors = 0
+    latencies = []
+    for code in states:
+        body = json.dumps({"Original": code})
+        start = time.perf_counter()
+        conn.request("POST", "/analyze", body, headers)
+        response = conn.getresponse()
+        data = response.read()
+        latencies.append(time.perf_counter() - start)
+        sent += len(body.encode("utf-8"))
+        received += len(data)
+        errors += response.status != 200
+    conn.close()
+    return {"sent": sent, "received": received, "errors": errors, "latencies": latencies}
+
+def replay_session(url: str, states: List[str]) -> Dict:
+    parts = urlsplit(url)
+    ws = simple_websocket.Client.connect(f"ws://{parts.netloc}/session")
+    sent = received = errors = 0
+    latencies = []
+    try:
+        for code in states:
+            message = json.dumps({"Original": code})
+            start = time.perf_counter()
+            ws.send(message)
+            reply = ws.receive()
+            latencies.append(time.perf_counter() - start)
+            sent += len(message.encode("utf-8"))
+            received += len(reply.encode("utf-8"))
+            errors += json.loads(reply)["type"] == "error"
+    finally:
+        ws.close()
+    return {"sent": sent, "received": received, "errors": errors, "latencies": latencies}
+
+def summarize(name: str, run: Dict) -> str:
+    latencies = sorted(run["latencies"])
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return (f"{name:<14} sent {run['sent']:>11,} B  received {run['received']:>12,} B  "
+            f"median {statistics.median(latencies) * 1000:7.2f}ms  p95 {p95 * 1000:7.2f}ms  errors {run['errors']}")
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Compare POST /analyze with /session diffs on an editing trace.")
+    parser.add_argument("--url", default="http://127.0.0.1:5001", help="server base URL")
+    parser.add_argument("--trace", choices=("typing", "edits"), default="edits")
+    parser.add_argument("--program", default="Original", help="program name from code.json")
+    parser.add_argument("--size", type=int, help="use a synthetic random program of this many variables instead")
+    parser.add_argument("--edits", type=int, default=100, help="number of edits in an edits trace")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.size:
+        code = random_program(args.size, args.seed)
+    else:
+        with open("code.json") as f:
+            code = json.load(f)["programs"][args.program]
+    states = typing_trace(code) if args.trace == "typing" else edit_trace(code, args.edits, args.seed)
+    print(f"{len(states)} states, final program {len(code.splitlines())} lines", file=sys.stderr)
+
+    print(summarize("POST", replay_post(args.url, states)))
+    print(summarize("POST+gzip", replay_post(args.url, states, gzipped=True)))
+    print(summarize("session", replay_session(args.url, states)))
+
+if __name__ == "__main__":
+    main()
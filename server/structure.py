@@ -0,0 +1,275 @@
+"""
+Structural fingerprints of dependency graphs, and analysis results shared between programs
+whose graphs have the same structure.
+
+Many submissions differ only in variable names. Their pruned graphs (GraphIndex, after
+cycles are merged) are isomorphic, so they can share one layout and one animation order:
+
+  1. Color refinement (1-dimensional Weisfeiler-Lehman) on an ordered partition. Nodes
+     start grouped by depth, height (longest path to an output) and degrees. A cell is split
+     whenever its nodes differ in how many dependencies or users they have in another cell.
+     Splitters are processed in position order, and only the neighbors of a splitter are
+     revisited, so names and ids never influence the result.
+  2. Tie-break. While some cell still holds several nodes, its last node is moved into a
+     cell of its own and the partition is refined again. A node's canonical label is its
+     final position.
+  3. Fingerprint: a SHA-256 of the canonically labelled adjacency.
+
+Equal fingerprints always mean isomorphic graphs. Conversely, isomorphic graphs get the same
+fingerprint whenever the nodes of each tied cell are interchangeable. That covers the
+symmetries programs actually have: inputs summed together, parallel chains, repeated
+blocks. Otherwise a cache entry is missed, but a wrong result is never returned.
+
+A structure is analyzed once, on its canonical graph, whose variables are named after their
+labels ("0", "1", ...). Each program then reuses that layout and order with its own names.
+Node ids and positions therefore depend on the structure alone, and may differ from those
+process_code gives the same program.
+"""
+import copy
+import hashlib
+import heapq
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from depgraph2 import (
+    Budget, GraphIndex, generate_edges, generate_order, graph_stats, index_code, layout_node_positions,
+    materialize_nodes, materialize_order,
+)
+
+# ---------------------
+# Canonical Labeling
+# ---------------------
+
+def _heights(index: GraphIndex) -> array:
+    """Longest path from each node to an output (0 for outputs)."""
+    height = array('i', bytes(4 * len(index)))
+    for node in reversed(index.topo):
+        for pos in range(index.user_offsets[node], index.user_offsets[node + 1]):
+            user_height = height[index.users[pos]] + 1
+            if user_height > height[node]:
+                height[node] = user_height
+    return height
+
+class _Partition:
+    """
+    Ordered partition of the nodes: order lists every node, each cell is a contiguous range
+    of it and is named by where it starts. Cells only ever split, and a split keeps the
+    nodes that stay behind at the front, so a cell keeps its name.
+    """
+
+    def __init__(self, index: GraphIndex) -> None:
+        n = len(index)
+        self.index = index
+        heights = _heights(index)
+        keys = [
+            (index.depth[node], heights[node], index.dep_offsets[node + 1] - index.dep_offsets[node],
+             index.user_offsets[node + 1] - index.user_offsets[node])
+            for node in range(n)
+        ]
+        self.order = sorted(range(n), key=keys.__getitem__)
+        self.pos = array('i', bytes(4 * n))
+        self.cell = array('i', bytes(4 * n))        # Start of the cell holding each node
+        self.cell_end = array('i', bytes(4 * n))    # End of the cell starting at each position
+        self.queued = bytearray(n)
+        self.splitters: List[int] = []
+        start = 0
+        for i, node in enumerate(self.order):
+            self.pos[node] = i
+            if keys[node] != keys[self.order[start]]:
+                self._add_cell(start, i)
+                start = i
+            self.cell[node] = start
+        if n:
+            self._add_cell(start, n)
+
+    def _add_cell(self, start: int, end: int) -> None:
+        self.cell_end[start] = end
+        self.queued[start] = 1
+        heapq.heappush(self.splitters, start)
+
+    def refine(self) -> None:
+        """
+        Split cells until every node of a cell has as many dependencies and as many users in
+        each other cell as the rest of its cell (color refinement). Splitters are taken in
+        position order, so the result depends only on the structure and on the
+        individualized nodes.
+        """
+        index, cell, order = self.index, self.cell, self.order
+        while self.splitters:
+            start = heapq.heappop(self.splitters)
+            self.queued[start] = 0
+            counts: Dict[int, List[int]] = {}
+            for node in order[start:self.cell_end[start]]:
+                for pos in range(index.user_offsets[node], index.user_offsets[node + 1]):
+                    counts.setdefault(index.users[pos], [0, 0])[0] += 1
+                for dep in index.dependencies(node):
+                    counts.setdefault(dep, [0, 0])[1] += 1
+            touched: Dict[int, List[int]] = {}
+            for node in counts:
+                touched.setdefault(cell[node], []).append(node)
+            for cell_start, nodes in touched.items():
+                self._split(cell_start, nodes, counts)
+
+    def _split(self, start: int, nodes: List[int], counts: Dict[int, List[int]]) -> None:
+        """Split a cell by the counts of its touched nodes; untouched nodes keep the cell's name."""
+        end = self.cell_end[start]
+        order, pos = self.order, self.pos
+        nodes.sort(key=lambda node: counts[node])
+        if len(nodes) == end - start and counts[nodes[0]] == counts[nodes[-1]]:
+            return
+        # Touched nodes move to the back of the cell, in count order
+        tail = end - len(nodes)
+        for i, node in enumerate(nodes, tail):
+            other = order[i]
+            order[pos[node]], order[i] = other, node
+            pos[other], pos[node] = pos[node], i
+
+        parts = [start] if tail > start else []
+        for i in range(tail, end):
+            if i == tail or counts[order[i]] != counts[order[i - 1]]:
+                parts.append(i)
+        bounds = parts + [end]
+        was_queued = self.queued[start]
+        largest = max(range(len(parts)), key=lambda i: bounds[i + 1] - bounds[i])
+        for i, part in enumerate(parts):
+            self.cell_end[part] = bounds[i + 1]
+            if part != start:
+                for node in order[part:bounds[i + 1]]:
+                    self.cell[node] = part
+            # Hopcroft: a cell already waiting covers its parts; otherwise the largest can be skipped
+            if not self.queued[part] and (was_queued or i != largest):
+                self.queued[part] = 1
+                heapq.heappush(self.splitters, part)
+
+    def individualize(self, start: int) -> None:
+        """Move the last node of a cell into a cell of its own and refine."""
+        end = self.cell_end[start]
+        node = self.order[end - 1]
+        self.cell_end[start] = end - 1
+        self.cell[node] = end - 1
+        self._add_cell(end - 1, end)
+        self.refine()
+
+def canonical_labels(index: GraphIndex) -> array:
+    """Canonical label of every node, indexed by node id (see the module docstring)."""
+    partition = _Partition(index)
+    partition.refine()
+    start = 0
+    while start < len(index):
+        end = partition.cell_end[start]
+        if end - start > 1:
+            partition.individualize(start)
+        else:
+            start = end
+    return partition.pos
+
+def canonical_graph(index: GraphIndex, labels: array) -> Dict[str, List[str]]:
+    """The graph with every node renamed to its label, listed in label order with sorted dependencies."""
+    graph: Dict[str, List[str]] = {}
+    nodes = sorted(range(len(index)), key=labels.__getitem__)
+    for node in nodes:
+        graph[str(labels[node])] = [str(label) for label in sorted(labels[dep] for dep in index.dependencies(node))]
+    return graph
+
+def structure_fingerprint(index: GraphIndex) -> Tuple[str, array]:
+    """Return the structural fingerprint of the graph and the canonical label of every node."""
+    labels = canonical_labels(index)
+    digest = hashlib.sha256(str(len(index)).encode("ascii"))
+    for deps in canonical_graph(index, labels).values():
+        digest.update(("|" + ",".join(deps)).encode("ascii"))
+    return digest.hexdigest(), labels
+
+# ---------------------
+# Structure Cache
+# ---------------------
+
+class _Structure:
+    """A structure analyzed once: its canonical index, layout and order steps."""
+
+    def __init__(self, index: GraphIndex, x_positions: array, steps: List) -> None:
+        self.index = index
+        self.x_positions = x_positions
+        self.steps = steps
+
+class StructureCache:
+    """Bounded LRU of analyzed structures, keyed by structure_fingerprint."""
+
+    def __init__(self, max_entries: int = 4096) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, _Structure]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, fingerprint: str) -> Optional[_Structure]:
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(fingerprint)
+            self.hits += 1
+            return entry
+
+    def put(self, fingerprint: str, entry: _Structure) -> None:
+        with self._lock:
+            self._entries[fingerprint] = entry
+            self._entries.move_to_end(fingerprint)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+# ---------------------
+# Shared Analysis
+# ---------------------
+
+def process_code_by_structure(code: str, cache: StructureCache, timings: Optional[Dict[str, float]] = None,
+                              budget: Optional[Budget] = None) -> Dict:
+    """
+    Same result as process_code plus a 'structure' fingerprint, but the layout and order
+    come from the canonical graph and are shared with every program of the same structure
+    through cache. Results that took budget shortcuts are not cached.
+    """
+    clock = time.perf_counter
+    graph, index = index_code(code, budget, timings)
+    indexed = clock()
+    fingerprint, labels = structure_fingerprint(index)
+    fingerprinted = clock()
+
+    shared = cache.get(fingerprint)
+    if shared is None:
+        canonical = GraphIndex(canonical_graph(index, labels))
+        x_positions = layout_node_positions(canonical, budget)
+        shared = _Structure(canonical, x_positions, generate_order(canonical, x_positions, budget))
+        if budget is None or not budget.degraded:
+            cache.put(fingerprint, shared)
+    analyzed = clock()
+
+    # Canonical node ids are the labels, so the program's names drop straight in
+    relabeled = copy.copy(shared.index)
+    relabeled.names = [""] * len(index)
+    for node, label in enumerate(labels):
+        relabeled.names[label] = index.names[node]
+    result = {
+        "sterilized_graph": graph,
+        "positioned_nodes": materialize_nodes(relabeled, shared.x_positions),
+        "edges": generate_edges(relabeled),
+        "order": materialize_order(relabeled, shared.steps),
+        "stats": graph_stats(index),
+        "merged": index.merged,
+        "structure": fingerprint,
+        "degraded": budget.degraded if budget is not None else []
+    }
+    if timings is not None:
+        timings.update({
+            "fingerprint": fingerprinted - indexed,
+            "analyze": analyzed - fingerprinted,
+            "materialize": clock() - analyzed,
+        })
+    return result
@@ -0,0 +1,265 @@
+"""
+Layered (Sugiyama-style) layout with crossing minimization, computed with NumPy over the
+integer adjacency of a GraphIndex.
+
+  1. Layering: longest-path layers, the rows GraphIndex.depth already assigns (a node sits
+     one row below its deepest dependency).
+  2. Initial order: each row sorted by topological position, a depth-first postorder that
+     keeps connected nodes next to each other.
+  3. Crossing minimization: rounds of barycenter sweeps. A down sweep reorders the rows top
+     to bottom by the mean x of each node's dependencies; an up sweep reorders them bottom to
+     top by the mean x of each node's users. Every round after the first is an up sweep
+     followed by a down sweep. A row is reordered with a few whole-array operations, and
+     rows with a single node are skipped, so chains cost almost nothing.
+  4. Coordinate assignment: each row is spaced HORIZONTAL_SPACING apart and centred, so a
+     node's x is known after every sweep.
+
+Crossings are counted after each round the way the frontend draws edges: as straight
+lines, cut into segments at every row they pass. The best layout seen is kept. Sweeping stops
+when no crossings are left, when a round changes nothing (converged), when the count has
+not improved for PATIENCE rounds, or after MAX_ROUNDS.
+
+Cutting edges at every row costs time and memory in proportion to the rows the edges pass
+(depgraph2.edge_dummies), which for a variable read by every row of a deep graph grows with
+the square of the depth. Graphs over depgraph2.SUGIYAMA_MAX_DUMMIES per node are laid out
+by calculate_node_positions instead, and their crossings are not counted.
+
+sugiyama_layout() has the same contract as depgraph2.calculate_node_positions; select it
+through depgraph2.LAYOUT_ENGINES.
+"""
+from array import array
+from typing import Optional, Tuple
+
+import numpy as np
+
+from depgraph2 import HORIZONTAL_SPACING, Budget, GraphIndex, calculate_node_positions, sugiyama_fits
+
+MAX_ROUNDS = 8
+PATIENCE = 2
+
+# ---------------------
+# Adjacency
+# ---------------------
+
+def _edge_arrays(index: GraphIndex) -> Tuple[np.ndarray, np.ndarray]:
+    """(source, target) node ids of every edge, in edge order."""
+    offsets = np.frombuffer(index.dep_offsets, dtype=np.int32)
+    sources = np.frombuffer(index.deps, dtype=np.int32) if len(index.deps) else np.zeros(0, np.int32)
+    targets = np.repeat(np.arange(len(index), dtype=np.int32), np.diff(offsets))
+    return sources.astype(np.int64), targets.astype(np.int64)
+
+def _layers(index: GraphIndex) -> np.ndarray:
+    return np.frombuffer(index.depth, dtype=np.int32).astype(np.int64)
+
+# ---------------------
+# Crossing Counting
+# ---------------------
+
+def _split_long_edges(layers: np.ndarray, sources: np.ndarray, targets: np.ndarray):
+    """
+    Cut every edge into segments between adjacent rows, with a dummy point on each row it passes.
+    Returns the row of every node and dummy point (dummies numbered from len(layers)), the
+    segments as (upper, lower) arrays, and for each dummy point the edge it belongs to.
+    """
+    n = len(layers)
+    spans = layers[targets] - layers[sources]
+    dummies_per_edge = spans - 1
+    total = int(dummies_per_edge.sum())
+    dummy_edge = np.repeat(np.arange(len(sources)), dummies_per_edge)
+    first_dummy = np.cumsum(dummies_per_edge) - dummies_per_edge    # Offset of each edge's first dummy
+    step = np.arange(total) - first_dummy[dummy_edge] + 1           # 1..span-1 along the edge
+    node_layers = np.concatenate([layers, layers[sources][dummy_edge] + step])
+
+    # Chain per edge: source -> dummies... -> target
+    dummy_ids = n + np.arange(total)
+    uppers = np.concatenate([
+        sources[dummies_per_edge == 0],
+        sources[dummies_per_edge > 0],
+        dummy_ids[step < dummies_per_edge[dummy_edge]],
+        dummy_ids[step == dummies_per_edge[dummy_edge]],
+    ])
+    lowers = np.concatenate([
+        targets[dummies_per_edge == 0],
+        dummy_ids[step == 1],
+        dummy_ids[step < dummies_per_edge[dummy_edge]] + 1,
+        targets[dummy_edge[step == dummies_per_edge[dummy_edge]]],
+    ])
+    return node_layers, uppers, lowers, dummy_edge
+
+_BLOCK = 16
+_BEFORE = np.triu(np.ones((_BLOCK, _BLOCK), dtype=bool), 1)    # _BEFORE[i, j]: i comes before j
+
+def count_inversions(keys: np.ndarray) -> int:
+    """
+    Number of pairs i < j with keys[i] > keys[j]. Blocks of _BLOCK keys are compared
+    pairwise, then merged bottom-up: each merge counts, for every key of a right-hand
+    block, the greater keys of its left-hand neighbour.
+    """
+    n = len(keys)
+    if n < 2:
+        return 0
+    ranks = np.unique(keys, return_inverse=True)[1].astype(np.int64).ravel()
+    span = int(ranks.max()) + 2
+    size = max(_BLOCK, 1 << (n - 1).bit_length())
+    merged = np.full(size, span - 1, dtype=np.int64)    # Padding sorts last and never inverts
+    merged[:n] = ranks
+    blocks = merged.reshape(-1, _BLOCK)
+    total = int((_BEFORE & (blocks[:, :, None] > blocks[:, None, :])).sum())
+    merged = np.sort(blocks, axis=1).ravel()
+    block = _BLOCK
+    while block < size:
+        pairs = merged.reshape(-1, 2, block)
+        offsets = (np.arange(len(pairs), dtype=np.int64) * span)[:, None]
+        left = (pairs[:, 0, :] + offsets).ravel()
+        right = (pairs[:, 1, :] + offsets).ravel()
+        left_end = np.repeat(np.arange(1, len(pairs) + 1) * block, block)
+        total += int((left_end - np.searchsorted(left, right, side="right")).sum())
+        merged = np.sort(pairs.reshape(-1, 2 * block), axis=1).ravel()
+        block *= 2
+    return total
+
+class _Segments:
+    """
+    Edges drawn as straight lines and cut at every row they pass. Two segments between the
+    same pair of rows cross when their order on the upper row and on the lower row differ.
+    """
+
+    def __init__(self, layers: np.ndarray, sources: np.ndarray, targets: np.ndarray) -> None:
+        n = len(layers)
+        node_layers, self.uppers, self.lowers, dummy_edge = _split_long_edges(layers, sources, targets)
+        self.edge_sources, self.edge_targets = sources[dummy_edge], targets[dummy_edge]
+        spans = layers[self.edge_targets] - layers[self.edge_sources]
+        self.fractions = (node_layers[n:] - layers[self.edge_sources]) / np.maximum(spans, 1)
+        self.gaps = node_layers[self.uppers]
+
+    def crossings(self, x: np.ndarray) -> int:
+        src_x, tgt_x = x[self.edge_sources], x[self.edge_targets]
+        all_x = np.concatenate([x, src_x + (tgt_x - src_x) * self.fractions])
+        upper, lower = all_x[self.uppers], all_x[self.lowers]
+        # Sorted by gap, then upper x: every inversion of the lower x is a crossing
+        by_gap = np.lexsort((lower, upper, self.gaps))
+        # Offset each gap past the x range of the previous ones so pairs from different gaps never invert
+        stride = 2 * float(np.abs(all_x).max()) + 1
+        return count_inversions((self.gaps * stride + lower)[by_gap])
+
+# ---------------------
+# Crossing Minimization
+# ---------------------
+
+class _Rows:
+    """Nodes grouped by layer, with the edges into each layer from above and from below."""
+
+    def __init__(self, layers: np.ndarray, sources: np.ndarray, targets: np.ndarray) -> None:
+        n = len(layers)
+        self.nodes_by_id = np.argsort(layers, kind="stable")
+        sizes = np.bincount(layers)
+        self.starts = np.concatenate([[0], np.cumsum(sizes)])
+        self.local = np.empty(n, dtype=np.int64)    # Index of a node within its row
+        self.local[self.nodes_by_id] = np.arange(n) - self.starts[layers[self.nodes_by_id]]
+        # Edges grouped by the layer of their lower end (down sweeps) and upper end (up sweeps)
+        down = np.argsort(layers[targets], kind="stable")
+        up = np.argsort(layers[sources], kind="stable")
+        self.down = (targets[down], sources[down], np.searchsorted(layers[targets][down], np.arange(len(sizes) + 1)))
+        self.up = (sources[up], targets[up], np.searchsorted(layers[sources][up], np.arange(len(sizes) + 1)))
+
+    def __len__(self) -> int:
+        return len(self.starts) - 1
+
+    def row(self, layer: int) -> np.ndarray:
+        return self.nodes_by_id[self.starts[layer]:self.starts[layer + 1]]
+
+def _place(nodes: np.ndarray, keys: np.ndarray, x: np.ndarray) -> None:
+    """Order a row by keys (ties keep the current order) and space it out, centred."""
+    order = np.lexsort((x[nodes], keys))
+    x[nodes[order]] = (np.arange(len(nodes)) - (len(nodes) - 1) / 2) * HORIZONTAL_SPACING
+
+def _sweep(rows: _Rows, x: np.ndarray, downward: bool) -> None:
+    """
+    One barycenter sweep: each row in turn, top to bottom (or bottom to top), is reordered
+    by the mean x of its neighbours in the rows already visited.
+    """
+    movers, neighbours, bounds = rows.down if downward else rows.up
+    layers = range(1, len(rows)) if downward else range(len(rows) - 2, -1, -1)
+    for layer in layers:
+        nodes = rows.row(layer)
+        if len(nodes) < 2:
+            continue
+        lo, hi = bounds[layer], bounds[layer + 1]
+        local = rows.local[movers[lo:hi]]
+        sums = np.bincount(local, weights=x[neighbours[lo:hi]], minlength=len(nodes))
+        counts = np.bincount(local, minlength=len(nodes))
+        keys = x[nodes].copy()    # Nodes without neighbours on that side stay where they are
+        has = counts > 0
+        keys[has] = sums[has] / counts[has]
+        _place(nodes, keys, x)
+
+# ---------------------
+# Layout
+# ---------------------
+
+def sugiyama_layout(index: GraphIndex, budget: Optional[Budget] = None) -> array:
+    """
+    Compute the horizontal position of every node, indexed by node id (see the module
+    docstring). Under a budget, graphs over the size limits keep the initial ordering and
+    the sweeps stop once the time limit is reached, as in calculate_node_positions.
+    """
+    n = len(index)
+    if n == 0:
+        return array('d')
+    if not sugiyama_fits(index):
+        return calculate_node_positions(index, budget)
+    sources, targets = _edge_arrays(index)
+    layers = _layers(index)
+    rows = _Rows(layers, sources, targets)
+
+    topo_rank = np.empty(n, dtype=np.float64)
+    topo_rank[np.frombuffer(index.topo, dtype=np.int32)] = np.arange(n)
+    x = np.zeros(n)
+    for layer in range(len(rows)):
+        nodes = rows.row(layer)
+        _place(nodes, topo_rank[nodes], x)
+
+    if budget is not None and budget.graph_too_large(index):
+        budget.degraded.append("layout_simplified")
+        return array('d', x.tobytes())
+    if budget is not None and budget.expired():
+        budget.degraded.append("layout_truncated")
+        return array('d', x.tobytes())
+
+    segments = _Segments(layers, sources, targets)
+    if budget is not None and budget.expired():    # Cutting the edges alone can use up the time left
+        budget.degraded.append("layout_truncated")
+        return array('d', x.tobytes())
+    best, best_crossings = x.copy(), segments.crossings(x)
+    stale = 0
+    for rounds in range(MAX_ROUNDS):
+        if best_crossings == 0 or stale >= PATIENCE:
+            break
+        if budget is not None and budget.expired():
+            budget.degraded.append("layout_truncated")
+            break
+        before = x.copy()
+        if rounds:
+            _sweep(rows, x, downward=False)
+        _sweep(rows, x, downward=True)
+        if np.array_equal(x, before):    # Converged: further sweeps would repeat this one
+            break
+        crossings = segments.crossings(x)
+        if crossings < best_crossings:
+            best, best_crossings, stale = x.copy(), crossings, 0
+        else:
+            stale += 1
+    return array('d', best.tobytes())
+
+def count_crossings(index: GraphIndex, x_positions: array) -> Optional[int]:
+    """
+    Edge crossings of a layout drawn with straight edges between rows (index.depth), so
+    layouts from any engine can be compared. None for graphs whose edges pass too many rows
+    to count them (see the module docstring).
+    """
+    if len(index) == 0:
+        return 0
+    if not sugiyama_fits(index):
+        return None
+    sources, targets = _edge_arrays(index)
+    return _Segments(_layers(index), sources, targets).crossings(np.frombuffer(x_positions, dtype=np.float64))
@@ -0,0 +1,132 @@
+"""
+Compact columnar encoding of /analyze payloads.
+
+The default payload repeats the same style objects on every node and edge and names
+everything with strings like "node17" and "edge3-17". The compact form sends each
+distinct style, node type and color once and lays the rest out as columns:
+
+    {
+      "format": "compact/1",
+      "node_styles": [{...}], "edge_styles": [{"type": ..., "style": {...}}],
+      "types": ["custominput", "step", ...], "colors": ["#0000FF", ...],
+      "nodes": {"label": [...], "type": [...], "style": [...], "x": [...], "y": [...]},
+      "edges": {"source": [...], "target": [...], "style": [...]},
+      "order": [element, color, element, color, ...]
+    }
+
+Node i has id "node{i + 1}" and edge j has id "edge{source + 1}-{target + 1}"; when a
+payload uses other ids they are sent in an extra "id" column. In "order", elements below
+the node count are node indexes and the rest are the node count plus an edge index.
+"""
+import gzip
+import json
+from typing import Dict, List
+
+COMPACT_FORMAT = "compact/1"
+COMPACT_MEDIA_TYPE = "application/vnd.depgraph.compact+json"
+
+def _table(values: List, item) -> int:
+    """Return the index of item in values, appending it if new (tables are tiny)."""
+    for idx, value in enumerate(values):
+        if value == item:
+            return idx
+    values.append(item)
+    return len(values) - 1
+
+def to_compact(payload: Dict) -> Dict:
+    """Convert a {"nodes", "edges", "order"} payload into the compact columnar form."""
+    nodes, edges = payload["nodes"], payload["edges"]
+    node_styles, edge_styles, types, colors = [], [], [], []
+
+    node_index = {}
+    labels, type_codes, style_codes, xs, ys, node_ids = [], [], [], [], [], []
+    default_node_ids = True
+    for idx, node in enumerate(nodes):
+        node_index[node["id"]] = idx
+        node_ids.append(node["id"])
+        default_node_ids = default_node_ids and node["id"] == "node" + str(idx + 1)
+        labels.append(node["data"]["label"])
+        type_codes.append(_table(types, node["mytype"]))
+        style_codes.append(_table(node_styles, node["style"]))
+        xs.append(node["position"]["x"])
+        ys.append(node["position"]["y"])
+
+    element_index = dict(node_index)
+    sources, targets, edge_style_codes, edge_ids = [], [], [], []
+    default_edge_ids = True
+    for idx, edge in enumerate(edges):
+        source, target = node_index[edge["source"]], node_index[edge["target"]]
+        element_index[edge["id"]] = len(nodes) + idx
+        edge_ids.append(edge["id"])
+        default_edge_ids = default_edge_ids and edge["id"] == f"edge{source + 1}-{target + 1}"
+        sources.append(source)
+        targets.append(target)
+        edge_style_codes.append(_table(edge_styles, {"type": edge["type"], "style": edge["style"]}))
+
+    order = []
+    for element, color in payload["order"]:
+        order.append(element_index[element])
+        order.append(_table(colors, color))
+
+    compact = {
+        "format": COMPACT_FORMAT,
+        "node_styles": node_styles,
+        "edge_styles": edge_styles,
+        "types": types,
+        "colors": colors,
+        "nodes": {"label": labels, "type": type_codes, "style": style_codes, "x": xs, "y": ys},
+        "edges": {"source": sources, "target": targets, "style": edge_style_codes},
+        "order": order,
+    }
+    if not default_node_ids:
+        compact["nodes"]["id"] = node_ids
+    if not default_edge_ids:
+        compact["edges"]["id"] = edge_ids
+    for key, value in payload.items():
+        if key not in ("nodes", "edges", "order"):
+            compact[key] = value
+    return compact
+
+def from_compact(compact: Dict) -> Dict:
+    """Rebuild the default payload from its compact form (inverse of to_compact)."""
+    columns = compact["nodes"]
+    node_ids = columns.get("id") or ["node" + str(idx + 1) for idx in range(len(columns["label"]))]
+    nodes = [
+        {
+            "id": node_ids[idx],
+            "mytype": compact["types"][columns["type"][idx]],
+            "data": {"label": columns["label"][idx]},
+            "position": {"x": columns["x"][idx], "y": columns["y"][idx]},
+            "style": compact["node_styles"][columns["style"][idx]],
+        }
+        for idx in range(len(node_ids))
+    ]
+    columns = compact["edges"]
+    edge_ids = columns.get("id") or [
+        f"edge{source + 1}-{target + 1}" for source, target in zip(columns["source"], columns["target"])
+    ]
+    edges = []
+    for idx, edge_id in enumerate(edge_ids):
+        edge_style = compact["edge_styles"][columns["style"][idx]]
+        edges.append({
+            "id": edge_id,
+            "source": node_ids[columns["source"][idx]],
+            "target": node_ids[columns["target"][idx]],
+            "type": edge_style["type"],
+            "style": edge_style["style"],
+        })
+    element_ids = node_ids + edge_ids
+    flat = compact["order"]
+    order = [[element_ids[flat[i]], compact["colors"][flat[i + 1]]] for i in range(0, len(flat), 2)]
+    payload = {"nodes": nodes, "edges": edges, "order": order}
+    for key, value in compact.items():
+        if key not in ("format", "node_styles", "edge_styles", "types", "colors", "nodes", "edges", "order"):
+            payload[key] = value
+    return payload
+
+def encode(payload: Dict, compact: bool = False) -> bytes:
+    """Serialize a payload as JSON, optionally in the compact form."""
+    return json.dumps(to_compact(payload) if compact else payload, separators=(",", ":")).encode("utf-8")
+
+def gzip_body(body: bytes) -> bytes:
+    return gzip.compress(body, compresslevel=6)